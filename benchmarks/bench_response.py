@@ -0,0 +1,104 @@
+"""
+Compare the Redsys response parsing pipelines.
+
+    python benchmarks/bench_response.py --responses 20000
+
+``legacy`` is the path used before the raw bytes pipeline: ``resp.json()``
+refused for a ``text/html`` body, ``resp.text()``, ``json.loads`` of the
+string, base64 decode of ``Ds_MerchantParameters``, ``.decode("utf-8")`` and
+a second ``json.loads``. ``raw`` is ``parse_redsys_response`` on the body
+bytes. The report shows CPU time and peak memory allocated per response.
+"""
+from guillotina_redsys.models import parse_redsys_response
+from guillotina_redsys.transports import TransportResponse
+
+import argparse
+import base64
+import json
+import time
+import tracemalloc
+
+
+PARAMS = {
+    "Ds_Amount": "1249",
+    "Ds_Currency": "978",
+    "Ds_Order": "1234ABCD5678",
+    "Ds_MerchantCode": "999008881",
+    "Ds_Terminal": "1",
+    "Ds_Response": "0000",
+    "Ds_AuthorisationCode": "123456",
+    "Ds_TransactionType": "0",
+    "Ds_SecurePayment": "2",
+    "Ds_Language": "1",
+    "Ds_Card_Number": "454881******0003",
+    "Ds_Card_Brand": "1",
+    "Ds_Card_Country": "724",
+    "Ds_ProcessedPayMethod": "78",
+    "Ds_Merchant_Identifier": "a" * 40,
+    "Ds_ExpiryDate": "4912",
+}
+BODY = json.dumps(
+    {
+        "Ds_SignatureVersion": "HMAC_SHA512_V2",
+        "Ds_MerchantParameters": base64.urlsafe_b64encode(
+            json.dumps(PARAMS).encode("utf-8")
+        )
+        .decode("ascii")
+        .rstrip("="),
+        "Ds_Signature": "x" * 86,
+    }
+).encode("utf-8")
+
+
+def legacy(body):
+    resp = TransportResponse(200, body, "text/html", "UTF-8")
+    try:
+        text = resp.json()
+    except Exception:
+        text = resp.text()
+    response = json.loads(text)
+    encoded = response["Ds_MerchantParameters"]
+    raw = base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4))
+    return json.loads(raw.decode("utf-8"))
+
+
+def raw(body):
+    return parse_redsys_response(TransportResponse(200, body, "text/html").body)
+
+
+def cpu_per_response(pipeline, responses):
+    started = time.process_time()
+    for _ in range(responses):
+        pipeline(BODY)
+    return (time.process_time() - started) / responses
+
+
+def peak_per_response(pipeline, rounds=1000):
+    # highest memory held at once while parsing one response
+    tracemalloc.start()
+    pipeline(BODY)
+    total = 0
+    for _ in range(rounds):
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        pipeline(BODY)
+        total += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+    return total / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--responses", type=int, default=20000)
+    args = parser.parse_args()
+    assert legacy(BODY) == raw(BODY)
+    print(f"body {len(BODY)} bytes, {args.responses} responses")
+    print(f"{'pipeline':<8} {'cpu us/resp':>12} {'peak bytes/resp':>16}")
+    for name, pipeline in (("legacy", legacy), ("raw", raw)):
+        cpu = cpu_per_response(pipeline, args.responses)
+        peak = peak_per_response(pipeline)
+        print(f"{name:<8} {cpu * 1e6:>12.2f} {peak:>16.0f}")
+
+
+if __name__ == "__main__":
+    main()
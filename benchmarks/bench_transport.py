@@ -0,0 +1,163 @@
+"""
+Compare RestAPI transports against local stubs that answer like Redsys.
+
+    pip install -e .[http2]
+    python benchmarks/bench_transport.py --requests 5000 --concurrency 300 --delay 0.05
+
+The aiohttp transport talks HTTP/1.1 to an aiohttp.web stub, the http2
+transport talks h2c (prior knowledge) to an h2 stub. Both stubs wait
+``--delay`` seconds before answering, like a remote Redsys would. The report
+shows throughput, latency percentiles and the sockets each client opened.
+"""
+from aiohttp import web
+from guillotina_redsys.transports import AiohttpTransport
+from guillotina_redsys.transports import HTTP2Transport
+from guillotina_redsys.utils import RestAPI
+
+import aiohttp
+import argparse
+import asyncio
+import h2.config
+import h2.connection
+import h2.events
+import json
+import statistics
+import time
+
+
+BODY = json.dumps(
+    {
+        "Ds_SignatureVersion": "HMAC_SHA512_V2",
+        "Ds_MerchantParameters": "eyJEc19PcmRlciI6ICJBQkNEMTIzNCJ9" * 20,
+        "Ds_Signature": "x" * 86,
+    }
+).encode("utf-8")
+
+
+class H2StubProtocol(asyncio.Protocol):
+    connections = 0
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.conn = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(client_side=False)
+        )
+
+    def connection_made(self, transport):
+        H2StubProtocol.connections += 1
+        self.transport = transport
+        self.conn.initiate_connection()
+        self.transport.write(self.conn.data_to_send())
+
+    def data_received(self, data):
+        for event in self.conn.receive_data(data):
+            if isinstance(event, h2.events.DataReceived):
+                self.conn.acknowledge_received_data(
+                    event.flow_controlled_length, event.stream_id
+                )
+            elif isinstance(event, h2.events.StreamEnded):
+                asyncio.get_running_loop().call_later(
+                    self.delay, self.respond, event.stream_id
+                )
+        self.transport.write(self.conn.data_to_send())
+
+    def respond(self, stream_id):
+        if self.transport.is_closing():
+            return
+        self.conn.send_headers(
+            stream_id,
+            [
+                (":status", "200"),
+                ("content-type", "text/html;charset=UTF-8"),
+                ("content-length", str(len(BODY))),
+            ],
+        )
+        self.conn.send_data(stream_id, BODY, end_stream=True)
+        self.transport.write(self.conn.data_to_send())
+
+
+async def start_http1_stub(delay):
+    connections = set()
+
+    async def handler(request):
+        connections.add(request.transport)
+        await request.read()
+        await asyncio.sleep(delay)
+        return web.Response(body=BODY, content_type="text/html")
+
+    app = web.Application()
+    app.router.add_post("/{tail:.*}", handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, port, connections
+
+
+async def drive(api, requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one():
+        async with semaphore:
+            started = time.perf_counter()
+            await api.post("/trataPeticionREST", json={"Ds_MerchantParameters": "x"})
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(requests)])
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "rps": round(requests / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 1),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 1),
+    }
+
+
+async def main(args):
+    loop = asyncio.get_running_loop()
+    results = {}
+
+    runner, port, connections = await start_http1_stub(args.delay)
+    api = RestAPI(
+        f"http://127.0.0.1:{port}",
+        transport=AiohttpTransport(
+            session=aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=args.max_connections)
+            )
+        ),
+    )
+    results["aiohttp"] = await drive(api, args.requests, args.concurrency)
+    results["aiohttp"]["sockets"] = len(connections)
+    await api.session.close()
+    await runner.cleanup()
+
+    server = await loop.create_server(
+        lambda: H2StubProtocol(args.delay), "127.0.0.1", 0
+    )
+    port = server.sockets[0].getsockname()[1]
+    api = RestAPI(
+        f"http://127.0.0.1:{port}",
+        transport=HTTP2Transport(
+            max_connections=args.h2_connections, prior_knowledge=True
+        ),
+    )
+    results["http2"] = await drive(api, args.requests, args.concurrency)
+    results["http2"]["sockets"] = H2StubProtocol.connections
+    await api.close()
+    server.close()
+
+    for name, result in results.items():
+        print(name, result)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--delay", type=float, default=0.05)
+    parser.add_argument("--max-connections", type=int, default=100)
+    parser.add_argument("--h2-connections", type=int, default=1)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,188 @@
+"""
+Replay recorded Redsys flows against a running Guillotina and the simulator.
+
+    # Guillotina configured with "url_redsys": "http://localhost:8181"
+    python -m guillotina_redsys.simulator --port 8181
+    python benchmarks/replay.py redsys-traces.jsonl \\
+        --guillotina http://localhost:8080/db/container \\
+        --simulator http://localhost:8181 --speed 4 --json before.json
+
+Traces come from the ``traces`` setting of ``RedsysUtility``. Each recorded
+flow gets a fresh order id; its outcomes and Redsys latencies are queued in
+the simulator, and its steps are sent to the Guillotina services at the
+recorded pace divided by ``--speed``. The report shows throughput and
+p50/p95/p99 latency per Guillotina endpoint; ``--json`` saves it to compare
+releases.
+"""
+from guillotina_redsys.retries import REQUEST_ATTEMPTS
+from guillotina_redsys.traces import load_traces
+
+import aiohttp
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+
+CARD = {"card": "4548810000000003", "expiry_date": "4912", "cvv": "123"}
+AMOUNT = "10.00"
+
+
+def new_order():
+    # Redsys wants the first 4 characters numeric
+    return f"{int(time.time()) % 10000:04d}{uuid.uuid4().hex[:8]}"
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+class Replayer:
+    def __init__(self, session, guillotina, simulator, speed, stats):
+        self.session = session
+        self.guillotina = guillotina.rstrip("/")
+        self.simulator = simulator.rstrip("/")
+        self.speed = speed
+        self.stats = stats
+
+    async def call(self, endpoint, path, payload):
+        started = time.monotonic()
+        try:
+            async with self.session.post(
+                f"{self.guillotina}/{path}", json=payload
+            ) as resp:
+                body = await resp.read()
+                status = resp.status
+        except aiohttp.ClientError:
+            body, status = b"", 0
+        entry = self.stats.setdefault(endpoint, {"latencies": [], "errors": 0})
+        entry["latencies"].append(time.monotonic() - started)
+        if status != 200:
+            entry["errors"] += 1
+            return None
+        return json.loads(body) if body else None
+
+    async def queue_scenario(self, order, steps):
+        scenario = []
+        for step in steps:
+            if step["outcome"] == "failed":
+                scenario.append(
+                    {"outcome": "failed", "latency": 0, "repeat": REQUEST_ATTEMPTS}
+                )
+            else:
+                scenario.append(
+                    {"outcome": step["outcome"], "latency": step["duration"]}
+                )
+        async with self.session.post(
+            f"{self.simulator}/_scenario", json={"order": order, "steps": scenario}
+        ) as resp:
+            resp.raise_for_status()
+
+    async def run_flow(self, steps, origin, started):
+        order = new_order()
+        await self.queue_scenario(order, steps)
+        payload = dict(CARD, amount=AMOUNT, order_id=order)
+        transaction_id = protocol = None
+        for step in steps:
+            delay = started + (step["at"] - origin) / self.speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            name = step["step"]
+            if name == "CardData":
+                res = await self.call(
+                    "@initTransactionRedsys", "@initTransactionRedsys", payload
+                )
+                if not res or "Ds_EMV3DS" not in res:
+                    return
+                transaction_id = res["Ds_EMV3DS"]["threeDSServerTransID"]
+                protocol = res["Ds_EMV3DS"]["protocolVersion"]
+            elif name == "AuthenticationData" and transaction_id:
+                await self.call(
+                    "@initTrataPeticion",
+                    "@initTrataPeticion",
+                    dict(
+                        payload,
+                        transaction_id=transaction_id,
+                        protocol_version=protocol,
+                        three_ds_comp_ind="Y",
+                    ),
+                )
+            elif name == "ChallengeResponse" and transaction_id:
+                suffix = f"{order}/{transaction_id}"
+                await self.call(
+                    "@notificationRedsysChallenge",
+                    f"@notificationRedsysChallenge/{suffix}",
+                    {"CRES": "eyJ0cmFuc1N0YXR1cyI6IlkifQ"},
+                )
+                await self.call(
+                    "@performNotificationRedsysChallenge",
+                    f"@performNotificationRedsysChallenge/{suffix}",
+                    dict(payload, protocol_version=protocol),
+                )
+            elif name == "token":
+                await self.call(
+                    "@tokenPaymentRedsys",
+                    "@tokenPaymentRedsys",
+                    {"amount": AMOUNT, "order_id": order, "identifier": "replay"},
+                )
+
+
+def report(stats, elapsed):
+    result = {}
+    for endpoint, entry in sorted(stats.items()):
+        latencies = entry["latencies"]
+        result[endpoint] = {
+            "requests": len(latencies),
+            "errors": entry["errors"],
+            "throughput": round(len(latencies) / elapsed, 2),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        }
+    return result
+
+
+async def main(args):
+    flows = load_traces(args.traces)
+    if args.limit:
+        flows = flows[: args.limit]
+    origin = flows[0][0]["at"]
+    stats = {}
+    auth = aiohttp.BasicAuth(*args.auth.split(":", 1))
+    connector = aiohttp.TCPConnector(limit=args.connections)
+    async with aiohttp.ClientSession(auth=auth, connector=connector) as session:
+        replayer = Replayer(session, args.guillotina, args.simulator, args.speed, stats)
+        started = time.monotonic()
+        await asyncio.gather(
+            *[replayer.run_flow(steps, origin, started) for steps in flows]
+        )
+        elapsed = time.monotonic() - started
+
+    result = report(stats, elapsed)
+    print(f"{len(flows)} flows in {elapsed:.1f}s (speed x{args.speed})")
+    print(f"{'endpoint':<38} {'reqs':>6} {'errs':>5} {'req/s':>8} ", end="")
+    print(f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for endpoint, row in result.items():
+        print(
+            f"{endpoint:<38} {row['requests']:>6} {row['errors']:>5} "
+            f"{row['throughput']:>8} {row['p50_ms']:>8} {row['p95_ms']:>8} "
+            f"{row['p99_ms']:>8}"
+        )
+    if args.json:
+        with open(args.json, "w") as fi:
+            json.dump({"elapsed": elapsed, "endpoints": result}, fi, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("traces")
+    parser.add_argument("--guillotina", default="http://localhost:8080/db/container")
+    parser.add_argument("--simulator", default="http://localhost:8181")
+    parser.add_argument("--auth", default="root:root")
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--limit", type=int, default=0)
+    parser.add_argument("--connections", type=int, default=100)
+    parser.add_argument("--json", default=None)
+    asyncio.run(main(parser.parse_args()))
@@ -25,6 +25,7 @@ app_settings = {
 
 def includeme(root, settings):
     configure.scan("guillotina_redsys.utility")
+    configure.scan("guillotina_redsys.schemas")
     configure.scan("guillotina_redsys.api")
     configure.scan("guillotina_redsys.interfaces")
     configure.scan("guillotina_redsys.utils")
@@ -0,0 +1,202 @@
+from collections import OrderedDict
+from guillotina_redsys import metrics
+from guillotina_redsys.resources import resources
+from guillotina_redsys.transports import Transport
+from guillotina_redsys.transports import TransportResponse
+from typing import Any
+from typing import Dict
+from typing import Optional
+from yarl import URL
+
+import aiohttp
+import time
+
+
+ACS_HOSTS_EVICTED = metrics.Counter(
+    "redsys_acs_hosts_evicted_total",
+    "ACS hosts whose connections were closed, by reason",
+    labels=("reason",),
+)
+ACS_PRECONNECTS = metrics.Counter(
+    "redsys_acs_preconnects_total",
+    "Connections opened to ACS hosts ahead of the 3DS method, by result",
+    labels=("result",),
+)
+ACS_REQUEST_SECONDS = metrics.Histogram(
+    "redsys_acs_request_seconds",
+    "Duration of the requests to ACS hosts",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+
+
+class AcsHost:
+    def __init__(self, origin: str, session: aiohttp.ClientSession) -> None:
+        self.origin = origin
+        self.session = session
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        # exponentially weighted average, seconds
+        self.latency: Optional[float] = None
+        self.last_used = time.monotonic()
+
+    def status(self) -> dict:
+        return {
+            "host": self.origin,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "latency": self.latency,
+            "idle": time.monotonic() - self.last_used,
+        }
+
+
+class AcsClient(Transport):
+    """
+    Transport for the 3DS method posts to the issuers' ACS hosts.
+
+    Each host gets its own connection pool of at most ``per_host_limit``
+    sockets, with DNS answers cached for ``dns_ttl`` seconds. At most
+    ``max_hosts`` hosts are kept warm: the least recently used one is closed
+    to make room, and hosts unused for ``idle_timeout`` seconds are closed
+    on the next request, so popular issuers keep their connections and
+    memory stays bounded. Latency and errors are tracked per host.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_hosts: int = 256,
+        per_host_limit: int = 4,
+        idle_timeout: float = 60.0,
+        dns_ttl: int = 300,
+        timeout: float = 10.0,
+        preconnect_timeout: float = 3.0,
+        alpha: float = 0.3,
+    ) -> None:
+        self.max_hosts = max_hosts
+        self.per_host_limit = per_host_limit
+        self.idle_timeout = idle_timeout
+        self.dns_ttl = dns_ttl
+        self.timeout = timeout
+        self.preconnect_timeout = preconnect_timeout
+        self.alpha = alpha
+        # least recently used first
+        self._hosts: "OrderedDict[str, AcsHost]" = OrderedDict()
+
+    def _new_session(self) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(
+            limit=self.per_host_limit,
+            ttl_dns_cache=self.dns_ttl,
+            keepalive_timeout=self.idle_timeout,
+        )
+        return resources.track_session(
+            aiohttp.ClientSession(
+                connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        )
+
+    async def _evict(self) -> None:
+        now = time.monotonic()
+        for origin, host in list(self._hosts.items()):
+            if host.in_flight:
+                continue
+            if now - host.last_used > self.idle_timeout:
+                reason = "idle"
+            elif len(self._hosts) > self.max_hosts:
+                reason = "lru"
+            else:
+                break
+            del self._hosts[origin]
+            ACS_HOSTS_EVICTED.inc(reason=reason)
+            await host.session.close()
+
+    def _get_host(self, url: str) -> AcsHost:
+        origin = str(URL(url).origin())
+        host = self._hosts.get(origin)
+        if host is None:
+            host = self._hosts[origin] = AcsHost(origin, self._new_session())
+        else:
+            self._hosts.move_to_end(origin)
+        host.last_used = time.monotonic()
+        # busy hosts are not evicted
+        host.in_flight += 1
+        return host
+
+    async def request(
+        self,
+        method: str,
+        url: str,
+        *,
+        json: Optional[Dict[str, Any]] = None,
+        data: Optional[Any] = None,
+        params: Optional[Dict[str, Any]] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> TransportResponse:
+        host = self._get_host(url)
+        host.requests += 1
+        try:
+            await self._evict()
+            started = time.monotonic()
+            with resources.in_flight("acs"):
+                async with host.session.request(
+                    method, url, json=json, data=data, params=params, headers=headers
+                ) as resp:
+                    response = TransportResponse(
+                        resp.status, await resp.read(), resp.content_type, resp.charset
+                    )
+        except Exception:
+            host.errors += 1
+            raise
+        finally:
+            host.in_flight -= 1
+            host.last_used = time.monotonic()
+        latency = host.last_used - started
+        host.latency = (
+            latency
+            if host.latency is None
+            else self.alpha * latency + (1 - self.alpha) * host.latency
+        )
+        ACS_REQUEST_SECONDS.observe(latency)
+        return response
+
+    async def preconnect(self, url: str) -> bool:
+        """
+        Open a connection to the host of ``url`` before the 3DS method post
+        needs it: DNS, TCP and TLS are done by a ``HEAD`` of the origin and
+        the socket stays in the host pool. Hosts already warm are skipped.
+        Returns whether a connection was opened.
+        """
+        origin = str(URL(url).origin())
+        if origin in self._hosts:
+            ACS_PRECONNECTS.inc(result="warm")
+            return False
+        host = self._get_host(url)
+        try:
+            await self._evict()
+            async with host.session.head(
+                origin,
+                allow_redirects=False,
+                timeout=aiohttp.ClientTimeout(total=self.preconnect_timeout),
+            ) as resp:
+                await resp.read()
+        except Exception:
+            ACS_PRECONNECTS.inc(result="error")
+            return False
+        finally:
+            host.in_flight -= 1
+        ACS_PRECONNECTS.inc(result="connected")
+        return True
+
+    def status(self) -> dict:
+        return {
+            "max_hosts": self.max_hosts,
+            "per_host_limit": self.per_host_limit,
+            # most recently used first
+            "hosts": [host.status() for host in reversed(self._hosts.values())],
+        }
+
+    async def close(self) -> None:
+        hosts, self._hosts = self._hosts, OrderedDict()
+        for host in hosts.values():
+            await host.session.close()
@@ -0,0 +1,126 @@
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+from typing import Dict
+
+import logging
+import math
+import time
+
+
+logger = logging.getLogger("guillotina_redsys")
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, operation: str, retry_after: int):
+        self.operation = operation
+        self.retry_after = retry_after
+        super().__init__(f"Too many {operation} requests in flight")
+
+
+class OperationLimit:
+    def __init__(self, limit: float) -> None:
+        self.limit = limit
+        self.in_flight = 0
+        # exponentially weighted average, seconds
+        self.latency = None
+        self.admitted = 0
+        self.rejected = 0
+        # calls started before the last decrease do not decrease again
+        self.decreased_at = float("-inf")
+
+    def status(self) -> dict:
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "latency": self.latency,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+        }
+
+
+class AdmissionController:
+    """
+    Per operation concurrency limits that adapt to the Redsys latency.
+
+    Each call waits on Redsys holding a slot; when all ``limit`` slots of an
+    operation are taken new calls are rejected at once instead of queueing.
+    The limit grows by one every ``limit`` calls answered under
+    ``target_latency`` and shrinks by ``backoff`` when a call is slower or
+    fails (AIMD), so a slow Redsys leaves a small, bounded backlog. Calls
+    that were already in flight at a decrease do not decrease it again.
+    """
+
+    def __init__(
+        self,
+        *,
+        enabled: bool = False,
+        initial_limit: int = 50,
+        min_limit: int = 5,
+        max_limit: int = 500,
+        target_latency: float = 2.0,
+        backoff: float = 0.9,
+        alpha: float = 0.2,
+        max_retry_after: int = 30,
+    ) -> None:
+        self.enabled = enabled
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.alpha = alpha
+        self.max_retry_after = max_retry_after
+        self._operations: Dict[str, OperationLimit] = {}
+
+    def _get(self, operation: str) -> OperationLimit:
+        if operation not in self._operations:
+            self._operations[operation] = OperationLimit(self.initial_limit)
+        return self._operations[operation]
+
+    def _retry_after(self, state: OperationLimit) -> int:
+        # roughly the time for the calls in flight to drain
+        latency = state.latency or self.target_latency
+        return max(1, min(self.max_retry_after, math.ceil(latency)))
+
+    def _completed(
+        self, state: OperationLimit, started: float, latency: float, ok: bool
+    ) -> None:
+        state.latency = (
+            latency
+            if state.latency is None
+            else self.alpha * latency + (1 - self.alpha) * state.latency
+        )
+        if ok and latency <= self.target_latency:
+            state.limit = min(self.max_limit, state.limit + 1 / state.limit)
+        elif started >= state.decreased_at:
+            # one decrease per burst of slow calls, not one per call
+            state.limit = max(self.min_limit, state.limit * self.backoff)
+            state.decreased_at = started + latency
+
+    @asynccontextmanager
+    async def admit(self, operation: str) -> AsyncIterator[None]:
+        if not self.enabled:
+            yield
+            return
+        state = self._get(operation)
+        if state.in_flight >= int(state.limit):
+            state.rejected += 1
+            raise AdmissionRejected(operation, self._retry_after(state))
+        state.in_flight += 1
+        state.admitted += 1
+        started = time.monotonic()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            state.in_flight -= 1
+            self._completed(state, started, time.monotonic() - started, ok)
+
+    def status(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "operations": {
+                name: state.status() for name, state in self._operations.items()
+            },
+        }
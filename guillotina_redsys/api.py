@@ -5,7 +5,130 @@ from guillotina.component import get_utility
 from guillotina.contrib.redis import get_driver
 from guillotina.interfaces import IContainer
 from guillotina.interfaces import IResource
+from guillotina.response import HTTPBadRequest
+from guillotina.response import HTTPConflict
+from guillotina.response import HTTPNotFound
+from guillotina.response import HTTPServiceUnavailable
+from guillotina.response import Response
+from guillotina.utils import execute
+from guillotina_redsys import keys
+from guillotina_redsys import metrics
+from guillotina_redsys.admission import AdmissionRejected
+from guillotina_redsys.billing import BillingRunExists
+from guillotina_redsys.checkout import CheckoutSessionNotFound
 from guillotina_redsys.interfaces import IRedsysUtility
+from guillotina_redsys.profiling import profiler
+from guillotina_redsys.push import FINAL_EVENT_TYPES
+from guillotina_redsys.resources import resources
+from guillotina_redsys.schemas import BILLING_RUN_ID
+from guillotina_redsys.schemas import ORDER_PATH_PARAMETERS
+from guillotina_redsys.schemas import request_body
+from guillotina_redsys.schemas import SESSION_TOKEN
+from guillotina_redsys.schemas import TRANSACTION_ID
+
+import asyncio
+import hmac
+import jsonschema
+
+
+def _validation_error(error, location, name=None):
+    # never echo the rejected value, it can be card data
+    if error.validator == "required":
+        message = error.message
+    else:
+        message = f"Invalid value ({error.validator})"
+    return {
+        "in": location,
+        "path": [name] if name else list(error.absolute_path),
+        "validator": error.validator,
+        "message": message,
+    }
+
+
+class RedsysService(Service):
+    """
+    Validates path and query parameters and the JSON body against the
+    schemas declared in ``configure.service`` before the service runs.
+    Validators are compiled once per service. Every error is returned in a
+    single 400 response; the parsed body is left in ``self.payload``.
+    Calls rejected by the admission control or the rate limiter get a 503
+    with Retry-After, and unknown or expired checkout sessions a 404.
+    """
+
+    payload = None
+
+    @classmethod
+    def _parameter_validators(cls):
+        if "_parameters" not in cls.__dict__:
+            cls._parameters = [
+                (
+                    parameter["in"],
+                    parameter["name"],
+                    parameter.get("required", False),
+                    parameter["schema"].get("type"),
+                    jsonschema.validators.validator_for(parameter["schema"])(
+                        parameter["schema"]
+                    ),
+                )
+                for parameter in cls.__config__.get("parameters", [])
+                if parameter["in"] in ("path", "query") and "schema" in parameter
+            ]
+        return cls._parameters
+
+    def _parameter_errors(self):
+        errors = []
+        for location, name, required, type_, validator in self._parameter_validators():
+            values = (
+                self.request.matchdict if location == "path" else self.request.query
+            )
+            if name not in values:
+                if required:
+                    errors.append(
+                        {
+                            "in": location,
+                            "path": [name],
+                            "validator": "required",
+                            "message": f"'{name}' is a required parameter",
+                        }
+                    )
+                continue
+            value = values[name]
+            if type_ in ("integer", "number"):
+                try:
+                    value = int(value) if type_ == "integer" else float(value)
+                except ValueError:
+                    pass
+            errors.extend(
+                _validation_error(error, location, name)
+                for error in validator.iter_errors(value)
+            )
+        return errors
+
+    async def _call_validate(self):
+        errors = self._parameter_errors()
+        _, validator, _ = self.__class__._get_validator()
+        if hasattr(validator, "iter_errors"):
+            try:
+                self.payload = await self.request.json()
+            except ValueError:
+                raise HTTPBadRequest(content={"reason": "Invalid json payload"})
+            errors.extend(
+                _validation_error(error, "body")
+                for error in validator.iter_errors(self.payload)
+            )
+        if errors:
+            raise HTTPBadRequest(
+                content={"reason": "Request validation error", "errors": errors}
+            )
+        try:
+            return await self._call_original()
+        except AdmissionRejected as e:
+            raise HTTPServiceUnavailable(
+                content={"reason": "Redsys overloaded", "operation": e.operation},
+                headers={"Retry-After": str(e.retry_after)},
+            )
+        except CheckoutSessionNotFound as e:
+            raise HTTPNotFound(content={"reason": str(e)})
 
 
 @configure.service(
@@ -14,12 +137,15 @@ from guillotina_redsys.interfaces import IRedsysUtility
     permission="redsys.PerformTransaction",
     name="@initTransactionRedsys",
     summary="Starts a transaction",
+    requestBody=request_body("RedsysInitTransaction"),
+    validate=True,
     responses={"200": {"description": "Post", "schema": {"properties": {}}}},
 )
-class initTransactionRedsys(Service):
+class initTransactionRedsys(RedsysService):
+    @profiler("initTransactionRedsys")
     async def __call__(self):
         utility = get_utility(IRedsysUtility)
-        payload = await self.request.json()
+        payload = self.payload
         amount = Decimal(payload["amount"])
         card = payload["card"]
         expiry_date = payload["expiry_date"]
@@ -31,22 +157,74 @@ class initTransactionRedsys(Service):
             expiry_date=expiry_date,
             cvv=cvv,
             order=order,
+            store_card=payload.get("store_card", False),
         )
         return res.dict()
 
 
+@configure.service(
+    context=IResource,
+    method="GET",
+    permission="redsys.PerformTransaction",
+    name="@redsysBinHints",
+    summary="Cached 3DS metadata of a BIN range, to prefetch the 3DS method",
+    parameters=[
+        {
+            "name": "bin",
+            "in": "query",
+            "required": True,
+            "schema": {"type": "string", "pattern": r"^\d+$"},
+        }
+    ],
+    validate=True,
+    responses={"200": {"description": "Get", "schema": {"properties": {}}}},
+)
+class GetRedsysBinHints(RedsysService):
+    async def __call__(self):
+        utility = get_utility(IRedsysUtility)
+        bin_range = self.request.query["bin"]
+        if len(bin_range) != utility.bins.bin_length:
+            # ranges are cached by their first bin_length digits only
+            raise HTTPBadRequest(
+                content={
+                    "reason": "Request validation error",
+                    "errors": [
+                        {
+                            "in": "query",
+                            "path": ["bin"],
+                            "validator": "bin_length",
+                            "message": f"Expected {utility.bins.bin_length} digits",
+                        }
+                    ],
+                }
+            )
+        info = utility.bin_hints(bin_range)
+        if info is None:
+            return {
+                "protocolVersion": None,
+                "threeDSMethodURL": None,
+                "preconnect": None,
+            }
+        headers = {}
+        if info.acs_origin:
+            headers["Link"] = f"<{info.acs_origin}>; rel=preconnect"
+        return Response(content=info.hints(), headers=headers)
+
+
 @configure.service(
     context=IResource,
     method="POST",
     permission="redsys.PerformTransaction",
     name="@initThreeDS",
     summary="Starts a transaction",
+    requestBody=request_body("RedsysInitThreeDS"),
+    validate=True,
     responses={"200": {"description": "Post", "schema": {"properties": {}}}},
 )
-class initThreeDS(Service):
+class initThreeDS(RedsysService):
     async def __call__(self):
         utility = get_utility(IRedsysUtility)
-        payload = await self.request.json()
+        payload = self.payload
         transaction_id = payload["transaction_id"]
         three_method_url = payload["three_method_url"]
         res_3ds = await utility.init_threeds_method(
@@ -61,13 +239,25 @@ class initThreeDS(Service):
     permission="redsys.PerformTransaction",
     name="@initTrataPeticion",
     summary="Starts a transaction",
+    requestBody=request_body("RedsysTrataPeticion"),
+    validate=True,
     responses={"200": {"description": "Post", "schema": {"properties": {}}}},
 )
-class initTrataPeticion(Service):
+class initTrataPeticion(RedsysService):
+    @profiler("initTrataPeticion")
     async def __call__(self):
         utility = get_utility(IRedsysUtility)
-        payload = await self.request.json()
+        payload = self.payload
         transaction_id = payload["transaction_id"]
+        if "session_token" in payload:
+            res_3ds_trata = await utility.init_trata_peticion_session(
+                session_token=payload["session_token"],
+                protocol_version=payload["protocol_version"],
+                transaction_id=transaction_id,
+                three_ds_comp_ind=payload["three_ds_comp_ind"],
+                order=payload.get("order_id"),
+            )
+            return res_3ds_trata.dict()
         amount = payload["amount"]
         card = payload["card"]
         expiry_date = payload["expiry_date"]
@@ -85,10 +275,36 @@ class initTrataPeticion(Service):
             protocol_version=protocol,
             transaction_id=transaction_id,
             three_ds_comp_ind=three_ds_comp_ind,
+            store_card=payload.get("store_card", False),
         )
         return res_3ds_trata.dict()
 
 
+@configure.service(
+    context=IResource,
+    method="POST",
+    permission="redsys.PerformTransaction",
+    name="@tokenPaymentRedsys",
+    summary="Charges a card stored on Redsys (card on file)",
+    requestBody=request_body("RedsysTokenPayment"),
+    validate=True,
+    responses={"200": {"description": "Post", "schema": {"properties": {}}}},
+)
+class tokenPaymentRedsys(RedsysService):
+    async def __call__(self):
+        utility = get_utility(IRedsysUtility)
+        payload = self.payload
+        res = await utility.token_payment(
+            amount=Decimal(payload["amount"]),
+            identifier=payload["identifier"],
+            order=payload["order_id"],
+            cof_type=payload.get("cof_type", "R"),
+            cof_txnid=payload.get("cof_txnid"),
+            currency=payload.get("currency", 978),
+        )
+        return res.dict()
+
+
 EXPIRATION_15_MIN = 60 * 15
 EXPIRATION_30_MIN = 60 * 30
 
@@ -99,21 +315,29 @@ EXPIRATION_30_MIN = 60 * 30
     permission="redsys.Public",
     name="@notificationRedsys3DS/{order_id}/{three_dss_trans_id}",
     summary="Starts a transaction",
+    parameters=ORDER_PATH_PARAMETERS,
+    requestBody=request_body("RedsysNotification3DS"),
+    validate=True,
     responses={"200": {"description": "Post", "schema": {"properties": {}}}},
 )
-class RedsysNotification3DS(Service):
+class RedsysNotification3DS(RedsysService):
+    @profiler("notificationRedsys3DS")
     async def __call__(self):
         # Save the result of the 3DS notification taking into account
         # order_id, and transaction_id
         order_id = self.request.matchdict["order_id"]
         trans_id = self.request.matchdict["three_dss_trans_id"]
-        payload = await self.request.json()
+        payload = self.payload
         result = payload.get("threeDSCompInd", "N")
         redis_driver = await get_driver()
-        key_redis = f"notification_3DS:{order_id}:{trans_id}"
+        key_redis = keys.notification_3ds(order_id, trans_id)
         await redis_driver.set(
             key=key_redis, data=result.encode("utf-8"), expire=EXPIRATION_15_MIN
         )
+        utility = get_utility(IRedsysUtility)
+        await utility.emit_event(
+            "threeds_completed", order_id, trans_id, threeDSCompInd=result
+        )
 
 
 @configure.service(
@@ -122,16 +346,23 @@ class RedsysNotification3DS(Service):
     permission="redsys.Public",
     name="@getnotificationRedsys3DS/{order_id}/{three_dss_trans_id}",
     summary="Starts a transaction",
+    parameters=ORDER_PATH_PARAMETERS,
+    validate=True,
     responses={"200": {"description": "Post", "schema": {"properties": {}}}},
 )
-class GetRedsysNotification3DS(Service):
+class GetRedsysNotification3DS(RedsysService):
+    @profiler("getnotificationRedsys3DS")
     async def __call__(self):
         # get the result of the 3DS notification via redis
         order_id = self.request.matchdict["order_id"]
         trans_id = self.request.matchdict["three_dss_trans_id"]
-        redis_driver = await get_driver()
-        key_redis = f"notification_3DS:{order_id}:{trans_id}"
-        result = await redis_driver.get(key_redis) or "N".encode("utf-8")
+        utility = get_utility(IRedsysUtility)
+        key_redis = keys.notification_3ds(order_id, trans_id)
+        result = (
+            await utility.reads.get(key_redis)
+            or await utility.reads.get(keys.legacy_notification_3ds(order_id, trans_id))
+            or "N".encode("utf-8")
+        )
         return {"threeDSCompInd": result.decode("utf-8")}
 
 
@@ -141,21 +372,28 @@ class GetRedsysNotification3DS(Service):
     permission="redsys.Public",
     name="@notificationRedsysChallenge/{order_id}/{three_dss_trans_id}",
     summary="Starts a transaction",
+    parameters=ORDER_PATH_PARAMETERS,
+    requestBody=request_body("RedsysNotificationChallenge"),
+    validate=True,
     responses={"200": {"description": "Post", "schema": {"properties": {}}}},
 )
-class RedsysNotificationChallenge(Service):
+class RedsysNotificationChallenge(RedsysService):
+    @profiler("notificationRedsysChallenge")
     async def __call__(self):
         # Save the result of the 3DS notification taking into account
         # order_id, and transaction_id
         order_id = self.request.matchdict["order_id"]
         trans_id = self.request.matchdict["three_dss_trans_id"]
-        payload = await self.request.json()
+        payload = self.payload
         result = payload.get("CRES", "")
         redis_driver = await get_driver()
-        key_redis = f"notification_CRES:{order_id}:{trans_id}"
+        key_redis = keys.notification_cres(order_id, trans_id)
         await redis_driver.set(
             key=key_redis, data=result.encode("utf-8"), expire=EXPIRATION_30_MIN
         )
+        utility = get_utility(IRedsysUtility)
+        if utility.auto_complete_challenge and result:
+            execute.after_request(utility.complete_challenge, order_id, trans_id)
 
 
 @configure.service(
@@ -164,33 +402,448 @@ class RedsysNotificationChallenge(Service):
     permission="redsys.Public",
     name="@performNotificationRedsysChallenge/{order_id}/{three_dss_trans_id}",
     summary="Starts a transaction",
+    parameters=ORDER_PATH_PARAMETERS,
+    requestBody=request_body("RedsysChallengeResponse"),
+    validate=True,
     responses={"200": {"description": "Post", "schema": {"properties": {}}}},
 )
-class GetRedsysNotificationChallenge(Service):
+class GetRedsysNotificationChallenge(RedsysService):
+    @profiler("performNotificationRedsysChallenge")
     async def __call__(self):
-        payload = await self.request.json()
-        amount = payload["amount"]
-        card = payload["card"]
-        expiry_date = payload["expiry_date"]
-        cvv = payload["cvv"]
+        payload = self.payload
         protocol = payload["protocol_version"]
-        currency = payload.get("currency", 978)
         order_id = self.request.matchdict["order_id"]
         trans_id = self.request.matchdict["three_dss_trans_id"]
-        redis_driver = await get_driver()
-        key_redis = f"notification_CRES:{order_id}:{trans_id}"
-        result = await redis_driver.get(key=key_redis)
-        if result is None:
-            return None
         utility = get_utility(IRedsysUtility)
-        res = await utility.authenticate_cres(
-            amount=Decimal(amount),
-            card=card,
-            cvv=cvv,
-            expiry_date=expiry_date,
-            protocol_version=protocol,
+
+        async def authenticate(cres):
+            if "session_token" in payload:
+                return await utility.authenticate_cres_session(
+                    session_token=payload["session_token"],
+                    protocol_version=protocol,
+                    cres=cres,
+                    order=order_id,
+                )
+            return await utility.authenticate_cres(
+                amount=Decimal(payload["amount"]),
+                card=payload["card"],
+                cvv=payload["cvv"],
+                expiry_date=payload["expiry_date"],
+                protocol_version=protocol,
+                order=order_id,
+                currency=payload.get("currency", 978),
+                cres=cres,
+                store_card=payload.get("store_card", False),
+            )
+
+        # the CRES is sent to Redsys once, other calls get the stored result
+        return await utility.authenticate_challenge_once(
+            order_id, trans_id, authenticate
+        )
+
+
+@configure.service(
+    context=IContainer,
+    method="GET",
+    permission="redsys.Public",
+    name="@getResultRedsysChallenge/{order_id}/{three_dss_trans_id}",
+    summary="Final result of a challenge completed on the server",
+    parameters=ORDER_PATH_PARAMETERS,
+    validate=True,
+    responses={"200": {"description": "Get", "schema": {"properties": {}}}},
+)
+class GetRedsysChallengeResult(RedsysService):
+    @profiler("getResultRedsysChallenge")
+    async def __call__(self):
+        utility = get_utility(IRedsysUtility)
+        result = await utility.get_challenge_result(
+            self.request.matchdict["order_id"],
+            self.request.matchdict["three_dss_trans_id"],
+        )
+        if result is not None:
+            # the card on file token is for the merchant backend only
+            result.pop("Ds_Merchant_Identifier", None)
+        return result
+
+
+@configure.service(
+    context=IContainer,
+    method="GET",
+    permission="redsys.Public",
+    name="@streamRedsysOrder/{order_id}",
+    summary="Server-Sent Events stream with the state transitions of an order",
+    parameters=ORDER_PATH_PARAMETERS[:1]
+    + [
+        {"name": "transaction_id", "in": "query", "schema": TRANSACTION_ID},
+        {"name": "session_token", "in": "query", "schema": SESSION_TOKEN},
+    ],
+    validate=True,
+    responses={"200": {"description": "text/event-stream"}},
+)
+class StreamRedsysOrder(RedsysService):
+    async def __call__(self):
+        utility = get_utility(IRedsysUtility)
+        if not utility.push.enabled:
+            raise HTTPNotFound(content={"reason": "Push delivery is not enabled"})
+        order_id = self.request.matchdict["order_id"]
+        await self._check_owner(utility, order_id)
+        resp = Response(
+            status=200,
+            headers={
+                "Content-Type": "text/event-stream",
+                "Cache-Control": "no-cache",
+                "X-Accel-Buffering": "no",
+            },
+        )
+        await resp.prepare(self.request)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + utility.push.max_stream_time
+        async with utility.push.subscribe(order_id) as queue:
+            event = await utility.push.last_event(order_id)
+            while event is None or event.type not in FINAL_EVENT_TYPES:
+                if event is not None:
+                    await resp.write(_sse(event))
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    # the client reconnects if the flow is still running
+                    await resp.write(eof=True)
+                    return resp
+                try:
+                    event = await asyncio.wait_for(
+                        queue.get(), timeout=min(utility.push.keepalive, remaining)
+                    )
+                except asyncio.TimeoutError:
+                    # a final event the subscription missed is in the order state
+                    event = await utility.push.last_event(order_id)
+                    if event is None or event.type not in FINAL_EVENT_TYPES:
+                        event = None
+                        await resp.write(b": keepalive\n\n")
+            await resp.write(_sse(event), eof=True)
+        return resp
+
+    async def _check_owner(self, utility, order_id):
+        # order ids are guessable: the caller proves it runs the flow with
+        # the checkout session or the 3DS server transaction id
+        session_token = self.request.query.get("session_token")
+        transaction_id = self.request.query.get("transaction_id")
+        if session_token is not None:
+            await utility.checkout.get(session_token, order_id)
+        elif transaction_id is not None:
+            event = await utility.push.last_event(order_id)
+            if event is None or not hmac.compare_digest(
+                event.transaction_id or "", transaction_id
+            ):
+                raise HTTPNotFound(content={"reason": "Unknown order"})
+        else:
+            raise HTTPBadRequest(
+                content={
+                    "reason": "Request validation error",
+                    "errors": [
+                        {
+                            "in": "query",
+                            "path": ["transaction_id"],
+                            "validator": "required",
+                            "message": "transaction_id or session_token is required",
+                        }
+                    ],
+                }
+            )
+
+
+def _sse(event) -> bytes:
+    return f"event: {event.type}\ndata: {event.to_json()}\n\n".encode("utf-8")
+
+
+@configure.service(
+    context=IContainer,
+    method="POST",
+    permission="redsys.Manage",
+    name="@schedulePreauthConfirmationRedsys",
+    summary="Schedules the confirmation of a preauthorization",
+    requestBody=request_body("RedsysSchedulePreauth"),
+    validate=True,
+    responses={"200": {"description": "Post", "schema": {"properties": {}}}},
+)
+class SchedulePreauthConfirmation(RedsysService):
+    async def __call__(self):
+        utility = get_utility(IRedsysUtility)
+        payload = self.payload
+        order_id = payload["order_id"]
+        await utility.preauth_scheduler.schedule(
             order=order_id,
-            currency=currency,
-            cres=result.decode("utf-8"),
+            amount=Decimal(payload["amount"]),
+            due_at=float(payload["due_at"]),
+            expires_at=float(payload["expires_at"]),
+            currency=payload.get("currency", 978),
         )
-        return res.dict()
+        return await utility.preauth_scheduler.get_state(order_id)
+
+
+@configure.service(
+    context=IContainer,
+    method="GET",
+    permission="redsys.Manage",
+    name="@preauthStatusRedsys/{order_id}",
+    summary="State of a scheduled preauthorization confirmation",
+    parameters=ORDER_PATH_PARAMETERS[:1],
+    validate=True,
+    responses={"200": {"description": "Get", "schema": {"properties": {}}}},
+)
+class GetPreauthStatus(RedsysService):
+    async def __call__(self):
+        utility = get_utility(IRedsysUtility)
+        order_id = self.request.matchdict["order_id"]
+        state = await utility.preauth_scheduler.get_state(order_id)
+        if state is None:
+            raise HTTPNotFound(content={"reason": "Preauthorization not scheduled"})
+        return state
+
+
+@configure.service(
+    context=IContainer,
+    method="GET",
+    permission="redsys.Manage",
+    name="@redsysProfile",
+    summary="Aggregated profile of the sampled redsys services",
+    parameters=[
+        {"name": "name", "in": "query", "schema": {"type": "string"}},
+        {"name": "sort", "in": "query", "schema": {"type": "string"}},
+        {"name": "limit", "in": "query", "schema": {"type": "integer"}},
+        {"name": "format", "in": "query", "schema": {"type": "string"}},
+    ],
+    validate=True,
+    responses={"200": {"description": "Get", "schema": {"properties": {}}}},
+)
+class GetRedsysProfile(RedsysService):
+    async def __call__(self):
+        name = self.request.query.get("name")
+        if self.request.query.get("format") == "pstats":
+            return Response(
+                body=profiler.dump(name),
+                content_type="application/octet-stream",
+                headers={"Content-Disposition": 'attachment; filename="redsys.pstats"'},
+            )
+        return {
+            "enabled": profiler.enabled,
+            "sample_rate": profiler.sample_rate,
+            "started_at": profiler.started_at,
+            "samples": profiler.names(),
+            "report": profiler.report(
+                name,
+                sort=self.request.query.get("sort", "cumulative"),
+                limit=int(self.request.query.get("limit", 50)),
+            ),
+        }
+
+
+@configure.service(
+    context=IContainer,
+    method="DELETE",
+    permission="redsys.Manage",
+    name="@redsysProfile",
+    summary="Discards the aggregated profiles",
+    responses={"200": {"description": "Delete", "schema": {"properties": {}}}},
+)
+class ResetRedsysProfile(Service):
+    async def __call__(self):
+        profiler.reset()
+
+
+@configure.service(
+    context=IContainer,
+    method="GET",
+    permission="redsys.Manage",
+    name="@redsysAudit/{order_id}",
+    summary="Masked Redsys requests and responses of an order",
+    parameters=ORDER_PATH_PARAMETERS[:1],
+    validate=True,
+    responses={"200": {"description": "Get", "schema": {"properties": {}}}},
+)
+class GetRedsysAudit(RedsysService):
+    async def __call__(self):
+        utility = get_utility(IRedsysUtility)
+        order_id = self.request.matchdict["order_id"]
+        return {
+            "order": order_id,
+            "records": await utility.audit.query(order_id),
+        }
+
+
+@configure.service(
+    context=IContainer,
+    method="GET",
+    permission="redsys.Manage",
+    name="@redsysEndpoints",
+    summary="Health, latency and active state of the Redsys endpoints",
+    responses={"200": {"description": "Get", "schema": {"properties": {}}}},
+)
+class GetRedsysEndpoints(Service):
+    async def __call__(self):
+        utility = get_utility(IRedsysUtility)
+        return utility.endpoints.status()
+
+
+@configure.service(
+    context=IContainer,
+    method="GET",
+    permission="redsys.Manage",
+    name="@redsysResources",
+    summary="Open sessions, sockets, tasks and calls in flight of this worker",
+    responses={"200": {"description": "Get", "schema": {"properties": {}}}},
+)
+class GetRedsysResources(Service):
+    async def __call__(self):
+        return resources.status()
+
+
+@configure.service(
+    context=IContainer,
+    method="POST",
+    permission="redsys.Manage",
+    name="@redsysResources",
+    summary="Takes a tracemalloc snapshot, compared to the previous one",
+    parameters=[
+        {
+            "name": "frames",
+            "in": "query",
+            "schema": {"type": "integer", "minimum": 1, "maximum": 100},
+        },
+        {
+            "name": "limit",
+            "in": "query",
+            "schema": {"type": "integer", "minimum": 1, "maximum": 1000},
+        },
+    ],
+    validate=True,
+    responses={"200": {"description": "Post", "schema": {"properties": {}}}},
+)
+class SnapshotRedsysResources(RedsysService):
+    async def __call__(self):
+        return resources.snapshot(
+            frames=int(self.request.query.get("frames", 1)),
+            limit=int(self.request.query.get("limit", 20)),
+        )
+
+
+@configure.service(
+    context=IContainer,
+    method="DELETE",
+    permission="redsys.Manage",
+    name="@redsysResources",
+    summary="Stops tracemalloc and discards the snapshots",
+    responses={"200": {"description": "Delete", "schema": {"properties": {}}}},
+)
+class StopRedsysResources(Service):
+    async def __call__(self):
+        resources.stop_tracing()
+        return resources.status()
+
+
+@configure.service(
+    context=IContainer,
+    method="GET",
+    permission="redsys.Manage",
+    name="@redsysInFlight",
+    summary="3DS flows in progress, by deadline",
+    parameters=[
+        {"name": "offset", "in": "query", "schema": {"type": "integer", "minimum": 0}},
+        {
+            "name": "limit",
+            "in": "query",
+            "schema": {"type": "integer", "minimum": 1, "maximum": 1000},
+        },
+    ],
+    validate=True,
+    responses={"200": {"description": "Get", "schema": {"properties": {}}}},
+)
+class GetRedsysInFlight(RedsysService):
+    async def __call__(self):
+        utility = get_utility(IRedsysUtility)
+        return await utility.sweeper.list_inflight(
+            offset=int(self.request.query.get("offset", 0)),
+            limit=int(self.request.query.get("limit", 100)),
+        )
+
+
+@configure.service(
+    context=IContainer,
+    method="POST",
+    permission="redsys.Manage",
+    name="@redsysBillingRuns",
+    summary="Creates a recurring billing run of stored card charges",
+    requestBody=request_body("RedsysBillingRun"),
+    validate=True,
+    responses={"200": {"description": "Post", "schema": {"properties": {}}}},
+)
+class CreateBillingRun(RedsysService):
+    async def __call__(self):
+        utility = get_utility(IRedsysUtility)
+        try:
+            run_id = await utility.billing.create(
+                self.payload["charges"], run_id=self.payload.get("run_id")
+            )
+        except BillingRunExists as e:
+            raise HTTPConflict(content={"reason": str(e)})
+        return dict(await utility.billing.get_run(run_id), run_id=run_id)
+
+
+@configure.service(
+    context=IContainer,
+    method="GET",
+    permission="redsys.Manage",
+    name="@redsysBillingRuns/{run_id}",
+    summary="Progress and results of a billing run",
+    parameters=[
+        {"name": "run_id", "in": "path", "required": True, "schema": BILLING_RUN_ID}
+    ],
+    validate=True,
+    responses={"200": {"description": "Get", "schema": {"properties": {}}}},
+)
+class GetBillingRun(RedsysService):
+    async def __call__(self):
+        utility = get_utility(IRedsysUtility)
+        run = await utility.billing.get_run(self.request.matchdict["run_id"])
+        if run is None:
+            raise HTTPNotFound(content={"reason": "Billing run not found"})
+        return run
+
+
+@configure.service(
+    context=IContainer,
+    method="GET",
+    permission="redsys.Manage",
+    name="@redsysAdmission",
+    summary="Adaptive concurrency limits and load per Redsys operation",
+    responses={"200": {"description": "Get", "schema": {"properties": {}}}},
+)
+class GetRedsysAdmission(Service):
+    async def __call__(self):
+        utility = get_utility(IRedsysUtility)
+        return utility.admission.status()
+
+
+@configure.service(
+    context=IContainer,
+    method="GET",
+    permission="redsys.Manage",
+    name="@redsysMetrics",
+    summary="Metrics of this worker",
+    responses={"200": {"description": "Get", "schema": {"properties": {}}}},
+)
+class GetRedsysMetrics(Service):
+    async def __call__(self):
+        return metrics.status()
+
+
+@configure.service(
+    context=IContainer,
+    method="GET",
+    permission="redsys.Manage",
+    name="@redsysAcsHosts",
+    summary="Warm ACS hosts of this worker with their latency",
+    responses={"200": {"description": "Get", "schema": {"properties": {}}}},
+)
+class GetRedsysAcsHosts(Service):
+    async def __call__(self):
+        utility = get_utility(IRedsysUtility)
+        return utility.acs.status()
@@ -0,0 +1,161 @@
+from guillotina.contrib.redis import get_driver
+from guillotina_redsys import keys
+from guillotina_redsys.utils import mask_card_data
+from pydantic import BaseModel
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import asyncio
+import json
+import logging
+import time
+import zlib
+
+
+logger = logging.getLogger("guillotina_redsys")
+
+
+class AuditRecorder:
+    """
+    Ring buffer of the Redsys traffic for dispute debugging.
+
+    ``record`` only enqueues, so the request path pays no I/O. A background
+    writer masks card data, compresses the records in a thread and appends
+    them to a Redis Stream capped at ``maxlen`` entries. A short per order
+    index of entry ids makes lookups by order cheap. When the queue is full
+    records are dropped (and counted) rather than slowing payments down.
+    ``close`` waits up to ``close_timeout`` seconds for the queued records
+    to be written.
+    """
+
+    def __init__(
+        self,
+        *,
+        enabled: bool = False,
+        maxlen: int = 100_000,
+        queue_size: int = 10_000,
+        batch_size: int = 100,
+        index_size: int = 50,
+        index_ttl: int = 60 * 60 * 24 * 7,
+        stream: Optional[str] = None,
+        close_timeout: float = 5.0,
+    ) -> None:
+        self.enabled = enabled
+        self.maxlen = maxlen
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.index_size = index_size
+        self.index_ttl = index_ttl
+        self.stream = stream or keys.audit_stream()
+        self.close_timeout = close_timeout
+        self.dropped = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def record(
+        self,
+        operation: str,
+        order: str,
+        request: Dict[str, Any],
+        response: Any,
+        duration: float,
+        error: Optional[str] = None,
+    ) -> None:
+        if not self.enabled:
+            return
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue(maxsize=self.queue_size)
+            self._task = asyncio.create_task(self._writer())
+        try:
+            self._queue.put_nowait(
+                (time.time(), operation, order, request, response, duration, error)
+            )
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    @staticmethod
+    def _encode(entries) -> List[Tuple[str, bytes]]:
+        encoded = []
+        for timestamp, operation, order, request, response, duration, error in entries:
+            record = {
+                "timestamp": timestamp,
+                "operation": operation,
+                "order": order,
+                "duration": duration,
+                "request": mask_card_data(request),
+                "response": mask_card_data(
+                    response.dict() if isinstance(response, BaseModel) else response
+                ),
+                "error": error,
+            }
+            encoded.append((order, zlib.compress(json.dumps(record).encode("utf-8"))))
+        return encoded
+
+    async def _write(self, records: List[Tuple[str, bytes]]) -> None:
+        pool = (await get_driver()).pool
+        pipe = pool.pipeline(transaction=False)
+        for order, blob in records:
+            pipe.xadd(
+                self.stream,
+                {"order": order, "record": blob},
+                maxlen=self.maxlen,
+                approximate=True,
+            )
+        entry_ids = await pipe.execute()
+        pipe = pool.pipeline(transaction=False)
+        for (order, _), entry_id in zip(records, entry_ids):
+            index = keys.audit_index(order)
+            pipe.lpush(index, entry_id)
+            pipe.ltrim(index, 0, self.index_size - 1)
+            pipe.expire(index, self.index_ttl)
+        await pipe.execute()
+
+    async def _writer(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                records = await loop.run_in_executor(None, self._encode, batch)
+                await self._write(records)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.warning("Could not write redsys audit records", exc_info=True)
+                self.dropped += len(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    async def query(self, order: str) -> List[Dict[str, Any]]:
+        """
+        Audit records of an order, oldest first. Records already trimmed
+        from the ring buffer are skipped.
+        """
+        pool = (await get_driver()).pool
+        entry_ids = await pool.lrange(keys.audit_index(order), 0, -1)
+        if not entry_ids:
+            return []
+        pipe = pool.pipeline(transaction=False)
+        for entry_id in reversed(entry_ids):
+            pipe.xrange(self.stream, entry_id, entry_id)
+        records = []
+        for entries in await pipe.execute():
+            for _, fields in entries:
+                records.append(json.loads(zlib.decompress(fields[b"record"])))
+        return records
+
+    async def close(self) -> None:
+        if self._task is not None:
+            try:
+                # bounded, a Redis outage must not hold the shutdown
+                await asyncio.wait_for(self._queue.join(), self.close_timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Redsys audit records not written before close")
+                self.dropped += self._queue.qsize()
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
@@ -0,0 +1,95 @@
+from guillotina.contrib.redis import get_driver
+from guillotina_redsys import metrics
+from typing import Dict
+from typing import Optional
+from typing import Set
+
+import asyncio
+import logging
+
+
+logger = logging.getLogger("guillotina_redsys")
+
+
+class RedisReadBatcher:
+    """
+    Per worker aggregator of Redis GETs.
+
+    Reads issued within ``window`` seconds of each other are sent as one
+    pipeline (at most ``max_batch`` keys, a full batch is sent at once).
+    A pipeline and not MGET, because order keys live in different Redis
+    Cluster slots. Callers asking for a key that is already queued or in
+    flight share its result instead of reading it again.
+    """
+
+    def __init__(
+        self, *, enabled: bool = False, window: float = 0.002, max_batch: int = 100
+    ) -> None:
+        self.enabled = enabled
+        self.window = window
+        self.max_batch = max_batch
+        # queued for the next batch, and sent but not answered yet
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._batches: Set[asyncio.Task] = set()
+
+    async def get(self, key: str) -> Optional[bytes]:
+        if not self.enabled:
+            redis_driver = await get_driver()
+            return await redis_driver.get(key)
+        future = self._pending.get(key) or self._inflight.get(key)
+        if future is not None:
+            metrics.REDIS_READS.inc(result="shared")
+        else:
+            metrics.REDIS_READS.inc(result="read")
+            future = asyncio.get_event_loop().create_future()
+            self._pending[key] = future
+            if len(self._pending) >= self.max_batch:
+                self._flush()
+            elif self._timer is None:
+                self._timer = asyncio.get_event_loop().call_later(
+                    self.window, self._flush
+                )
+        # a cancelled caller must not cancel the read of the others
+        return await asyncio.shield(future)
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, {}
+        if not batch:
+            return
+        self._inflight.update(batch)
+        task = asyncio.create_task(self._read(batch))
+        self._batches.add(task)
+        task.add_done_callback(self._batches.discard)
+
+    async def _read(self, batch: Dict[str, asyncio.Future]) -> None:
+        metrics.REDIS_READ_BATCH_SIZE.observe(len(batch))
+        try:
+            redis_driver = await get_driver()
+            pipe = redis_driver.pool.pipeline(transaction=False)
+            for key in batch:
+                pipe.get(key)
+            values = await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Error reading {len(batch)} keys from redis: {e!r}")
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+                    # retrieved by the callers, if any are left
+                    future.exception()
+            return
+        finally:
+            for key in batch:
+                self._inflight.pop(key, None)
+        for future, value in zip(batch.values(), values):
+            if not future.done():
+                future.set_result(value)
+
+    async def close(self) -> None:
+        self._flush()
+        if self._batches:
+            await asyncio.gather(*self._batches, return_exceptions=True)
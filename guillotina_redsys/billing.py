@@ -0,0 +1,450 @@
+from decimal import Decimal
+from guillotina.contrib.redis import get_driver
+from guillotina_redsys import keys
+from guillotina_redsys import metrics
+from guillotina_redsys.admission import AdmissionRejected
+from guillotina_redsys.models import RedsysErrorResponse
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+import asyncio
+import json
+import logging
+import time
+import uuid
+
+
+logger = logging.getLogger("guillotina_redsys")
+
+BILLING_RUN_TTL = 60 * 60 * 24 * 30
+
+BILLING_CHARGES = metrics.Counter(
+    "redsys_billing_charges_total",
+    "Charges of billing runs by result",
+    labels=("result",),
+)
+
+# Lease the first shard whose lease (score) expired before ARGV[1]. Returns
+# the shard and its checkpoint, if any.
+_CLAIM_SHARD_SCRIPT = """
+local items = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, 1)
+if #items == 0 then
+    return false
+end
+redis.call('ZADD', KEYS[1], ARGV[2], items[1])
+redis.call('HSET', KEYS[2], items[1] .. ':owner', ARGV[3])
+local checkpoint = redis.call('HGET', KEYS[2], items[1] .. ':checkpoint')
+return {items[1], checkpoint or ''}
+"""
+
+# Store the checkpoint of shard ARGV[1] only if ARGV[2] still holds the
+# shard. A finished shard leaves the queue and its charges are deleted;
+# otherwise its lease is extended to ARGV[3].
+_CHECKPOINT_SCRIPT = """
+if redis.call('HGET', KEYS[2], ARGV[1] .. ':owner') ~= ARGV[2] then
+    return 0
+end
+redis.call('HSET', KEYS[2], ARGV[1] .. ':checkpoint', ARGV[4])
+if ARGV[5] == '1' then
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    redis.call('DEL', KEYS[4])
+    redis.call('HINCRBY', KEYS[3], 'shards_done', 1)
+else
+    redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+end
+return 1
+"""
+
+# Reserve order ARGV[3] for a charge if ARGV[2] still holds shard ARGV[1].
+# Returns -1 when the shard was lost and 0 when the order was already
+# reserved, by this or a previous holder of the shard.
+_RESERVE_CHARGE_SCRIPT = """
+if redis.call('HGET', KEYS[1], ARGV[1] .. ':owner') ~= ARGV[2] then
+    return -1
+end
+if redis.call('HSETNX', KEYS[2], ARGV[3], 'sending') == 0 then
+    return 0
+end
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+return 1
+"""
+
+# Store the result ARGV[2] of the charge of order ARGV[1] and add its
+# counters to the run, once.
+_RECORD_CHARGE_SCRIPT = """
+if redis.call('HGET', KEYS[1], ARGV[1]) ~= 'sending' then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+for i = 3, #ARGV, 2 do
+    redis.call('HINCRBY', KEYS[2], ARGV[i], ARGV[i + 1])
+end
+return 1
+"""
+
+
+class BillingRunExists(Exception):
+    def __init__(self, run_id: str) -> None:
+        super().__init__(f"Billing run {run_id} already exists")
+        self.run_id = run_id
+
+
+class ShardLost(Exception):
+    """The lease of the shard expired and another worker took it."""
+
+
+class ShardProgress:
+    """
+    Charges done in a shard: every index below ``position`` plus the ones in
+    ``done``, finished out of order by the concurrent charges.
+    """
+
+    def __init__(self, checkpoint: str = "") -> None:
+        data = json.loads(checkpoint) if checkpoint else {}
+        self.position: int = data.get("position", 0)
+        self.done: Set[int] = set(data.get("done", []))
+
+    def complete(self, idx: int) -> None:
+        self.done.add(idx)
+        while self.position in self.done:
+            self.done.remove(self.position)
+            self.position += 1
+
+    def is_done(self, idx: int) -> bool:
+        return idx < self.position or idx in self.done
+
+    def dumps(self) -> str:
+        return json.dumps({"position": self.position, "done": sorted(self.done)})
+
+
+class BillingRuns:
+    """
+    Recurring billing runs: merchant initiated charges of stored cards
+    (``token_payment``) split in shards of ``shard_size``.
+
+    Shards are leased through Redis by the workers of every node, so a run
+    scales with the number of workers. Each worker processes up to
+    ``shards_per_worker`` shards at a time, each one with ``concurrency``
+    charges in flight over the utility shared connection pool.
+
+    Every order is reserved in the run results before it is charged, and
+    its result is stored and counted once, so no order is charged twice,
+    not even by the worker that takes over a lost shard. The lease is
+    extended every third of ``lease_ttl`` and the shard progress is
+    written every ``checkpoint_every`` charges; a shard whose worker died
+    is taken again after ``lease_ttl`` seconds and resumes from its
+    checkpoint.
+    """
+
+    def __init__(
+        self,
+        utility,
+        *,
+        enabled: bool = False,
+        shard_size: int = 1000,
+        concurrency: int = 20,
+        shards_per_worker: int = 1,
+        checkpoint_every: int = 100,
+        lease_ttl: int = 60,
+        interval: float = 5.0,
+    ) -> None:
+        self.utility = utility
+        self.enabled = enabled
+        self.shard_size = shard_size
+        self.concurrency = concurrency
+        self.shards_per_worker = shards_per_worker
+        self.checkpoint_every = checkpoint_every
+        self.lease_ttl = lease_ttl
+        self.interval = interval
+        self.worker_id = uuid.uuid4().hex
+
+    async def create(
+        self, charges: Iterable[Dict[str, Any]], run_id: Optional[str] = None
+    ) -> str:
+        """
+        Store the charges (``order``, ``identifier``, ``amount`` and optional
+        ``currency`` and ``cof_txnid``) of a new run, shard by shard, then
+        write the run header and queue every shard at once, so no shard is
+        charged before the run counts it. Raises ``BillingRunExists`` if
+        ``run_id`` was already used.
+        """
+        run_id = run_id or uuid.uuid4().hex
+        pool = (await get_driver()).pool
+        pipe = pool.pipeline(transaction=True)
+        pipe.hsetnx(keys.billing_run(run_id), "created_at", str(time.time()))
+        pipe.expire(keys.billing_run(run_id), BILLING_RUN_TTL)
+        created, _ = await pipe.execute()
+        if not created:
+            raise BillingRunExists(run_id)
+        total = 0
+        shards = 0
+        shard: List[str] = []
+        for charge in charges:
+            shard.append(json.dumps(charge))
+            total += 1
+            if len(shard) == self.shard_size:
+                await self._store_shard(pool, run_id, shards, shard)
+                shards += 1
+                shard = []
+        if shard:
+            await self._store_shard(pool, run_id, shards, shard)
+            shards += 1
+        pipe = pool.pipeline(transaction=True)
+        pipe.hset(
+            keys.billing_run(run_id), mapping={"charges": total, "shards": shards}
+        )
+        # never reset the counter a checkpoint may have increased already
+        pipe.hincrby(keys.billing_run(run_id), "shards_done", 0)
+        if shards:
+            # available right away
+            pipe.zadd(
+                keys.billing_queue(run_id), {str(shard): 0 for shard in range(shards)}
+            )
+        for key in (
+            keys.billing_run(run_id),
+            keys.billing_queue(run_id),
+            keys.billing_shards(run_id),
+        ):
+            pipe.expire(key, BILLING_RUN_TTL)
+        await pipe.execute()
+        if shards:
+            await pool.sadd(keys.billing_runs(), run_id)
+        return run_id
+
+    async def _store_shard(self, pool, run_id: str, shard: int, charges: List[str]):
+        key = keys.billing_shard(run_id, shard)
+        pipe = pool.pipeline(transaction=True)
+        pipe.rpush(key, *charges)
+        pipe.expire(key, BILLING_RUN_TTL)
+        await pipe.execute()
+
+    async def get_run(self, run_id: str) -> Optional[Dict[str, Any]]:
+        pool = (await get_driver()).pool
+        run = await pool.hgetall(keys.billing_run(run_id))
+        if not run:
+            return None
+        state: Dict[str, Any] = {}
+        errors: Dict[str, int] = {}
+        for key, value in run.items():
+            key, value = key.decode("utf-8"), value.decode("utf-8")
+            if key.startswith("error:"):
+                errors[key[len("error:") :]] = int(value)
+            elif key == "created_at":
+                state[key] = float(value)
+            else:
+                state[key] = int(value)
+        state["errors"] = errors
+        if "shards" not in state:
+            # charges still being stored
+            state["status"] = "creating"
+        elif state.get("shards_done", 0) >= state["shards"]:
+            state["status"] = "finished"
+        else:
+            state["status"] = "running"
+        return state
+
+    async def _claim(self) -> Optional[Tuple[str, int, str]]:
+        pool = (await get_driver()).pool
+        for run_id in await pool.smembers(keys.billing_runs()):
+            run_id = run_id.decode("utf-8")
+            claimed = await self._claim_shard(run_id)
+            if claimed:
+                shard, checkpoint = claimed
+                return run_id, shard, checkpoint
+            if not await pool.exists(keys.billing_queue(run_id)):
+                await pool.srem(keys.billing_runs(), run_id)
+        return None
+
+    async def _claim_shard(self, run_id: str) -> Optional[Tuple[int, str]]:
+        pool = (await get_driver()).pool
+        now = time.time()
+        claimed = await pool.eval(
+            _CLAIM_SHARD_SCRIPT,
+            2,
+            keys.billing_queue(run_id),
+            keys.billing_shards(run_id),
+            now,
+            now + self.lease_ttl,
+            self.worker_id,
+        )
+        if not claimed:
+            return None
+        shard, checkpoint = claimed
+        return int(shard), checkpoint.decode("utf-8")
+
+    async def _checkpoint(
+        self, run_id: str, shard: int, checkpoint: str, done: bool = False
+    ) -> None:
+        pool = (await get_driver()).pool
+        held = await pool.eval(
+            _CHECKPOINT_SCRIPT,
+            4,
+            keys.billing_queue(run_id),
+            keys.billing_shards(run_id),
+            keys.billing_run(run_id),
+            keys.billing_shard(run_id, shard),
+            shard,
+            self.worker_id,
+            time.time() + self.lease_ttl,
+            checkpoint,
+            "1" if done else "0",
+        )
+        if not held:
+            raise ShardLost(f"Shard {shard} of billing run {run_id} lost")
+
+    async def _reserve(self, run_id: str, shard: int, order: str) -> int:
+        pool = (await get_driver()).pool
+        return await pool.eval(
+            _RESERVE_CHARGE_SCRIPT,
+            2,
+            keys.billing_shards(run_id),
+            keys.billing_results(run_id),
+            shard,
+            self.worker_id,
+            order,
+            BILLING_RUN_TTL,
+        )
+
+    async def _record(self, run_id: str, order: str, result: str, cents: int):
+        pool = (await get_driver()).pool
+        args: List[Any] = [order, result, "processed", 1, result, 1]
+        if cents:
+            args += ["authorized_cents", cents]
+        await pool.eval(
+            _RECORD_CHARGE_SCRIPT,
+            2,
+            keys.billing_results(run_id),
+            keys.billing_run(run_id),
+            *args,
+        )
+        BILLING_CHARGES.inc(result="error" if result.startswith("error:") else result)
+
+    async def _charge(self, charge: Dict[str, Any]) -> Tuple[str, int]:
+        """Returns the counter of the result and the authorized cents."""
+        amount = Decimal(str(charge["amount"]))
+        while True:
+            try:
+                res = await self.utility.token_payment(
+                    amount,
+                    charge["identifier"],
+                    charge["order"],
+                    cof_txnid=charge.get("cof_txnid"),
+                    currency=charge.get("currency", 978),
+                )
+            except AdmissionRejected as e:
+                # Redsys is saturated or the rate limit spent: wait, not fail
+                await asyncio.sleep(e.retry_after)
+                continue
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.warning(
+                    f"Error charging billing order {charge['order']}", exc_info=True
+                )
+                return "error:exception", 0
+            break
+        if isinstance(res, RedsysErrorResponse):
+            return f"error:{res.errorCode}", 0
+        if res.is_authorized:
+            return "authorized", int(amount * 100)
+        return "denied", 0
+
+    async def process_shard(
+        self, run_id: str, shard: int, checkpoint: str = ""
+    ) -> None:
+        pool = (await get_driver()).pool
+        charges = [
+            json.loads(charge)
+            for charge in await pool.lrange(keys.billing_shard(run_id, shard), 0, -1)
+        ]
+        progress = ShardProgress(checkpoint)
+        pending = iter(
+            [idx for idx in range(len(charges)) if not progress.is_done(idx)]
+        )
+        since_checkpoint = 0
+        lock = asyncio.Lock()
+        lost = asyncio.Event()
+
+        async def flush(done: bool = False) -> None:
+            nonlocal since_checkpoint
+            async with lock:
+                since_checkpoint = 0
+                try:
+                    await self._checkpoint(run_id, shard, progress.dumps(), done)
+                except ShardLost:
+                    lost.set()
+
+        async def renew_lease() -> None:
+            # charges waiting on the rate limiter must not let the lease expire
+            while not lost.is_set():
+                await asyncio.sleep(self.lease_ttl / 3)
+                await flush()
+
+        async def charge_worker() -> None:
+            nonlocal since_checkpoint
+            for idx in pending:
+                order = charges[idx]["order"]
+                reserved = await self._reserve(run_id, shard, order)
+                if reserved < 0:
+                    lost.set()
+                if lost.is_set():
+                    # charges in flight finish, no new one is taken
+                    return
+                if reserved:
+                    result, cents = await self._charge(charges[idx])
+                    await self._record(run_id, order, result, cents)
+                progress.complete(idx)
+                since_checkpoint += 1
+                if since_checkpoint >= self.checkpoint_every:
+                    await flush()
+
+        renewal = asyncio.create_task(renew_lease())
+        workers = [
+            asyncio.create_task(charge_worker()) for _ in range(self.concurrency)
+        ]
+        try:
+            await asyncio.gather(*workers)
+        except BaseException:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            raise
+        finally:
+            renewal.cancel()
+            await asyncio.gather(renewal, return_exceptions=True)
+        if not lost.is_set():
+            await flush(done=True)
+        if lost.is_set():
+            raise ShardLost(f"Shard {shard} of billing run {run_id} lost")
+
+    async def run_once(self) -> bool:
+        """Process one shard of any run. Returns False when none was due."""
+        claimed = await self._claim()
+        if claimed is None:
+            return False
+        run_id, shard, checkpoint = claimed
+        try:
+            await self.process_shard(run_id, shard, checkpoint)
+        except ShardLost:
+            logger.warning(f"Shard {shard} of billing run {run_id} lost")
+        return True
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                processed = await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.error("Error running billing shard", exc_info=True)
+                processed = False
+            if not processed:
+                await asyncio.sleep(self.interval)
+
+    async def run(self) -> None:
+        await asyncio.gather(*[self._loop() for _ in range(self.shards_per_worker)])
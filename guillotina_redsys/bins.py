@@ -0,0 +1,92 @@
+from collections import OrderedDict
+from guillotina_redsys import metrics
+from typing import Dict
+from typing import Optional
+from yarl import URL
+
+import time
+
+
+BIN_CACHE_LOOKUPS = metrics.Counter(
+    "redsys_bin_cache_lookups_total",
+    "Lookups of 3DS metadata by BIN range, by result",
+    labels=("result",),
+)
+
+
+class BinInfo:
+    __slots__ = ("protocol_version", "method_url", "expires")
+
+    def __init__(
+        self, protocol_version: Optional[str], method_url: Optional[str], expires: float
+    ) -> None:
+        self.protocol_version = protocol_version
+        self.method_url = method_url
+        self.expires = expires
+
+    @property
+    def acs_origin(self) -> Optional[str]:
+        if not self.method_url:
+            return None
+        return str(URL(self.method_url).origin())
+
+    def hints(self) -> Dict[str, Optional[str]]:
+        return {
+            "protocolVersion": self.protocol_version,
+            "threeDSMethodURL": self.method_url,
+            "preconnect": self.acs_origin,
+        }
+
+
+class BinCache:
+    """
+    3DS metadata (protocol version and 3DS method URL) that Redsys returned
+    in ``iniciaPeticion``, by BIN range: the first ``bin_length`` digits of
+    the card. Entries live ``ttl`` seconds and at most ``max_size`` ranges
+    are kept per worker, the least recently used one is dropped first.
+    """
+
+    def __init__(
+        self,
+        *,
+        enabled: bool = False,
+        bin_length: int = 8,
+        ttl: float = 60 * 60 * 24,
+        max_size: int = 10000,
+        preconnect: bool = True,
+    ) -> None:
+        self.enabled = enabled
+        self.bin_length = bin_length
+        self.ttl = ttl
+        self.max_size = max_size
+        self.preconnect = preconnect
+        # least recently used first
+        self._entries: "OrderedDict[str, BinInfo]" = OrderedDict()
+
+    def get(self, card: str) -> Optional[BinInfo]:
+        if not self.enabled or len(card) < self.bin_length:
+            return None
+        bin_range = card[: self.bin_length]
+        info = self._entries.get(bin_range)
+        if info is not None and info.expires < time.monotonic():
+            del self._entries[bin_range]
+            info = None
+        if info is None:
+            BIN_CACHE_LOOKUPS.inc(result="miss")
+            return None
+        self._entries.move_to_end(bin_range)
+        BIN_CACHE_LOOKUPS.inc(result="hit")
+        return info
+
+    def put(
+        self, card: str, protocol_version: Optional[str], method_url: Optional[str]
+    ) -> None:
+        if not self.enabled or len(card) < self.bin_length:
+            return
+        bin_range = card[: self.bin_length]
+        self._entries[bin_range] = BinInfo(
+            protocol_version, method_url, time.monotonic() + self.ttl
+        )
+        self._entries.move_to_end(bin_range)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
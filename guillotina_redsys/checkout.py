@@ -0,0 +1,84 @@
+from guillotina.contrib.redis import get_driver
+from guillotina_redsys import keys
+from guillotina_redsys.models import RedsysMerchantParams
+from guillotina_redsys.utils import decrypt_context
+from guillotina_redsys.utils import encrypt_context
+from pydantic import BaseModel
+from typing import Any
+from typing import Dict
+from typing import Optional
+
+import hashlib
+import secrets
+
+
+# fields that change on every step of the flow
+_STEP_FIELDS = {"Ds_Merchant_EMV3DS", "Ds_Merchant_Excep_SCA"}
+
+
+class CheckoutSessionNotFound(Exception):
+    def __init__(self):
+        super().__init__("Checkout session not found or expired")
+
+
+class CheckoutSession(BaseModel):
+    token: str
+    order: str
+    # RedsysMerchantParams fields, validated when the session was created
+    merchant: Dict[str, Any]
+
+    def merchant_params(self, **fields) -> RedsysMerchantParams:
+        # no validation: only the 3DS fields of the step are new
+        return RedsysMerchantParams.construct(**dict(self.merchant, **fields))
+
+
+class CheckoutSessions:
+    """
+    Server side state of a checkout, referenced by an opaque token.
+
+    ``init_transaction`` validates the amount and card data once and keeps
+    the merchant parameters without the per step 3DS fields, encrypted with
+    the ``secret_key``, for ``ttl`` seconds. Later steps send the token
+    instead of the card data and the parameters are rebuilt without being
+    validated again. Redis only sees a hash of the token.
+    """
+
+    def __init__(self, secret_key: str, *, enabled: bool = False, ttl: int = 1800):
+        self.secret_key = secret_key
+        self.enabled = enabled
+        self.ttl = ttl
+
+    def _key(self, token: str) -> str:
+        return keys.checkout_session(hashlib.sha256(token.encode("utf-8")).hexdigest())
+
+    async def create(self, merchant: RedsysMerchantParams) -> str:
+        token = secrets.token_urlsafe(32)
+        data = {
+            "order": merchant.Ds_Merchant_Order,
+            "merchant": merchant.dict(exclude=_STEP_FIELDS),
+        }
+        redis_driver = await get_driver()
+        await redis_driver.set(
+            key=self._key(token),
+            data=encrypt_context(self.secret_key, data).encode("utf-8"),
+            expire=self.ttl,
+        )
+        return token
+
+    async def get(self, token: str, order: Optional[str] = None) -> CheckoutSession:
+        """
+        Raises ``CheckoutSessionNotFound`` if the token is unknown, expired
+        or belongs to another order.
+        """
+        redis_driver = await get_driver()
+        stored = await redis_driver.get(self._key(token))
+        if stored is None:
+            raise CheckoutSessionNotFound()
+        data = decrypt_context(self.secret_key, stored.decode("utf-8"))
+        if order is not None and data["order"] != order:
+            raise CheckoutSessionNotFound()
+        return CheckoutSession(token=token, **data)
+
+    async def delete(self, token: str) -> None:
+        redis_driver = await get_driver()
+        await redis_driver.delete(self._key(token))
@@ -0,0 +1,185 @@
+from guillotina_redsys.resources import resources
+from pydantic import BaseModel
+from typing import List
+from typing import Optional
+
+import aiohttp
+import asyncio
+import logging
+import time
+
+
+logger = logging.getLogger("guillotina_redsys")
+
+
+class EndpointHealth(BaseModel):
+    url: str
+    healthy: bool = True
+    # exponentially weighted average, seconds
+    latency: Optional[float] = None
+    consecutive_failures: int = 0
+    consecutive_successes: int = 0
+    last_check: Optional[float] = None
+    last_error: Optional[str] = None
+
+
+class EndpointPool:
+    """
+    Ordered list of Redsys endpoints with health tracking.
+
+    Health comes from background probes (``probe_once``/``run``) and from
+    the outcome of real requests (``RestAPI`` reports them). An endpoint goes
+    down after ``failure_threshold`` consecutive failures and back up after
+    ``recovery_threshold`` consecutive successes. Traffic leaves the active
+    endpoint only when it is down, or when another healthy endpoint is
+    ``switch_ratio`` times faster, so it does not flap between close ones.
+    """
+
+    def __init__(
+        self,
+        urls: List[str],
+        *,
+        interval: float = 10.0,
+        timeout: float = 3.0,
+        probe_path: str = "",
+        failure_threshold: int = 3,
+        recovery_threshold: int = 3,
+        switch_ratio: float = 2.0,
+        alpha: float = 0.3,
+    ) -> None:
+        self.endpoints = [EndpointHealth(url=url.rstrip("/")) for url in urls]
+        self.interval = interval
+        self.timeout = timeout
+        self.probe_path = probe_path
+        self.failure_threshold = failure_threshold
+        self.recovery_threshold = recovery_threshold
+        self.switch_ratio = switch_ratio
+        self.alpha = alpha
+        self.switches = 0
+        self._active = 0
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def active(self) -> str:
+        return self.endpoints[self._active].url
+
+    def _get(self, url: str) -> Optional[EndpointHealth]:
+        for endpoint in self.endpoints:
+            if endpoint.url == url:
+                return endpoint
+        return None
+
+    def record(
+        self,
+        url: str,
+        ok: bool,
+        latency: Optional[float] = None,
+        error: Optional[str] = None,
+    ) -> None:
+        endpoint = self._get(url)
+        if endpoint is None:
+            return
+        endpoint.last_check = time.time()
+        if ok:
+            endpoint.consecutive_failures = 0
+            endpoint.consecutive_successes += 1
+            endpoint.last_error = None
+            if latency is not None:
+                endpoint.latency = (
+                    latency
+                    if endpoint.latency is None
+                    else self.alpha * latency + (1 - self.alpha) * endpoint.latency
+                )
+            if (
+                not endpoint.healthy
+                and endpoint.consecutive_successes >= self.recovery_threshold
+            ):
+                endpoint.healthy = True
+                logger.warning(f"Redsys endpoint {url} is back up")
+        else:
+            endpoint.consecutive_successes = 0
+            endpoint.consecutive_failures += 1
+            endpoint.last_error = error
+            if (
+                endpoint.healthy
+                and endpoint.consecutive_failures >= self.failure_threshold
+            ):
+                endpoint.healthy = False
+                logger.warning(f"Redsys endpoint {url} is down: {error}")
+        self._select()
+
+    def _select(self) -> None:
+        current = self.endpoints[self._active]
+        healthy = [idx for idx, e in enumerate(self.endpoints) if e.healthy]
+        if not healthy:
+            # nothing better to go to
+            return
+        # the fastest healthy endpoint, list order breaks ties and unknowns
+        best = min(
+            healthy,
+            key=lambda idx: (
+                self.endpoints[idx].latency is None,
+                self.endpoints[idx].latency or 0,
+                idx,
+            ),
+        )
+        if best == self._active:
+            return
+        if current.healthy:
+            candidate = self.endpoints[best]
+            if (
+                current.latency is None
+                or candidate.latency is None
+                or candidate.latency * self.switch_ratio > current.latency
+            ):
+                return
+        logger.warning(
+            f"Redsys traffic moved from {current.url} to {self.endpoints[best].url}"
+        )
+        self._active = best
+        self.switches += 1
+
+    async def _probe(self, endpoint: EndpointHealth) -> None:
+        if self._session is None:
+            self._session = resources.track_session(
+                aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+            )
+        started = time.monotonic()
+        try:
+            async with self._session.get(endpoint.url + self.probe_path) as resp:
+                await resp.read()
+                status = resp.status
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.record(endpoint.url, False, error=repr(e))
+            return
+        if status >= 500:
+            self.record(endpoint.url, False, error=f"HTTP {status}")
+        else:
+            self.record(endpoint.url, True, time.monotonic() - started)
+
+    async def probe_once(self) -> None:
+        await asyncio.gather(*[self._probe(e) for e in self.endpoints])
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.probe_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.error("Error probing redsys endpoints", exc_info=True)
+            await asyncio.sleep(self.interval)
+
+    def status(self) -> dict:
+        return {
+            "active": self.active,
+            "switches": self.switches,
+            "endpoints": [endpoint.dict() for endpoint in self.endpoints],
+        }
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
@@ -0,0 +1,176 @@
+from guillotina.contrib.redis import get_driver
+from guillotina_redsys import keys
+from pydantic import BaseModel
+from pydantic import Field
+from redis.exceptions import ResponseError
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Literal
+from typing import Optional
+from typing import Tuple
+
+import asyncio
+import json
+import logging
+import time
+
+
+logger = logging.getLogger("guillotina_redsys")
+
+EventType = Literal[
+    "transaction_started",
+    "threeds_completed",
+    "challenge_required",
+    "authorized",
+    "denied",
+    "error",
+    "abandoned",
+]
+
+
+class RedsysEvent(BaseModel):
+    type: EventType
+    order: str
+    transaction_id: Optional[str] = None
+    timestamp: float = Field(default_factory=time.time)
+    data: Dict[str, Any] = {}
+
+    def to_json(self) -> str:
+        return json.dumps(self.dict())
+
+
+class EventEmitter:
+    """
+    Appends ``RedsysEvent`` to a Redis Stream capped (approximately) at
+    ``maxlen`` entries. Emission never breaks the payment flow: failures are
+    logged and swallowed.
+    """
+
+    def __init__(
+        self,
+        *,
+        enabled: bool = False,
+        stream: Optional[str] = None,
+        maxlen: int = 100_000,
+    ) -> None:
+        self.enabled = enabled
+        self.stream = stream or keys.events_stream()
+        self.maxlen = maxlen
+
+    async def emit(self, event: RedsysEvent) -> Optional[str]:
+        if not self.enabled:
+            return None
+        try:
+            pool = (await get_driver()).pool
+            entry_id = await pool.xadd(
+                self.stream,
+                {"event": event.to_json()},
+                maxlen=self.maxlen,
+                approximate=True,
+            )
+        except Exception:
+            logger.warning(f"Could not emit redsys event {event.type}", exc_info=True)
+            return None
+        return entry_id.decode("utf-8")
+
+
+EventHandler = Callable[[List[RedsysEvent]], Awaitable[None]]
+
+
+class RedsysEventConsumer:
+    """
+    Consumer group reader for the events stream.
+
+    ``handler`` receives a batch of events; their entries are acknowledged
+    only when it returns without raising, otherwise they stay pending and
+    are reclaimed (by this or another consumer) after ``claim_idle`` ms.
+    """
+
+    def __init__(
+        self,
+        group: str,
+        consumer: str,
+        handler: EventHandler,
+        *,
+        stream: Optional[str] = None,
+        batch_size: int = 100,
+        block: int = 5000,
+        claim_idle: int = 60_000,
+    ) -> None:
+        self.group = group
+        self.consumer = consumer
+        self.handler = handler
+        self.stream = stream or keys.events_stream()
+        self.batch_size = batch_size
+        self.block = block
+        self.claim_idle = claim_idle
+
+    async def ensure_group(self) -> None:
+        pool = (await get_driver()).pool
+        try:
+            await pool.xgroup_create(self.stream, self.group, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    @staticmethod
+    def _parse(entries) -> Tuple[List[bytes], List[RedsysEvent]]:
+        ids = []
+        events = []
+        for entry_id, fields in entries:
+            ids.append(entry_id)
+            if not fields:
+                # entry trimmed from the stream while pending
+                continue
+            events.append(RedsysEvent(**json.loads(fields[b"event"])))
+        return ids, events
+
+    async def _handle(self, entries) -> int:
+        ids, events = self._parse(entries)
+        if not ids:
+            return 0
+        if events:
+            await self.handler(events)
+        pool = (await get_driver()).pool
+        await pool.xack(self.stream, self.group, *ids)
+        return len(ids)
+
+    async def reclaim(self) -> int:
+        pool = (await get_driver()).pool
+        _, entries, *_ = await pool.xautoclaim(
+            self.stream,
+            self.group,
+            self.consumer,
+            min_idle_time=self.claim_idle,
+            count=self.batch_size,
+        )
+        return await self._handle(entries)
+
+    async def process_batch(self, block: Optional[int] = None) -> int:
+        pool = (await get_driver()).pool
+        response = await pool.xreadgroup(
+            self.group,
+            self.consumer,
+            {self.stream: ">"},
+            count=self.batch_size,
+            block=self.block if block is None else block,
+        )
+        processed = 0
+        for _, entries in response or []:
+            processed += await self._handle(entries)
+        return processed
+
+    async def run(self) -> None:
+        await self.ensure_group()
+        while True:
+            try:
+                await self.reclaim()
+                await self.process_batch()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.error("Error consuming redsys events", exc_info=True)
+                await asyncio.sleep(1)
@@ -0,0 +1,114 @@
+from collections import Counter
+from fnmatch import fnmatch
+from guillotina_redsys.transports import TransportConnectionError
+from pydantic import BaseModel
+from pydantic import confloat
+from pydantic import conint
+from typing import AnyStr
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import asyncio
+import json
+import random
+
+
+Rate = confloat(ge=0, le=1)
+
+
+class FaultRule(BaseModel):
+    # fnmatch pattern matched against the full request url
+    endpoint: str = "*"
+
+    latency: confloat(ge=0) = 0
+    latency_rate: Rate = 0
+
+    reset_rate: Rate = 0
+
+    # once triggered, the next `error_burst` calls get `error_status`
+    error_rate: Rate = 0
+    error_status: conint(ge=500, le=599) = 503
+    error_burst: conint(ge=1) = 1
+
+    truncate_rate: Rate = 0
+
+    redsys_error_rate: Rate = 0
+    redsys_error_codes: List[str] = ["SIS0042"]
+
+
+class FaultInjector:
+    """
+    Chaos layer for ``RestAPI``: injects latency, connection resets, 5xx
+    bursts, truncated bodies and Redsys error codes on the endpoints matched
+    by its rules. The first matching rule applies.
+    """
+
+    def __init__(
+        self,
+        *,
+        enabled: bool = False,
+        rules: Optional[List[Dict]] = None,
+        seed: Optional[int] = None,
+    ) -> None:
+        self.enabled = enabled
+        self.configure(rules or [], seed=seed)
+
+    def configure(self, rules: List[Dict], seed: Optional[int] = None) -> None:
+        self.rules = [
+            rule if isinstance(rule, FaultRule) else FaultRule(**rule) for rule in rules
+        ]
+        self._random = random.Random(seed)
+        self._bursts: Dict[int, int] = {}
+        self.injected: Counter = Counter()
+
+    def _match(self, url: str) -> Tuple[int, Optional[FaultRule]]:
+        for idx, rule in enumerate(self.rules):
+            if fnmatch(url, rule.endpoint):
+                return idx, rule
+        return -1, None
+
+    def _hit(self, rate: float) -> bool:
+        return rate > 0 and self._random.random() < rate
+
+    async def before_request(self, method: str, url: str) -> Optional[Tuple[int, str]]:
+        """
+        Runs before the real request. May sleep, raise a connection error or
+        return a synthetic ``(status, body)`` that replaces the real call.
+        """
+        idx, rule = self._match(url)
+        if rule is None:
+            return None
+
+        if self._hit(rule.latency_rate):
+            self.injected["latency"] += 1
+            await asyncio.sleep(rule.latency)
+
+        if self._hit(rule.reset_rate):
+            self.injected["reset"] += 1
+            # retried and reported to the endpoint pool like a real reset
+            raise TransportConnectionError(
+                f"Connection reset by peer (injected) {method} {url}"
+            )
+
+        remaining = self._bursts.get(idx, 0)
+        if remaining == 0 and self._hit(rule.error_rate):
+            remaining = rule.error_burst
+        if remaining > 0:
+            self._bursts[idx] = remaining - 1
+            self.injected["server_error"] += 1
+            return rule.error_status, "Injected server error"
+
+        if self._hit(rule.redsys_error_rate):
+            self.injected["redsys_error"] += 1
+            code = self._random.choice(rule.redsys_error_codes)
+            return 200, json.dumps({"errorCode": code})
+        return None
+
+    def after_response(self, url: str, body: AnyStr) -> AnyStr:
+        _, rule = self._match(url)
+        if rule is not None and self._hit(rule.truncate_rate):
+            self.injected["truncate"] += 1
+            return body[: len(body) // 2]
+        return body
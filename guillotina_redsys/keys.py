@@ -0,0 +1,147 @@
+"""
+Redis key schema of guillotina_redsys.
+
+Every key is versioned (``redsys:v1:...``) so the layout can change without
+reading stale data. Keys that belong to an order carry the order id as a
+Redis Cluster hash tag (``{ORDER}``): they all live in the same slot, and
+multi-key pipelines or scripts for one order stay single-slot and atomic.
+Billing runs are tagged the same way by run id.
+"""
+
+PREFIX = "redsys"
+VERSION = "v1"
+
+
+def _key(*parts: str) -> str:
+    return ":".join((PREFIX, VERSION) + parts)
+
+
+def _order_key(order: str, *parts: str) -> str:
+    return _key("{" + order + "}", *parts)
+
+
+# ---------- per order ----------
+
+
+def notification_3ds(order: str, transaction_id: str) -> str:
+    return _order_key(order, "3ds", transaction_id)
+
+
+def notification_cres(order: str, transaction_id: str) -> str:
+    return _order_key(order, "cres", transaction_id)
+
+
+# Names used by 1.0.0. Notifications stored before an upgrade are still read
+# from them until the next release; nothing is written there anymore.
+
+
+def legacy_notification_3ds(order: str, transaction_id: str) -> str:
+    return f"notification_3DS:{order}:{transaction_id}"
+
+
+def legacy_notification_cres(order: str, transaction_id: str) -> str:
+    return f"notification_CRES:{order}:{transaction_id}"
+
+
+def challenge_context(order: str, transaction_id: str) -> str:
+    return _order_key(order, "context", transaction_id)
+
+
+def challenge_result(order: str, transaction_id: str) -> str:
+    return _order_key(order, "result", transaction_id)
+
+
+def challenge_claim(order: str, transaction_id: str) -> str:
+    return _order_key(order, "claim", transaction_id)
+
+
+def order_state(order: str) -> str:
+    return _order_key(order, "state")
+
+
+def preauth(order: str) -> str:
+    return _order_key(order, "preauth")
+
+
+def audit_index(order: str) -> str:
+    return _order_key(order, "audit")
+
+
+def flow(order: str) -> str:
+    return _order_key(order, "flow")
+
+
+# ---------- per billing run ----------
+
+
+def _run_key(run_id: str, *parts: str) -> str:
+    return _key("billing", "{" + run_id + "}", *parts)
+
+
+def billing_run(run_id: str) -> str:
+    return _run_key(run_id)
+
+
+def billing_queue(run_id: str) -> str:
+    return _run_key(run_id, "queue")
+
+
+def billing_shards(run_id: str) -> str:
+    return _run_key(run_id, "shards")
+
+
+def billing_shard(run_id: str, shard: int) -> str:
+    return _run_key(run_id, "shard", str(shard))
+
+
+def billing_results(run_id: str) -> str:
+    return _run_key(run_id, "results")
+
+
+# ---------- global ----------
+
+
+def preauth_queue() -> str:
+    return _key("{preauth_queue}")
+
+
+def preauth_processing() -> str:
+    # same slot as the queue, orders move between both in one script
+    return _key("{preauth_queue}", "processing")
+
+
+def events_stream() -> str:
+    return _key("events")
+
+
+def checkout_session(token_hash: str) -> str:
+    return _key("checkout", token_hash)
+
+
+def rate_bucket_merchant(merchant: str) -> str:
+    return _key("rate", "{" + merchant + "}")
+
+
+def rate_bucket(merchant: str, terminal: str, operation: str) -> str:
+    # same slot as the merchant bucket, both are taken in one script
+    return _key("rate", "{" + merchant + "}", terminal, operation)
+
+
+def billing_runs() -> str:
+    return _key("billing_runs")
+
+
+def inflight_index() -> str:
+    return _key("inflight")
+
+
+def sweeper_lock() -> str:
+    return _key("sweeper_lock")
+
+
+def audit_stream() -> str:
+    return _key("audit")
+
+
+def order_updates_channel() -> str:
+    return _key("order_updates")
@@ -0,0 +1,135 @@
+"""
+Process wide metrics of guillotina_redsys.
+
+Values are kept in memory (served by ``@redsysMetrics``) and, when
+``prometheus_client`` is installed (``pip install guillotina_redsys[metrics]``),
+mirrored to its default registry so the application can expose them.
+"""
+from typing import Dict
+from typing import List
+from typing import Sequence
+from typing import Tuple
+
+import bisect
+
+
+try:
+    import prometheus_client
+except ImportError:  # pragma: no cover
+    prometheus_client = None
+
+
+_registry: Dict[str, "_Metric"] = {}
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._prometheus = None
+        _registry[name] = self
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _mirror(self, labels: Dict[str, str]):
+        if self._prometheus is None:
+            return None
+        if self.labels:
+            return self._prometheus.labels(**labels)
+        return self._prometheus
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        super().__init__(name, description, labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+        if prometheus_client is not None:
+            self._prometheus = prometheus_client.Counter(name, description, labels)
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+        mirror = self._mirror(labels)
+        if mirror is not None:
+            mirror.inc(amount)
+
+    def status(self) -> dict:
+        return {
+            "type": self.kind,
+            "values": [
+                {"labels": dict(zip(self.labels, key)), "value": value}
+                for key, value in self.values.items()
+            ],
+        }
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        buckets: Sequence[float],
+        labels: Sequence[str] = (),
+    ):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+        # per label values: counts per bucket (last one is +Inf), sum
+        self.values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+        if prometheus_client is not None:
+            self._prometheus = prometheus_client.Histogram(
+                name, description, labels, buckets=self.buckets
+            )
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        if key not in self.values:
+            self.values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = self.values[key]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+        mirror = self._mirror(labels)
+        if mirror is not None:
+            mirror.observe(value)
+
+    def status(self) -> dict:
+        values = []
+        for key, (counts, total) in self.values.items():
+            count = sum(counts)
+            values.append(
+                {
+                    "labels": dict(zip(self.labels, key)),
+                    "count": count,
+                    "sum": total[0],
+                    "mean": total[0] / count if count else None,
+                    "buckets": dict(
+                        zip([str(b) for b in self.buckets] + ["+Inf"], counts)
+                    ),
+                }
+            )
+        return {"type": self.kind, "values": values}
+
+
+def status() -> dict:
+    return {name: metric.status() for name, metric in sorted(_registry.items())}
+
+
+# ---------- redis reads ----------
+
+REDIS_READ_BATCH_SIZE = Histogram(
+    "redsys_redis_read_batch_size",
+    "Keys per pipelined Redis read batch",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+REDIS_READS = Counter(
+    "redsys_redis_reads_total",
+    "Redis reads requested through the read batcher, by result",
+    labels=("result",),
+)
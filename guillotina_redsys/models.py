@@ -2,14 +2,18 @@
 from decimal import Decimal
 from decimal import ROUND_HALF_UP
 from guillotina_redsys.utils import compute_redsys_signature
+from guillotina_redsys.utils import decode_redsys_merchant_parameters
+from guillotina_redsys.utils import load_json
 from pydantic import BaseModel
 from pydantic import conint
 from pydantic import constr
 from pydantic import Field
 from pydantic import validator
+from typing import Any
 from typing import Dict
 from typing import Literal
 from typing import Optional
+from typing import Union
 from urllib.parse import unquote
 
 import base64
@@ -25,12 +29,22 @@ TransactionType = constr(pattern=r"^\d$")
 Pan = constr(pattern=r"^\d{12,19}$")
 ExpiryDate = constr(pattern=r"^\d{4}$")
 CVV2 = constr(pattern=r"^\d{3,4}$")
-ExcepSCAFlag = constr(pattern=r"^[YN]$")
+ExcepSCAFlag = constr(pattern=r"^(Y|N|MIT|LWV|TRA|COR|ATD)$")
 TerminalResponse = constr(pattern=r"^\d{1,3}$")
 ExcepSCA = constr(min_length=1, max_length=255)
 CardPSD2Flag = constr(pattern=r"^[YN]$")
 ThreeDSCompInd = constr(pattern=r"^[YN]$")
 
+# Card on file (COF) / merchant initiated transactions (MIT)
+MerchantIdentifier = constr(min_length=1, max_length=40)
+CofIni = constr(pattern=r"^[SN]$")
+CofType = constr(pattern=r"^[IRHEDMNC]$")
+CofTxnid = constr(min_length=1, max_length=64)
+DirectPayment = constr(pattern=r"^(true|false|MOTO)$")
+
+# Value sent in Ds_Merchant_Identifier to ask Redsys for a new token
+IDENTIFIER_REQUIRED = "REQUIRED"
+
 
 class RedsysEMV3DS(BaseModel):
     # For your example: {"threeDSInfo": "CardData"}
@@ -73,6 +87,13 @@ class RedsysMerchantParams(BaseModel):
     Ds_Merchant_EMV3DS: Optional[RedsysEMV3DS] = None
     Ds_Merchant_Excep_SCA: Optional[ExcepSCAFlag] = None
 
+    # --- Card on file (tokenization) ---
+    Ds_Merchant_Identifier: Optional[MerchantIdentifier] = None
+    Ds_Merchant_Cof_Ini: Optional[CofIni] = None
+    Ds_Merchant_Cof_Type: Optional[CofType] = None
+    Ds_Merchant_Cof_Txnid: Optional[CofTxnid] = None
+    Ds_Merchant_DirectPayment: Optional[DirectPayment] = None
+
     class Config:
         anystr_strip_whitespace = True
 
@@ -102,6 +123,16 @@ class RedsysMerchantParams(BaseModel):
             data["Ds_Merchant_EMV3DS"] = self.Ds_Merchant_EMV3DS.dict()
         if self.Ds_Merchant_Excep_SCA is not None:
             data["Ds_Merchant_Excep_SCA"] = self.Ds_Merchant_Excep_SCA
+        if self.Ds_Merchant_Identifier is not None:
+            data["Ds_Merchant_Identifier"] = self.Ds_Merchant_Identifier
+        if self.Ds_Merchant_Cof_Ini is not None:
+            data["Ds_Merchant_Cof_Ini"] = self.Ds_Merchant_Cof_Ini
+        if self.Ds_Merchant_Cof_Type is not None:
+            data["Ds_Merchant_Cof_Type"] = self.Ds_Merchant_Cof_Type
+        if self.Ds_Merchant_Cof_Txnid is not None:
+            data["Ds_Merchant_Cof_Txnid"] = self.Ds_Merchant_Cof_Txnid
+        if self.Ds_Merchant_DirectPayment is not None:
+            data["Ds_Merchant_DirectPayment"] = self.Ds_Merchant_DirectPayment
 
         return data
 
@@ -127,6 +158,11 @@ class RedsysMerchantParams(BaseModel):
         cvv2: Optional[str] = None,
         emv3ds: Optional[RedsysEMV3DS] = None,
         excep_sca: Optional[str] = None,
+        identifier: Optional[str] = None,
+        cof_ini: Optional[str] = None,
+        cof_type: Optional[str] = None,
+        cof_txnid: Optional[str] = None,
+        direct_payment: Optional[str] = None,
     ) -> "RedsysMerchantParams":
         return cls(
             Ds_Merchant_Amount=cls.euros_to_minor_units(amount_eur),
@@ -140,6 +176,11 @@ class RedsysMerchantParams(BaseModel):
             Ds_Merchant_CVV2=cvv2,
             Ds_Merchant_EMV3DS=emv3ds,
             Ds_Merchant_Excep_SCA=excep_sca,
+            Ds_Merchant_Identifier=identifier,
+            Ds_Merchant_Cof_Ini=cof_ini,
+            Ds_Merchant_Cof_Type=cof_type,
+            Ds_Merchant_Cof_Txnid=cof_txnid,
+            Ds_Merchant_DirectPayment=direct_payment,
         )
 
     # -------- Optional defensive normalizers
@@ -153,6 +194,8 @@ class RedsysMerchantParams(BaseModel):
         "Ds_Merchant_ExpiryDate",
         "Ds_Merchant_CVV2",
         "Ds_Merchant_Excep_SCA",
+        "Ds_Merchant_Identifier",
+        "Ds_Merchant_Cof_Txnid",
     )
     def _strip_spaces(cls, v):
         if isinstance(v, str):
@@ -225,6 +268,8 @@ class RedsysIniciaPeticionResponse(BaseModel):
     Ds_Excep_SCA: Optional[ExcepSCA] = None
     Ds_Card_PSD2: Optional[CardPSD2Flag] = None
     payload_3DS: Optional[str] = None
+    # opaque reference to the validated card data (checkout sessions)
+    session_token: Optional[str] = None
 
 
 RepeatOrderStatus = Literal["Y", "N"]
@@ -264,15 +309,47 @@ class RedsysAuthResult(BaseModel):
     # field name variants Redsys uses
     Ds_Card_Number: Optional[str] = Field(default=None, alias="Ds_Card_Number")
     Ds_CardNumber: Optional[str] = Field(default=None, alias="Ds_CardNumber")
+    # card on file: present when Ds_Merchant_Identifier=REQUIRED was sent
+    Ds_Merchant_Identifier: Optional[MerchantIdentifier] = None
+    Ds_ExpiryDate: Optional[str] = None
+    Ds_Merchant_Cof_Txnid: Optional[CofTxnid] = None
 
     # Handy helpers
     @property
     def is_authorized(self) -> bool:
         return self.Ds_Response == "0000"
 
+    @property
+    def is_confirmed(self) -> bool:
+        # preauthorization confirmation (transaction type 2)
+        return self.Ds_Response == "0900"
+
+    @property
+    def is_cancelled(self) -> bool:
+        # preauthorization cancellation (transaction type 9)
+        return self.Ds_Response == "0400"
+
+    @property
+    def has_card_token(self) -> bool:
+        return bool(self.Ds_Merchant_Identifier)
+
     def decoded_datetime(self) -> tuple[Optional[str], Optional[str]]:
         # Redsys often URL-encodes date/hour in this response
         return (
             unquote(self.Ds_Date) if self.Ds_Date else None,
             unquote(self.Ds_Hour) if self.Ds_Hour else None,
         )
+
+
+def parse_redsys_response(
+    body: bytes,
+) -> Union[RedsysErrorResponse, Dict[str, Any]]:
+    """
+    Parse a Redsys REST response body in a single pass: error responses
+    become ``RedsysErrorResponse``, otherwise the decoded
+    ``Ds_MerchantParameters`` are returned.
+    """
+    response = load_json(body)
+    if "errorCode" in response:
+        return RedsysErrorResponse(**response)
+    return decode_redsys_merchant_parameters(response["Ds_MerchantParameters"])
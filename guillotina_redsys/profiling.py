@@ -0,0 +1,104 @@
+from typing import Dict
+from typing import Optional
+
+import cProfile
+import functools
+import io
+import marshal
+import pstats
+import random
+import time
+
+
+class SamplingProfiler:
+    """
+    Runs a fraction (``sample_rate``) of the decorated calls under cProfile
+    and aggregates the results per name in memory.
+
+    Only one profile can be active per thread, so a call arriving while
+    another one is being profiled is not sampled. Note that the event loop
+    keeps running other tasks while a sampled call awaits, and their frames
+    end up in the same profile.
+    """
+
+    def __init__(self, *, enabled: bool = False, sample_rate: float = 0.01) -> None:
+        self.configure(enabled=enabled, sample_rate=sample_rate)
+        self.reset()
+
+    def configure(self, *, enabled: bool = False, sample_rate: float = 0.01) -> None:
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+
+    def reset(self) -> None:
+        self._stats: Dict[str, pstats.Stats] = {}
+        self._samples: Dict[str, int] = {}
+        self._active = False
+        self.started_at = time.time()
+
+    def names(self) -> Dict[str, int]:
+        return dict(self._samples)
+
+    def _add(self, name: str, profile: cProfile.Profile) -> None:
+        profile.create_stats()
+        if name in self._stats:
+            self._stats[name].add(profile)
+        else:
+            self._stats[name] = pstats.Stats(profile)
+        self._samples[name] = self._samples.get(name, 0) + 1
+
+    def _merged(self, name: Optional[str] = None) -> Optional[pstats.Stats]:
+        names = [name] if name else list(self._stats)
+        selected = [self._stats[key] for key in names if key in self._stats]
+        if not selected:
+            return None
+        merged = pstats.Stats()
+        merged.add(*selected)
+        return merged
+
+    def report(
+        self, name: Optional[str] = None, sort: str = "cumulative", limit: int = 50
+    ) -> str:
+        stats = self._merged(name)
+        if stats is None:
+            return ""
+        out = io.StringIO()
+        stats.stream = out
+        stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def dump(self, name: Optional[str] = None) -> bytes:
+        """
+        Aggregated profile in the binary pstats format (snakeviz, pstats.Stats).
+        """
+        stats = self._merged(name)
+        if stats is None:
+            return b""
+        return marshal.dumps(stats.stats)
+
+    def __call__(self, name: str):
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                if (
+                    not self.enabled
+                    or self._active
+                    or random.random() >= self.sample_rate
+                ):
+                    return await func(*args, **kwargs)
+                self._active = True
+                profile = cProfile.Profile()
+                profile.enable()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    profile.disable()
+                    self._active = False
+                    self._add(name, profile)
+
+            return wrapper
+
+        return decorator
+
+
+# Configured by RedsysUtility from the "profiling" setting
+profiler = SamplingProfiler()
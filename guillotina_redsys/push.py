@@ -0,0 +1,141 @@
+from contextlib import asynccontextmanager
+from guillotina.contrib.redis import get_driver
+from guillotina_redsys import keys
+from guillotina_redsys.events import RedsysEvent
+from typing import AsyncIterator
+from typing import Dict
+from typing import Optional
+from typing import Set
+
+import asyncio
+import json
+import logging
+
+
+logger = logging.getLogger("guillotina_redsys")
+
+ORDER_STATE_TTL = 60 * 30
+
+# after these the flow of an order is over and streams are closed
+FINAL_EVENT_TYPES = ("authorized", "denied", "error", "abandoned")
+
+# streams are public: data for the merchant backend only is never pushed
+PRIVATE_DATA = ("Ds_AuthorisationCode",)
+
+
+class OrderUpdatesHub:
+    """
+    Fan out of order state transitions to the streams open in this worker.
+
+    Events are published on a single Redis channel; each worker holds one
+    subscription to it, started with the first local subscriber, and routes
+    messages to per order queues. The last event of every order is also kept
+    so a stream opened late starts from the current state.
+    """
+
+    def __init__(
+        self,
+        *,
+        enabled: bool = False,
+        channel: Optional[str] = None,
+        queue_size: int = 100,
+        keepalive: float = 15.0,
+        max_stream_time: float = 60 * 30,
+    ) -> None:
+        self.enabled = enabled
+        self.channel = channel or keys.order_updates_channel()
+        self.queue_size = queue_size
+        self.keepalive = keepalive
+        self.max_stream_time = max_stream_time
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._subscribed: Optional[asyncio.Event] = None
+
+    async def publish(self, event: RedsysEvent) -> None:
+        event = event.copy(
+            update={
+                "data": {k: v for k, v in event.data.items() if k not in PRIVATE_DATA}
+            }
+        )
+        data = event.to_json()
+        try:
+            redis_driver = await get_driver()
+            await redis_driver.set(
+                keys.order_state(event.order),
+                data.encode("utf-8"),
+                expire=ORDER_STATE_TTL,
+            )
+            await redis_driver.publish(self.channel, data)
+        except Exception:
+            logger.warning(
+                f"Could not publish order update {event.type}", exc_info=True
+            )
+
+    async def last_event(self, order: str) -> Optional[RedsysEvent]:
+        redis_driver = await get_driver()
+        data = await redis_driver.get(keys.order_state(order))
+        if data is None:
+            return None
+        return RedsysEvent(**json.loads(data))
+
+    def _dispatch(self, data) -> None:
+        event = RedsysEvent(**json.loads(data))
+        for queue in self._subscribers.get(event.order, ()):
+            if queue.full():
+                # slow reader: keep the most recent transitions
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+    async def _listen(self) -> None:
+        redis_driver = await get_driver()
+        while True:
+            try:
+                listener = await redis_driver.subscribe(self.channel)
+                self._subscribed.set()
+                async for data in listener:
+                    try:
+                        self._dispatch(data)
+                    except Exception:
+                        logger.warning("Invalid order update", exc_info=True)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.error("Order updates subscription failed", exc_info=True)
+                self._subscribed.clear()
+                try:
+                    await redis_driver.unsubscribe(self.channel)
+                except Exception:
+                    pass
+                await asyncio.sleep(1)
+
+    @asynccontextmanager
+    async def subscribe(self, order: str) -> AsyncIterator[asyncio.Queue]:
+        if self._task is None or self._task.done():
+            self._subscribed = asyncio.Event()
+            self._task = asyncio.create_task(self._listen())
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.setdefault(order, set()).add(queue)
+        try:
+            # events published before the SUBSCRIBE would never arrive
+            try:
+                await asyncio.wait_for(self._subscribed.wait(), self.keepalive)
+            except asyncio.TimeoutError:
+                logger.warning("Order updates subscription not ready")
+            yield queue
+        finally:
+            queues = self._subscribers.get(order)
+            if queues is not None:
+                queues.discard(queue)
+                if not queues:
+                    del self._subscribers[order]
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            redis_driver = await get_driver()
+            await redis_driver.unsubscribe(self.channel)
+
+    def subscriber_count(self) -> int:
+        return sum(len(queues) for queues in self._subscribers.values())
@@ -0,0 +1,177 @@
+from guillotina.contrib.redis import get_driver
+from guillotina_redsys import keys
+from guillotina_redsys import metrics
+from guillotina_redsys.admission import AdmissionRejected
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+import asyncio
+import math
+import time
+
+
+RATE_LIMIT_LEASES = metrics.Counter(
+    "redsys_rate_limit_leases_total",
+    "Token leases asked to the shared buckets, by result",
+    labels=("operation", "result"),
+)
+RATE_LIMIT_WAIT_SECONDS = metrics.Histogram(
+    "redsys_rate_limit_wait_seconds",
+    "Time Redsys calls waited for a token",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+    labels=("operation",),
+)
+
+# Refills the merchant wide bucket (KEYS[1]) and the terminal and operation
+# bucket (KEYS[2]) for the time elapsed and takes up to ARGV[5] tokens from
+# both. Returns the tokens granted and, when none are left, the milliseconds
+# until both have one. The clock is the Redis one, shared by every node.
+_LEASE_SCRIPT = """
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local buckets = {}
+for i = 1, 2 do
+    local rate = tonumber(ARGV[i * 2 - 1])
+    local burst = tonumber(ARGV[i * 2])
+    local bucket = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or burst
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate / 1000)
+    buckets[i] = {rate = rate, burst = burst, tokens = tokens}
+end
+local granted = math.min(
+    tonumber(ARGV[5]),
+    math.floor(buckets[1].tokens),
+    math.floor(buckets[2].tokens)
+)
+local wait = 0
+for i = 1, 2 do
+    local bucket = buckets[i]
+    bucket.tokens = bucket.tokens - granted
+    redis.call('HSET', KEYS[i], 'tokens', tostring(bucket.tokens), 'ts', now)
+    redis.call('PEXPIRE', KEYS[i], math.ceil(bucket.burst * 1000 / bucket.rate) + 1000)
+    if granted == 0 and bucket.tokens < 1 then
+        wait = math.max(wait, math.ceil((1 - bucket.tokens) * 1000 / bucket.rate))
+    end
+end
+return {granted, wait}
+"""
+
+
+class RateLimited(AdmissionRejected):
+    def __init__(self, operation: str, retry_after: int):
+        super().__init__(operation, retry_after)
+        self.args = (f"Rate limit of {operation} requests exceeded",)
+
+
+class Lease:
+    def __init__(self) -> None:
+        self.tokens = 0
+        self.expires = 0.0
+        self.lock = asyncio.Lock()
+
+
+class TokenBucketLimiter:
+    """
+    Requests per second to Redsys shared by every worker of the cluster.
+
+    Each merchant has a token bucket in Redis refilled at ``merchant_rate``
+    tokens per second up to ``merchant_burst``: the contract limit, by
+    default ``rate`` and ``burst``. Each (terminal, operation) pair of the
+    merchant has its own bucket refilled at ``rate`` up to ``burst``, which
+    ``operations`` overrides per operation. Every call takes a token from
+    both buckets in one script. Workers take ``lease_size`` tokens at a
+    time and spend them locally, so most calls make no Redis round trip;
+    leased tokens not spent in ``lease_ttl`` seconds are dropped, which
+    keeps the shared limit close to exact. A call that would wait more than
+    ``max_wait`` seconds for a token is rejected with ``RateLimited``. Calls
+    of the same bucket queue behind the one refilling the lease; that wait
+    is bounded by ``lock_timeout`` instead, so the Redis round trip of
+    another call does not use up ``max_wait``.
+    """
+
+    def __init__(
+        self,
+        *,
+        enabled: bool = False,
+        rate: float = 20,
+        burst: int = 40,
+        operations: Optional[Dict[str, Dict[str, float]]] = None,
+        lease_size: int = 5,
+        lease_ttl: float = 1.0,
+        max_wait: float = 5.0,
+        lock_timeout: float = 10.0,
+        merchant_rate: Optional[float] = None,
+        merchant_burst: Optional[int] = None,
+    ) -> None:
+        self.enabled = enabled
+        self.rate = rate
+        self.burst = burst
+        self.merchant_rate = merchant_rate or rate
+        self.merchant_burst = merchant_burst or burst
+        self.operations = operations or {}
+        self.lease_size = lease_size
+        self.lease_ttl = lease_ttl
+        self.max_wait = max_wait
+        self.lock_timeout = lock_timeout
+        self._leases: Dict[Tuple[str, str, str], Lease] = {}
+
+    def _limits(self, operation: str) -> Tuple[float, int]:
+        limits = self.operations.get(operation, {})
+        return limits.get("rate", self.rate), limits.get("burst", self.burst)
+
+    async def _lease(self, merchant: str, terminal: str, operation: str, size: int):
+        rate, burst = self._limits(operation)
+        pool = (await get_driver()).pool
+        granted, wait = await pool.eval(
+            _LEASE_SCRIPT,
+            2,
+            keys.rate_bucket_merchant(merchant),
+            keys.rate_bucket(merchant, terminal, operation),
+            self.merchant_rate,
+            self.merchant_burst,
+            rate,
+            burst,
+            min(size, burst, self.merchant_burst),
+        )
+        RATE_LIMIT_LEASES.inc(
+            operation=operation, result="granted" if granted else "empty"
+        )
+        return granted, wait / 1000
+
+    async def acquire(self, merchant: str, terminal: str, operation: str) -> None:
+        if not self.enabled:
+            return
+        lease = self._leases.setdefault((merchant, terminal, operation), Lease())
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(lease.lock.acquire(), self.lock_timeout)
+        except asyncio.TimeoutError:
+            RATE_LIMIT_WAIT_SECONDS.observe(self.lock_timeout, operation=operation)
+            raise RateLimited(operation, max(1, math.ceil(self.lock_timeout)))
+        try:
+            # only the wait for tokens counts towards max_wait
+            locked = time.monotonic()
+            while lease.tokens == 0 or time.monotonic() > lease.expires:
+                granted, wait = await self._lease(
+                    merchant, terminal, operation, self.lease_size
+                )
+                if granted:
+                    lease.tokens = granted
+                    lease.expires = time.monotonic() + self.lease_ttl
+                    break
+                waited = time.monotonic() - locked
+                if waited + wait > self.max_wait:
+                    RATE_LIMIT_WAIT_SECONDS.observe(
+                        time.monotonic() - started, operation=operation
+                    )
+                    raise RateLimited(operation, max(1, math.ceil(wait)))
+                await asyncio.sleep(wait)
+            lease.tokens -= 1
+        finally:
+            lease.lock.release()
+        RATE_LIMIT_WAIT_SECONDS.observe(time.monotonic() - started, operation=operation)
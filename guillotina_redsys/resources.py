@@ -0,0 +1,198 @@
+"""
+Resource instrumentation of long running workers: HTTP client sessions,
+file descriptors and sockets, asyncio tasks, calls in flight per operation
+and tracemalloc snapshots. ``no_leaks`` checks a block of a test for leaked
+sessions, sockets and tasks.
+"""
+from collections import Counter
+from contextlib import asynccontextmanager
+from contextlib import contextmanager
+from typing import Any
+from typing import AsyncIterator
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+
+import asyncio
+import os
+import time
+import tracemalloc
+import weakref
+
+
+def _is_closed(session: Any) -> bool:
+    # aiohttp.ClientSession or httpx.AsyncClient
+    closed = getattr(session, "closed", None)
+    if closed is None:
+        closed = getattr(session, "is_closed", False)
+    return bool(closed)
+
+
+def _file_descriptors() -> Optional[Dict[str, int]]:
+    """Open file descriptors and sockets of the process (Linux only)."""
+    try:
+        fds = os.listdir("/proc/self/fd")
+    except OSError:
+        return None
+    sockets = 0
+    for fd in fds:
+        try:
+            if os.readlink(f"/proc/self/fd/{fd}").startswith("socket:"):
+                sockets += 1
+        except OSError:
+            # closed while listing
+            continue
+    return {"open": len(fds), "sockets": sockets}
+
+
+def _task_name(task: asyncio.Task) -> str:
+    coro = task.get_coro()
+    return getattr(coro, "__qualname__", None) or repr(coro)
+
+
+class ResourceTracker:
+    """
+    Counts the HTTP client sessions created by guillotina_redsys that are
+    still open and the calls in flight per operation, and takes tracemalloc
+    snapshots on demand. Sessions are held by weak references, so tracking
+    never keeps one alive.
+    """
+
+    def __init__(self) -> None:
+        self._sessions: "weakref.WeakSet[Any]" = weakref.WeakSet()
+        self._in_flight: Dict[str, int] = {}
+        self._last_snapshot: Optional[tracemalloc.Snapshot] = None
+        self._snapshot_times: List[float] = []
+
+    def track_session(self, session: Any) -> Any:
+        self._sessions.add(session)
+        return session
+
+    def open_sessions(self) -> List[Any]:
+        return [session for session in self._sessions if not _is_closed(session)]
+
+    @contextmanager
+    def in_flight(self, operation: str) -> Iterator[None]:
+        self._in_flight[operation] = self._in_flight.get(operation, 0) + 1
+        try:
+            yield
+        finally:
+            self._in_flight[operation] -= 1
+
+    def tasks(self, limit: int = 20) -> Dict[str, Any]:
+        tasks = asyncio.all_tasks()
+        names = Counter(_task_name(task) for task in tasks)
+        return {"total": len(tasks), "by_coroutine": dict(names.most_common(limit))}
+
+    def snapshot(self, frames: int = 1, limit: int = 20) -> Dict[str, Any]:
+        """
+        Take a tracemalloc snapshot, starting tracing with ``frames`` frames
+        per allocation if needed. Returns the ``limit`` biggest allocation
+        sites, or the biggest changes since the previous snapshot.
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            (tracemalloc.Filter(False, tracemalloc.__file__),)
+        )
+        if self._last_snapshot is not None:
+            stats = snapshot.compare_to(self._last_snapshot, "lineno")[:limit]
+            top = [
+                {
+                    "trace": str(stat.traceback),
+                    "size": stat.size,
+                    "size_diff": stat.size_diff,
+                    "count": stat.count,
+                    "count_diff": stat.count_diff,
+                }
+                for stat in stats
+            ]
+        else:
+            top = [
+                {"trace": str(stat.traceback), "size": stat.size, "count": stat.count}
+                for stat in snapshot.statistics("lineno")[:limit]
+            ]
+        self._last_snapshot = snapshot
+        self._snapshot_times.append(time.time())
+        return {
+            "snapshot": len(self._snapshot_times),
+            "compared_to": (
+                self._snapshot_times[-2] if len(self._snapshot_times) > 1 else None
+            ),
+            "top": top,
+        }
+
+    def stop_tracing(self) -> None:
+        self._last_snapshot = None
+        self._snapshot_times = []
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def status(self) -> Dict[str, Any]:
+        tracing = tracemalloc.is_tracing()
+        traced, peak = tracemalloc.get_traced_memory() if tracing else (None, None)
+        return {
+            "sessions": len(self.open_sessions()),
+            "file_descriptors": _file_descriptors(),
+            "tasks": self.tasks(),
+            "in_flight": {
+                operation: count
+                for operation, count in self._in_flight.items()
+                if count
+            },
+            "tracemalloc": {
+                "tracing": tracing,
+                "snapshots": len(self._snapshot_times),
+                "traced": traced,
+                "peak": peak,
+            },
+        }
+
+
+resources = ResourceTracker()
+
+
+@asynccontextmanager
+async def no_leaks(grace: float = 1.0, sockets: bool = True) -> AsyncIterator[None]:
+    """
+    Test helper: fail with ``AssertionError`` if the block leaves tasks
+    running, sessions open or, with ``sockets``, more sockets open than it
+    found. Resources are given ``grace`` seconds to be released.
+
+        async with no_leaks():
+            await utility.init_transaction(...)
+            await utility.finalize()
+    """
+    tasks_before = asyncio.all_tasks()
+    sessions_before = resources.open_sessions()
+    fds_before = _file_descriptors() if sockets else None
+    yield
+    deadline = time.monotonic() + grace
+    while True:
+        current = asyncio.current_task()
+        tasks = [
+            task
+            for task in asyncio.all_tasks() - tasks_before
+            if task is not current and not task.done()
+        ]
+        sessions = [
+            session
+            for session in resources.open_sessions()
+            if all(session is not before for before in sessions_before)
+        ]
+        leaked_sockets = 0
+        if fds_before is not None:
+            fds = _file_descriptors()
+            leaked_sockets = max(0, fds["sockets"] - fds_before["sockets"])
+        if not (tasks or sessions or leaked_sockets) or time.monotonic() > deadline:
+            break
+        await asyncio.sleep(0.01)
+    leaks = []
+    if tasks:
+        leaks.append(f"{len(tasks)} tasks: {[_task_name(task) for task in tasks]}")
+    if sessions:
+        leaks.append(f"{len(sessions)} sessions: {sessions}")
+    if leaked_sockets:
+        leaks.append(f"{leaked_sockets} sockets")
+    assert not leaks, "Leaked " + ", ".join(leaks)
@@ -0,0 +1,182 @@
+"""
+Retry classification of Redsys calls.
+
+Every failed attempt is put in a class: ``connection`` (connection errors and
+5xx), ``transient`` (Redsys error codes worth repeating) or ``permanent``
+(error codes that cannot succeed, never repeated). Each class has its own
+number of attempts and exponential backoff.
+"""
+from aiohttp import ClientConnectorError
+from guillotina_redsys import metrics
+from guillotina_redsys.transports import TransportConnectionError
+from tenacity import AsyncRetrying
+from tenacity import wait_exponential
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import Optional
+
+
+CONNECTION = "connection"
+TRANSIENT = "transient"
+PERMANENT = "permanent"
+
+# attempts of a request on connection errors and 5xx
+REQUEST_ATTEMPTS = 3
+
+DEFAULT_CLASSES = {
+    CONNECTION: {"attempts": REQUEST_ATTEMPTS, "min_wait": 0.5, "max_wait": 5},
+    TRANSIENT: {"attempts": 3, "min_wait": 1, "max_wait": 10},
+    PERMANENT: {"attempts": 1},
+}
+
+# Redsys errorCode -> class. Codes not listed get ``default_error_class``.
+ERROR_CODES = {
+    # the session with the SIS was lost, the request can be sent again
+    "SIS0081": TRANSIENT,
+    # malformed request, signature, merchant or terminal
+    "SIS0007": PERMANENT,
+    "SIS0026": PERMANENT,
+    "SIS0027": PERMANENT,
+    "SIS0042": PERMANENT,
+    "SIS0429": PERMANENT,
+    "SIS0430": PERMANENT,
+    "SIS0431": PERMANENT,
+    "SIS0432": PERMANENT,
+    "SIS0433": PERMANENT,
+    "SIS0434": PERMANENT,
+    "SIS0435": PERMANENT,
+    # duplicate order number
+    "SIS0051": PERMANENT,
+    "SIS0055": PERMANENT,
+    # refunds, confirmations and cancellations of missing operations
+    "SIS0054": PERMANENT,
+    "SIS0056": PERMANENT,
+    "SIS0057": PERMANENT,
+    "SIS0059": PERMANENT,
+    "SIS0060": PERMANENT,
+    "SIS0061": PERMANENT,
+    "SIS0062": PERMANENT,
+    # invalid or expired card, CVV
+    "SIS0063": PERMANENT,
+    "SIS0064": PERMANENT,
+    "SIS0065": PERMANENT,
+    "SIS0071": PERMANENT,
+    "SIS0093": PERMANENT,
+    "SIS0216": PERMANENT,
+    "SIS0217": PERMANENT,
+    "SIS0221": PERMANENT,
+    "SIS0253": PERMANENT,
+    # operation not allowed for the merchant or the card
+    "SIS0112": PERMANENT,
+    "SIS0252": PERMANENT,
+    "SIS0256": PERMANENT,
+    "SIS0257": PERMANENT,
+    "SIS0274": PERMANENT,
+    "SIS0298": PERMANENT,
+    "SIS0321": PERMANENT,
+    # amount and operation limits
+    "SIS0198": PERMANENT,
+    "SIS0199": PERMANENT,
+    "SIS0200": PERMANENT,
+    "SIS0219": PERMANENT,
+    "SIS0220": PERMANENT,
+    # payment time exceeded
+    "SIS0142": PERMANENT,
+}
+
+RETRY_DECISIONS = metrics.Counter(
+    "redsys_retry_decisions_total",
+    "Failed attempts of Redsys calls by class and decision",
+    labels=("operation", "error_class", "decision"),
+)
+
+
+class HTTPServerError(Exception):
+    """Raised for 5xx responses so they are retried."""
+
+
+class RetryPolicy:
+    """
+    Runs a call, classifies each failed attempt (raised exception or
+    returned Redsys error response) and repeats it while its class allows.
+    ``repeatOrderStatus`` overrides the error code table: ``N`` is never
+    repeated and ``Y`` is repeated as transient. Exceptions of no class are
+    raised at once. After the last attempt the error response is returned
+    or the exception raised, as the call did.
+    """
+
+    def __init__(
+        self,
+        *,
+        classes: Optional[Dict[str, Dict[str, float]]] = None,
+        error_codes: Optional[Dict[str, str]] = None,
+        default_error_class: str = PERMANENT,
+    ) -> None:
+        self.classes = {
+            name: dict(config, **(classes or {}).get(name, {}))
+            for name, config in DEFAULT_CLASSES.items()
+        }
+        self.error_codes = dict(ERROR_CODES, **(error_codes or {}))
+        self.default_error_class = default_error_class
+        self._waits = {
+            name: wait_exponential(
+                min=config.get("min_wait", 0), max=config.get("max_wait", 0)
+            )
+            for name, config in self.classes.items()
+        }
+
+    def classify_error(self, error: BaseException) -> Optional[str]:
+        if isinstance(
+            error, (ClientConnectorError, TransportConnectionError, HTTPServerError)
+        ):
+            return CONNECTION
+        return None
+
+    def classify_result(self, result: Any) -> Optional[str]:
+        code = getattr(result, "errorCode", None)
+        if code is None:
+            return None
+        repeat = getattr(result, "repeatOrderStatus", None)
+        if repeat == "N":
+            return PERMANENT
+        if repeat == "Y":
+            return TRANSIENT
+        return self.error_codes.get(code, self.default_error_class)
+
+    def _classify(self, retry_state) -> Optional[str]:
+        outcome = retry_state.outcome
+        if outcome.failed:
+            return self.classify_error(outcome.exception())
+        return self.classify_result(outcome.result())
+
+    async def call(
+        self,
+        fn: Callable[..., Awaitable[Any]],
+        *args,
+        operation: str = "",
+        **kwargs,
+    ) -> Any:
+        def stop(retry_state) -> bool:
+            error_class = self._classify(retry_state)
+            attempts = self.classes[error_class].get("attempts", 1)
+            give_up = retry_state.attempt_number >= attempts
+            RETRY_DECISIONS.inc(
+                operation=operation,
+                error_class=error_class,
+                decision="give_up" if give_up else "retry",
+            )
+            return give_up
+
+        retrying = AsyncRetrying(
+            retry=lambda retry_state: self._classify(retry_state) is not None,
+            stop=stop,
+            wait=lambda retry_state: self._waits[self._classify(retry_state)](
+                retry_state
+            ),
+            # the last error response, or its exception raised
+            retry_error_callback=lambda retry_state: retry_state.outcome.result(),
+            reraise=True,
+        )
+        return await retrying(fn, *args, **kwargs)
@@ -0,0 +1,235 @@
+from decimal import Decimal
+from guillotina.contrib.redis import get_driver
+from guillotina_redsys import keys
+from guillotina_redsys.models import RedsysErrorResponse
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import asyncio
+import logging
+import time
+
+
+logger = logging.getLogger("guillotina_redsys")
+
+PREAUTH_STATE_TTL = 60 * 60 * 24 * 30
+
+FINAL_STATUSES = ("confirmed", "cancelled", "denied", "failed")
+
+# Queue again the orders of KEYS[2] whose visibility timeout (score) passed
+# before ARGV[1], then move at most ARGV[2] due orders from the queue KEYS[1]
+# to KEYS[2] until ARGV[3]. An order stays in KEYS[2] until it is processed,
+# so a worker dying after the claim does not lose it.
+_LEASE_DUE_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, item in ipairs(expired) do
+    redis.call('ZADD', KEYS[1], ARGV[1], item)
+end
+if #expired > 0 then
+    redis.call('ZREM', KEYS[2], unpack(expired))
+end
+local items = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, item in ipairs(items) do
+    redis.call('ZADD', KEYS[2], ARGV[3], item)
+end
+if #items > 0 then
+    redis.call('ZREM', KEYS[1], unpack(items))
+end
+return items
+"""
+
+
+class PreauthScheduler:
+    """
+    Queue of preauthorization confirmations (transaction type 2) ordered by
+    due time in a Redis sorted set.
+
+    Due confirmations are sent in batches of at most ``rate`` calls per second
+    through the utility shared ``RestAPI``. When a preauthorization is closer
+    than ``expiry_margin`` seconds to its expiry it is cancelled (type 9)
+    instead. Outcomes are stored in a per order hash.
+
+    Claimed orders wait in a processing set until they are done; the ones
+    not done within ``visibility_timeout`` seconds are queued again. Failed
+    calls are retried every ``retry_delay`` seconds until the
+    preauthorization expires, then the order is marked ``failed``.
+    """
+
+    def __init__(
+        self,
+        utility,
+        *,
+        enabled: bool = False,
+        interval: float = 1.0,
+        batch_size: int = 100,
+        rate: int = 10,
+        expiry_margin: int = 60 * 60 * 12,
+        retry_delay: int = 60 * 5,
+        visibility_timeout: int = 60 * 5,
+    ) -> None:
+        self.utility = utility
+        self.enabled = enabled
+        self.interval = interval
+        self.batch_size = batch_size
+        self.rate = rate
+        self.expiry_margin = expiry_margin
+        self.retry_delay = retry_delay
+        self.visibility_timeout = visibility_timeout
+
+    async def schedule(
+        self,
+        order: str,
+        amount: Decimal,
+        due_at: float,
+        expires_at: float,
+        currency: int = 978,
+    ) -> None:
+        pool = (await get_driver()).pool
+        key = keys.preauth(order)
+        pipe = pool.pipeline(transaction=True)
+        pipe.hset(
+            key,
+            mapping={
+                "amount": str(amount),
+                "currency": str(currency),
+                "due_at": str(due_at),
+                "expires_at": str(expires_at),
+                "status": "scheduled",
+                "attempts": "0",
+                "updated_at": str(time.time()),
+            },
+        )
+        pipe.expire(key, PREAUTH_STATE_TTL)
+        await pipe.execute()
+        await pool.zadd(keys.preauth_queue(), {order: due_at})
+
+    async def unschedule(self, order: str) -> bool:
+        """Returns False if the order was never scheduled or expired."""
+        pool = (await get_driver()).pool
+        pipe = pool.pipeline(transaction=True)
+        pipe.zrem(keys.preauth_queue(), order)
+        pipe.zrem(keys.preauth_processing(), order)
+        await pipe.execute()
+        if not await pool.exists(keys.preauth(order)):
+            return False
+        await self._update(order, status="unscheduled")
+        return True
+
+    async def get_state(self, order: str) -> Optional[Dict[str, str]]:
+        pool = (await get_driver()).pool
+        state = await pool.hgetall(keys.preauth(order))
+        if not state:
+            return None
+        return {k.decode("utf-8"): v.decode("utf-8") for k, v in state.items()}
+
+    async def _claim_due(self, now: float) -> List[str]:
+        pool = (await get_driver()).pool
+        items = await pool.eval(
+            _LEASE_DUE_SCRIPT,
+            2,
+            keys.preauth_queue(),
+            keys.preauth_processing(),
+            now,
+            self.batch_size,
+            now + self.visibility_timeout,
+        )
+        return [item.decode("utf-8") for item in items]
+
+    async def _done(self, order: str) -> None:
+        pool = (await get_driver()).pool
+        await pool.zrem(keys.preauth_processing(), order)
+
+    async def _update(self, order: str, **fields) -> None:
+        pool = (await get_driver()).pool
+        fields["updated_at"] = time.time()
+        await pool.hset(
+            keys.preauth(order),
+            mapping={k: str(v) for k, v in fields.items()},
+        )
+
+    async def _retry_later(self, order: str, state: Dict[str, str], now: float):
+        next_at = now + self.retry_delay
+        cancel_at = float(state["expires_at"]) - self.expiry_margin
+        if now < cancel_at:
+            # never wait past the point where the preauth must be cancelled
+            next_at = min(next_at, cancel_at)
+        if next_at >= float(state["expires_at"]):
+            await self._update(order, status="failed", error_code="expired")
+            await self._done(order)
+            return
+        pool = (await get_driver()).pool
+        pipe = pool.pipeline(transaction=True)
+        pipe.zadd(keys.preauth_queue(), {order: next_at})
+        pipe.zrem(keys.preauth_processing(), order)
+        await pipe.execute()
+        await self._update(order, status="retrying")
+
+    async def _process(self, order: str) -> None:
+        state = await self.get_state(order)
+        if state is None or state["status"] in FINAL_STATUSES:
+            await self._done(order)
+            return
+        now = time.time()
+        if now >= float(state["expires_at"]):
+            # Redsys already released it, nothing left to confirm or cancel
+            await self._update(order, status="failed", error_code="expired")
+            await self._done(order)
+            return
+        cancel = now >= float(state["expires_at"]) - self.expiry_margin
+        attempts = int(state.get("attempts", 0)) + 1
+        await self._update(order, attempts=attempts)
+        kwargs = dict(
+            amount=Decimal(state["amount"]),
+            order=order,
+            currency=int(state["currency"]),
+        )
+        try:
+            if cancel:
+                res = await self.utility.cancel_preauthorization(**kwargs)
+            else:
+                res = await self.utility.confirm_preauthorization(**kwargs)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.warning(f"Error processing preauth {order}", exc_info=True)
+            await self._retry_later(order, state, now)
+            return
+
+        if isinstance(res, RedsysErrorResponse):
+            await self._update(order, status="failed", error_code=res.errorCode)
+        elif cancel:
+            status = "cancelled" if res.is_cancelled else "denied"
+            await self._update(order, status=status, ds_response=res.Ds_Response)
+        else:
+            status = "confirmed" if res.is_confirmed else "denied"
+            await self._update(order, status=status, ds_response=res.Ds_Response)
+        await self._done(order)
+
+    async def run_once(self) -> int:
+        """
+        Send every due confirmation (up to ``batch_size``) honouring the rate.
+        Returns how many orders were processed.
+        """
+        orders = await self._claim_due(time.time())
+        loop = asyncio.get_running_loop()
+        for idx in range(0, len(orders), self.rate):
+            started = loop.time()
+            await asyncio.gather(
+                *[self._process(order) for order in orders[idx : idx + self.rate]]
+            )
+            if idx + self.rate < len(orders):
+                await asyncio.sleep(max(0, 1 - (loop.time() - started)))
+        return len(orders)
+
+    async def run(self) -> None:
+        while True:
+            try:
+                processed = await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.error("Error running preauth scheduler", exc_info=True)
+                processed = 0
+            if processed < self.batch_size:
+                await asyncio.sleep(self.interval)
@@ -0,0 +1,160 @@
+"""
+JSON schemas of the request bodies of the services, registered as
+guillotina json schema definitions. They mirror the constraints of the
+pydantic models so invalid input is rejected before any signing or I/O.
+"""
+from guillotina import configure
+
+
+ORDER_ID = {"type": "string", "pattern": "^[A-Za-z0-9]{4,12}$"}
+# euros as a string: JSON numbers can not be checked for two decimals
+AMOUNT = {
+    "type": "string",
+    "pattern": r"^(?!0+(\.0{1,2})?$)\d{1,10}(\.\d{1,2})?$",
+}
+CARD = {"type": "string", "pattern": r"^\d{12,19}$"}
+EXPIRY_DATE = {"type": "string", "pattern": r"^\d{4}$"}
+CVV = {"type": "string", "pattern": r"^\d{3,4}$"}
+CURRENCY = {"type": "integer", "minimum": 1, "maximum": 999}
+TRANSACTION_ID = {"type": "string", "minLength": 1, "maxLength": 64}
+PROTOCOL_VERSION = {"type": "string", "pattern": r"^\d+\.\d+\.\d+$"}
+COF_TYPE = {"type": "string", "pattern": "^[IRHEDMNC]$"}
+BILLING_RUN_ID = {"type": "string", "pattern": "^[A-Za-z0-9_-]{1,64}$"}
+SESSION_TOKEN = {"type": "string", "pattern": "^[A-Za-z0-9_-]{16,128}$"}
+IDENTIFIER = {"type": "string", "minLength": 1, "maxLength": 40}
+COF_TXNID = {"type": ["string", "null"], "maxLength": 64}
+
+_CARD_PAYMENT = {
+    "amount": AMOUNT,
+    "card": CARD,
+    "expiry_date": EXPIRY_DATE,
+    "cvv": CVV,
+    "order_id": ORDER_ID,
+    "store_card": {"type": "boolean"},
+}
+
+# path parameters shared by the notification services
+ORDER_PATH_PARAMETERS = [
+    {"name": "order_id", "in": "path", "required": True, "schema": ORDER_ID},
+    {
+        "name": "three_dss_trans_id",
+        "in": "path",
+        "required": True,
+        "schema": TRANSACTION_ID,
+    },
+]
+
+SCHEMAS = {
+    "RedsysInitTransaction": {
+        "type": "object",
+        "properties": _CARD_PAYMENT,
+        "required": ["amount", "card", "expiry_date", "cvv", "order_id"],
+    },
+    "RedsysInitThreeDS": {
+        "type": "object",
+        "properties": {
+            "transaction_id": TRANSACTION_ID,
+            "three_method_url": {"type": ["string", "null"], "maxLength": 2048},
+        },
+        "required": ["transaction_id", "three_method_url"],
+    },
+    "RedsysTrataPeticion": {
+        "type": "object",
+        "properties": dict(
+            _CARD_PAYMENT,
+            transaction_id=TRANSACTION_ID,
+            protocol_version=PROTOCOL_VERSION,
+            three_ds_comp_ind={"type": "string", "enum": ["Y", "N"]},
+            session_token=SESSION_TOKEN,
+        ),
+        "required": ["transaction_id", "protocol_version", "three_ds_comp_ind"],
+        # card data, or the checkout session that holds it
+        "anyOf": [
+            {"required": ["amount", "card", "expiry_date", "cvv", "order_id"]},
+            {"required": ["session_token"]},
+        ],
+    },
+    "RedsysTokenPayment": {
+        "type": "object",
+        "properties": {
+            "amount": AMOUNT,
+            "identifier": IDENTIFIER,
+            "order_id": ORDER_ID,
+            "cof_type": COF_TYPE,
+            "cof_txnid": COF_TXNID,
+            "currency": CURRENCY,
+        },
+        "required": ["amount", "identifier", "order_id"],
+    },
+    "RedsysNotification3DS": {
+        "type": "object",
+        "properties": {"threeDSCompInd": {"type": "string", "enum": ["Y", "N"]}},
+    },
+    "RedsysNotificationChallenge": {
+        "type": "object",
+        "properties": {"CRES": {"type": "string", "maxLength": 16384}},
+    },
+    "RedsysChallengeResponse": {
+        "type": "object",
+        "properties": {
+            "amount": AMOUNT,
+            "card": CARD,
+            "expiry_date": EXPIRY_DATE,
+            "cvv": CVV,
+            "protocol_version": PROTOCOL_VERSION,
+            "currency": CURRENCY,
+            "store_card": {"type": "boolean"},
+            "session_token": SESSION_TOKEN,
+        },
+        "required": ["protocol_version"],
+        "anyOf": [
+            {"required": ["amount", "card", "expiry_date", "cvv"]},
+            {"required": ["session_token"]},
+        ],
+    },
+    "RedsysSchedulePreauth": {
+        "type": "object",
+        "properties": {
+            "order_id": ORDER_ID,
+            "amount": AMOUNT,
+            "due_at": {"type": "number"},
+            "expires_at": {"type": "number"},
+            "currency": CURRENCY,
+        },
+        "required": ["order_id", "amount", "due_at", "expires_at"],
+    },
+    "RedsysBillingRun": {
+        "type": "object",
+        "properties": {
+            "run_id": BILLING_RUN_ID,
+            "charges": {
+                "type": "array",
+                "minItems": 1,
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "order": ORDER_ID,
+                        "identifier": IDENTIFIER,
+                        "amount": AMOUNT,
+                        "currency": CURRENCY,
+                        "cof_txnid": COF_TXNID,
+                    },
+                    "required": ["order", "identifier", "amount"],
+                },
+            },
+        },
+        "required": ["charges"],
+    },
+}
+
+for name, schema in SCHEMAS.items():
+    configure.json_schema_definition(name, schema)
+
+
+def request_body(name: str) -> dict:
+    return {
+        "required": True,
+        "content": {
+            "application/json": {"schema": {"$ref": f"#/components/schemas/{name}"}}
+        },
+    }
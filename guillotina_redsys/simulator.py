@@ -0,0 +1,205 @@
+"""
+Local Redsys REST simulator for benchmarks and tests.
+
+    python -m guillotina_redsys.simulator --port 8181 --secret-key sq7HjrUOBfKmC576ILgskD5srU870gJ7
+
+Point ``url_redsys`` at ``http://localhost:8181``. It answers
+``iniciaPeticionREST`` and ``trataPeticionREST`` with signed responses shaped
+like the real ones. By default every payment is frictionless and authorized;
+``POST /_scenario`` queues the outcome and latency of the next calls of an
+order (``{"order": "...", "steps": [{"outcome": "challenge", "latency": 0.3}]}``);
+a step with ``repeat`` answers that many calls, e.g. the retries of a failure.
+
+Outcomes: ``card_data`` and ``method`` (iniciaPeticion, without and with a
+3DS method url under ``--acs-url``), ``challenge``, ``authorized``, ``denied``, ``error`` (Redsys
+error code) and ``failed`` (HTTP 503).
+"""
+from aiohttp import web
+from collections import defaultdict
+from collections import deque
+from guillotina_redsys.utils import compute_redsys_signature
+from guillotina_redsys.utils import decode_redsys_merchant_parameters
+from typing import Any
+from typing import Deque
+from typing import Dict
+
+import argparse
+import asyncio
+import base64
+import json
+import uuid
+
+
+OUTCOMES = (
+    "card_data",
+    "method",
+    "challenge",
+    "authorized",
+    "denied",
+    "error",
+    "failed",
+)
+
+# final Ds_Response per transaction type
+_AUTHORIZED_RESPONSES = {"2": "0900", "9": "0400"}
+
+
+class RedsysSimulator:
+    def __init__(
+        self,
+        secret_key: str,
+        *,
+        latency: float = 0.0,
+        error_code: str = "SIS0051",
+        acs_url: str = "https://acs.example.com",
+    ) -> None:
+        self.secret_key = secret_key
+        self.acs_url = acs_url
+        self.latency = latency
+        self.error_code = error_code
+        self.healthy = True
+        self.requests = 0
+        self._scenarios: Dict[str, Deque[Dict[str, Any]]] = defaultdict(deque)
+        self.app = web.Application()
+        self.app.router.add_post("/iniciaPeticionREST", self.inicia_peticion)
+        self.app.router.add_post("/trataPeticionREST", self.trata_peticion)
+        self.app.router.add_post("/_scenario", self.set_scenario)
+        self.app.router.add_get("/_health", self.health)
+
+    def _next_step(self, order: str, default: str) -> Dict[str, Any]:
+        steps = self._scenarios.get(order)
+        step = {}
+        if steps:
+            step = steps[0]
+            step["repeat"] = step.get("repeat", 1) - 1
+            if step["repeat"] <= 0:
+                steps.popleft()
+        if steps is not None and not steps:
+            del self._scenarios[order]
+        return {
+            "outcome": step.get("outcome") or default,
+            "latency": step.get("latency", self.latency),
+        }
+
+    def _signed(self, order: str, params: Dict[str, Any]) -> web.Response:
+        encoded = (
+            base64.urlsafe_b64encode(json.dumps(params).encode("utf-8"))
+            .decode("ascii")
+            .rstrip("=")
+        )
+        body = {
+            "Ds_SignatureVersion": "HMAC_SHA512_V2",
+            "Ds_MerchantParameters": encoded,
+            "Ds_Signature": compute_redsys_signature(
+                terminal_key=self.secret_key,
+                merchant_params_b64=encoded,
+                order=order,
+            ),
+        }
+        return self._text(body)
+
+    @staticmethod
+    def _text(body: Dict[str, Any]) -> web.Response:
+        # Redsys answers JSON bodies as text/html
+        return web.Response(
+            text=json.dumps(body), content_type="text/html", charset="UTF-8"
+        )
+
+    async def _respond(self, request: web.Request, default: str, build):
+        self.requests += 1
+        form = await request.json()
+        merchant = decode_redsys_merchant_parameters(form["Ds_MerchantParameters"])
+        order = merchant["Ds_Merchant_Order"]
+        step = self._next_step(order, default)
+        if not self.healthy:
+            step["outcome"] = "failed"
+        if step["latency"]:
+            await asyncio.sleep(step["latency"])
+        if step["outcome"] == "failed":
+            return web.Response(status=503, text="Service Unavailable")
+        if step["outcome"] == "error":
+            return self._text({"errorCode": self.error_code})
+        base = {
+            "Ds_Order": order,
+            "Ds_MerchantCode": merchant["Ds_Merchant_MerchantCode"],
+            "Ds_Terminal": merchant["Ds_Merchant_Terminal"],
+            "Ds_TransactionType": merchant["Ds_Merchant_TransactionType"],
+        }
+        return self._signed(order, build(step["outcome"], merchant, base))
+
+    async def inicia_peticion(self, request: web.Request) -> web.Response:
+        def build(outcome, merchant, base):
+            emv3ds = {
+                "protocolVersion": "2.2.0",
+                "threeDSServerTransID": str(uuid.uuid4()),
+                "threeDSInfo": "CardConfiguration",
+            }
+            if outcome == "method":
+                emv3ds["threeDSMethodURL"] = f"{self.acs_url}/3dsmethod"
+            return dict(base, Ds_EMV3DS=emv3ds)
+
+        return await self._respond(request, "card_data", build)
+
+    async def trata_peticion(self, request: web.Request) -> web.Response:
+        def build(outcome, merchant, base):
+            if outcome == "challenge":
+                return {
+                    "Ds_EMV3DS": {
+                        "threeDSInfo": "ChallengeRequest",
+                        "protocolVersion": "2.2.0",
+                        "acsURL": "https://acs.example.com/challenge",
+                        "creq": "eyJtZXNzYWdlVHlwZSI6IkNSZXEifQ",
+                    }
+                }
+            transaction_type = merchant["Ds_Merchant_TransactionType"]
+            if outcome == "denied":
+                response = "0190"
+            else:
+                response = _AUTHORIZED_RESPONSES.get(transaction_type, "0000")
+            result = dict(
+                base,
+                Ds_Amount=merchant["Ds_Merchant_Amount"],
+                Ds_Currency=merchant.get("Ds_Merchant_Currency", "978"),
+                Ds_Response=response,
+                Ds_AuthorisationCode="123456" if response != "0190" else None,
+                Ds_SecurePayment="2",
+                Ds_Card_Brand="1",
+                Ds_Card_Country="724",
+            )
+            if merchant.get("Ds_Merchant_Identifier") == "REQUIRED":
+                result["Ds_Merchant_Identifier"] = uuid.uuid4().hex
+                result["Ds_ExpiryDate"] = merchant.get("Ds_Merchant_ExpiryDate")
+            return result
+
+        return await self._respond(request, "authorized", build)
+
+    async def set_scenario(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        for step in payload["steps"]:
+            if step.get("outcome") not in OUTCOMES:
+                raise web.HTTPBadRequest(text=f"Unknown outcome {step.get('outcome')}")
+        self._scenarios[payload["order"]].extend(payload["steps"])
+        return web.json_response({"queued": len(self._scenarios[payload["order"]])})
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {"healthy": self.healthy}, status=200 if self.healthy else 503
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8181)
+    parser.add_argument("--secret-key", default="sq7HjrUOBfKmC576ILgskD5srU870gJ7")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--acs-url", default="https://acs.example.com")
+    args = parser.parse_args()
+    simulator = RedsysSimulator(
+        args.secret_key, latency=args.latency, acs_url=args.acs_url
+    )
+    web.run_app(simulator.app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+from guillotina.contrib.redis import get_driver
+from guillotina_redsys import keys
+from guillotina_redsys.events import RedsysEvent
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import asyncio
+import logging
+import time
+import uuid
+
+
+logger = logging.getLogger("guillotina_redsys")
+
+FLOW_STATE_MARGIN = 60 * 60
+
+# flows end with these events
+_DONE_EVENT_TYPES = ("authorized", "denied", "error", "abandoned")
+
+# emitted by public services: they move flows already tracked forward but
+# never add an order to the index
+_PUBLIC_EVENT_TYPES = ("threeds_completed",)
+
+# Update the flow hash (KEYS[1]) and its TTL (ARGV[1]) with the field/value
+# pairs in ARGV[2..] only if the flow exists.
+_EXTEND_FLOW_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+# Take the lock if free, or extend it if we already hold it.
+_LEADER_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return 1
+end
+return 0
+"""
+
+# Pop at most ARGV[2] members whose due time (score) is <= ARGV[1].
+# Claiming and removing in one script keeps workers from taking the same
+# member twice.
+_CLAIM_DUE_SCRIPT = """
+local items = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #items > 0 then
+    redis.call('ZREM', KEYS[1], unpack(items))
+end
+return items
+"""
+
+
+class FlowSweeper:
+    """
+    Index of the 3DS flows in progress and sweeper of the abandoned ones.
+
+    Orders are kept in a Redis sorted set scored by deadline, moved forward
+    on every step of the flow and removed when it ends, next to a small fixed
+    size hash with the step and transaction id. Only the worker holding the
+    leader lock sweeps: expired orders are claimed in batches, their keys are
+    deleted and an ``abandoned`` event is emitted for each.
+    """
+
+    def __init__(
+        self,
+        utility,
+        *,
+        enabled: bool = False,
+        flow_ttl: int = 60 * 30,
+        interval: float = 30.0,
+        batch_size: int = 100,
+        lock_ttl: int = 60,
+    ) -> None:
+        self.utility = utility
+        self.enabled = enabled
+        self.flow_ttl = flow_ttl
+        self.interval = interval
+        self.batch_size = batch_size
+        self.lock_ttl = lock_ttl
+        self.worker_id = uuid.uuid4().hex
+
+    async def on_event(self, event: RedsysEvent) -> None:
+        try:
+            if event.type in _DONE_EVENT_TYPES:
+                await self.untrack(event.order)
+            else:
+                await self.track(
+                    event.order,
+                    event.transaction_id,
+                    event.type,
+                    extend_only=event.type in _PUBLIC_EVENT_TYPES,
+                )
+        except Exception:
+            logger.warning(f"Could not index flow {event.order}", exc_info=True)
+
+    async def track(
+        self,
+        order: str,
+        transaction_id: Optional[str],
+        step: str,
+        *,
+        extend_only: bool = False,
+    ) -> None:
+        pool = (await get_driver()).pool
+        now = time.time()
+        deadline = now + self.flow_ttl
+        key = keys.flow(order)
+        mapping = {"step": step, "updated_at": str(now)}
+        if transaction_id:
+            mapping["transaction_id"] = transaction_id
+        # one round trip on the payment path; the index is in another slot,
+        # so no MULTI
+        pipe = pool.pipeline(transaction=False)
+        # outlive the deadline so the sweeper still finds it
+        ttl = self.flow_ttl + FLOW_STATE_MARGIN
+        if extend_only:
+            fields = [item for pair in mapping.items() for item in pair]
+            pipe.eval(_EXTEND_FLOW_SCRIPT, 1, key, ttl, *fields)
+        else:
+            pipe.hsetnx(key, "started_at", str(now))
+            pipe.hset(key, mapping=mapping)
+            pipe.expire(key, ttl)
+        pipe.zadd(keys.inflight_index(), {order: deadline}, xx=extend_only)
+        await pipe.execute()
+
+    async def untrack(self, order: str) -> None:
+        pool = (await get_driver()).pool
+        pipe = pool.pipeline(transaction=False)
+        pipe.zrem(keys.inflight_index(), order)
+        pipe.delete(keys.flow(order))
+        await pipe.execute()
+
+    async def get_flow(self, order: str) -> Optional[Dict[str, str]]:
+        pool = (await get_driver()).pool
+        flow = await pool.hgetall(keys.flow(order))
+        if not flow:
+            return None
+        return {k.decode("utf-8"): v.decode("utf-8") for k, v in flow.items()}
+
+    async def list_inflight(self, offset: int = 0, limit: int = 100) -> Dict:
+        pool = (await get_driver()).pool
+        index = keys.inflight_index()
+        total = await pool.zcard(index)
+        items = await pool.zrange(index, offset, offset + limit - 1, withscores=True)
+        return {
+            "total": total,
+            "items": [
+                {"order": order.decode("utf-8"), "deadline": deadline}
+                for order, deadline in items
+            ],
+        }
+
+    async def acquire_leadership(self) -> bool:
+        pool = (await get_driver()).pool
+        held = await pool.eval(
+            _LEADER_SCRIPT,
+            1,
+            keys.sweeper_lock(),
+            self.worker_id,
+            self.lock_ttl * 1000,
+        )
+        return bool(held)
+
+    async def _abandon(self, order: str) -> None:
+        flow = await self.get_flow(order) or {}
+        transaction_id = flow.get("transaction_id")
+        pool = (await get_driver()).pool
+        to_delete = [keys.flow(order), keys.order_state(order)]
+        if transaction_id:
+            to_delete += [
+                keys.notification_3ds(order, transaction_id),
+                keys.notification_cres(order, transaction_id),
+                keys.challenge_context(order, transaction_id),
+                keys.challenge_claim(order, transaction_id),
+            ]
+        # all in the order hash tag slot
+        await pool.delete(*to_delete)
+        await self.utility.emit_event(
+            "abandoned",
+            order,
+            transaction_id,
+            step=flow.get("step"),
+            started_at=flow.get("started_at"),
+        )
+
+    async def sweep_once(self) -> int:
+        """
+        Expire one batch of abandoned flows. Returns how many were expired.
+        """
+        pool = (await get_driver()).pool
+        items: List[bytes] = await pool.eval(
+            _CLAIM_DUE_SCRIPT, 1, keys.inflight_index(), time.time(), self.batch_size
+        )
+        for item in items:
+            order = item.decode("utf-8")
+            try:
+                await self._abandon(order)
+            except Exception:
+                logger.warning(f"Error expiring flow {order}", exc_info=True)
+        return len(items)
+
+    async def run(self) -> None:
+        while True:
+            try:
+                if await self.acquire_leadership():
+                    while await self.sweep_once() >= self.batch_size:
+                        pass
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.error("Error sweeping redsys flows", exc_info=True)
+            await asyncio.sleep(self.interval)
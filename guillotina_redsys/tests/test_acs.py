@@ -0,0 +1,49 @@
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from guillotina_redsys.acs import AcsClient
+
+import pytest
+
+
+pytestmark = pytest.mark.asyncio
+
+
+async def _method_notification(request):
+    await request.read()
+    return web.json_response({"threeDSCompInd": "Y"})
+
+
+async def test_acs_client_keeps_a_bounded_set_of_warm_hosts():
+    servers = []
+    for _ in range(3):
+        app = web.Application()
+        app.router.add_post("/3dsmethod", _method_notification)
+        servers.append(TestServer(app))
+        await servers[-1].start_server()
+    urls = [str(server.make_url("/3dsmethod")) for server in servers]
+    client = AcsClient(max_hosts=2, per_host_limit=2)
+    try:
+        for url in urls[:2] + urls[:1]:
+            resp = await client.request("POST", url, json={"threeDSMethodData": "x"})
+            assert resp.json() == {"threeDSCompInd": "Y"}
+        hosts = client.status()["hosts"]
+        assert [host["requests"] for host in hosts] == [2, 1]
+        assert all(host["latency"] is not None for host in hosts)
+
+        # the least recently used host makes room
+        second = client._hosts[hosts[1]["host"]].session
+        await client.request("POST", urls[2])
+        assert [host["host"] for host in client.status()["hosts"]] == [
+            str(servers[2].make_url("")).rstrip("/"),
+            hosts[0]["host"],
+        ]
+        assert second.closed
+
+        # idle hosts are closed on the next request
+        client.idle_timeout = 0
+        await client.request("POST", urls[0])
+        assert len(client.status()["hosts"]) == 1
+    finally:
+        await client.close()
+        for server in servers:
+            await server.close()
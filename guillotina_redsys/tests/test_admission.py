@@ -0,0 +1,58 @@
+from guillotina_redsys.admission import AdmissionController
+from guillotina_redsys.admission import AdmissionRejected
+
+import asyncio
+import pytest
+
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_admission_sheds_load():
+    admission = AdmissionController(
+        enabled=True, initial_limit=2, min_limit=1, target_latency=0.05
+    )
+    release = asyncio.Event()
+
+    async def call():
+        async with admission.admit("AuthenticationData"):
+            await release.wait()
+
+    tasks = [asyncio.create_task(call()) for _ in range(2)]
+    await asyncio.sleep(0)
+    with pytest.raises(AdmissionRejected) as exc:
+        async with admission.admit("AuthenticationData"):
+            pass
+    assert exc.value.retry_after == 1
+    # other operations have their own limit
+    async with admission.admit("CardData"):
+        pass
+
+    # answers slower than the target shrink the limit
+    await asyncio.sleep(0.1)
+    release.set()
+    await asyncio.gather(*tasks)
+    status = admission.status()["operations"]["AuthenticationData"]
+    assert status["limit"] == 1
+    assert (status["admitted"], status["rejected"], status["in_flight"]) == (2, 1, 0)
+
+    # and fast ones grow it back
+    async with admission.admit("AuthenticationData"):
+        pass
+    assert admission.status()["operations"]["AuthenticationData"]["limit"] == 2
+
+
+async def test_admission_decreases_once_per_burst():
+    admission = AdmissionController(
+        enabled=True, initial_limit=8, min_limit=1, target_latency=0.01, backoff=0.5
+    )
+
+    async def slow_call():
+        async with admission.admit("token"):
+            await asyncio.sleep(0.05)
+
+    await asyncio.gather(*[slow_call() for _ in range(8)])
+    assert admission.status()["operations"]["token"]["limit"] == 4
+    # a later slow call decreases again
+    await slow_call()
+    assert admission.status()["operations"]["token"]["limit"] == 2
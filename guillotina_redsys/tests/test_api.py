@@ -0,0 +1,251 @@
+from guillotina.component import get_utility
+from guillotina_redsys.interfaces import IRedsysUtility
+from guillotina_redsys.models import RedsysAuthResult
+
+import asyncio
+import json
+import pytest
+
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_api_rejects_invalid_requests(guillotina_redsys):
+    resp, status = await guillotina_redsys(
+        "POST",
+        "/db/guillotina/@initTransactionRedsys",
+        data=json.dumps(
+            {"amount": "12,49", "card": "4548-8100", "cvv": "123", "order_id": "A1"}
+        ),
+    )
+    assert status == 400
+    errors = {(tuple(e["path"]), e["validator"]) for e in resp["errors"]}
+    assert errors == {
+        (("amount",), "pattern"),
+        (("card",), "pattern"),
+        (("order_id",), "pattern"),
+        ((), "required"),
+    }
+    assert "'expiry_date' is a required property" in json.dumps(resp)
+    assert "4548-8100" not in json.dumps(resp)
+
+    for amount in (0, 12.49, "0.00", "12.345", "1e20"):
+        resp, status = await guillotina_redsys(
+            "POST",
+            "/db/guillotina/@tokenPaymentRedsys",
+            data=json.dumps(
+                {"amount": amount, "identifier": "token", "order_id": "0001ORDER"}
+            ),
+        )
+        assert status == 400
+        assert resp["errors"][0]["path"] == ["amount"]
+
+    resp, status = await guillotina_redsys(
+        "POST", "/db/guillotina/@initTransactionRedsys", data="{not json"
+    )
+    assert status == 400
+
+    resp, status = await guillotina_redsys(
+        "POST",
+        "/db/guillotina/@notificationRedsysChallenge/ORDER-1/trans-1",
+        data=json.dumps({"CRES": "x"}),
+    )
+    assert status == 400
+    assert resp["errors"][0]["in"] == "path"
+    assert resp["errors"][0]["path"] == ["order_id"]
+
+    # the models only take Y or N, anything else would be a 500
+    resp, status = await guillotina_redsys(
+        "POST",
+        "/db/guillotina/@initTrataPeticion",
+        data=json.dumps(
+            {
+                "transaction_id": "trans-1",
+                "protocol_version": "2.1.0",
+                "three_ds_comp_ind": "U",
+                "amount": "12.49",
+                "card": "4548810000000003",
+                "expiry_date": "4912",
+                "cvv": "123",
+                "order_id": "0001ORDER",
+            }
+        ),
+    )
+    assert status == 400
+    assert resp["errors"][0]["path"] == ["three_ds_comp_ind"]
+    assert resp["errors"][0]["validator"] == "enum"
+
+    resp, status = await guillotina_redsys(
+        "GET", "/db/guillotina/@redsysInFlight?limit=0"
+    )
+    assert status == 400
+    assert resp["errors"][0]["in"] == "query"
+
+    # BIN ranges are cached by their first bin_length digits
+    resp, status = await guillotina_redsys(
+        "GET", "/db/guillotina/@redsysBinHints?bin=454881"
+    )
+    assert status == 400
+    assert resp["errors"][0]["validator"] == "bin_length"
+    resp, status = await guillotina_redsys(
+        "GET", "/db/guillotina/@redsysBinHints?bin=4548x100"
+    )
+    assert status == 400
+    assert resp["errors"][0]["validator"] == "pattern"
+    resp, status = await guillotina_redsys(
+        "GET", "/db/guillotina/@redsysBinHints?bin=45488100"
+    )
+    assert (status, resp["protocolVersion"]) == (200, None)
+
+    # valid requests reach the service
+    resp, status = await guillotina_redsys(
+        "POST",
+        "/db/guillotina/@initThreeDS",
+        data=json.dumps({"transaction_id": "trans-1", "three_method_url": ""}),
+    )
+    assert status == 200
+    assert resp == {"threeDSCompInd": "N"}
+
+
+async def test_challenge_cres_is_authenticated_once(guillotina_redsys, redis_container):
+    utility = get_utility(IRedsysUtility)
+    calls = []
+
+    async def authenticate_cres(**kwargs):
+        calls.append(kwargs["cres"])
+        await asyncio.sleep(0.2)
+        return RedsysAuthResult(
+            Ds_Amount="1249",
+            Ds_Currency="978",
+            Ds_Order="ORDER0042",
+            Ds_MerchantCode="999008881",
+            Ds_Terminal="1",
+            Ds_Response="0000",
+            Ds_AuthorisationCode="123456",
+            Ds_TransactionType="0",
+            Ds_SecurePayment="2",
+            Ds_Card_Brand="1",
+            Ds_ProcessedPayMethod="78",
+        )
+
+    utility.authenticate_cres = authenticate_cres
+    try:
+        resp, status = await guillotina_redsys(
+            "POST",
+            "/db/guillotina/@notificationRedsysChallenge/ORDER0042/trans-1",
+            data=json.dumps({"CRES": "CRES-1"}),
+            authenticated=False,
+        )
+        assert status == 200
+        body = json.dumps(
+            {
+                "amount": "12.49",
+                "card": "4548810000000003",
+                "expiry_date": "4912",
+                "cvv": "123",
+                "protocol_version": "2.1.0",
+            }
+        )
+        url = "/db/guillotina/@performNotificationRedsysChallenge/ORDER0042/trans-1"
+        responses = await asyncio.gather(
+            *[
+                guillotina_redsys("POST", url, data=body, authenticated=False)
+                for _ in range(3)
+            ]
+        )
+        resp, status = await guillotina_redsys(
+            "POST", url, data=body, authenticated=False
+        )
+    finally:
+        del utility.authenticate_cres
+    assert calls == ["CRES-1"]
+    assert {status for _, status in responses} == {200}
+    assert [resp["Ds_Response"] for resp, _ in responses] == ["0000"] * 3
+    assert resp["Ds_AuthorisationCode"] == "123456"
+
+
+async def test_challenge_cres_survives_a_dead_claimer(
+    guillotina_redsys, redis_container
+):
+    utility = get_utility(IRedsysUtility)
+    ttl = utility.challenge_claim_ttl
+    utility.challenge_claim_ttl = 0.2
+    calls = []
+
+    async def authenticate(cres):
+        calls.append(cres)
+        return RedsysAuthResult(
+            Ds_Amount="1249",
+            Ds_Currency="978",
+            Ds_Order="ORDER0043",
+            Ds_MerchantCode="999008881",
+            Ds_Terminal="1",
+            Ds_Response="0000",
+            Ds_TransactionType="0",
+        )
+
+    try:
+        resp, status = await guillotina_redsys(
+            "POST",
+            "/db/guillotina/@notificationRedsysChallenge/ORDER0043/trans-1",
+            data=json.dumps({"CRES": "CRES-2"}),
+            authenticated=False,
+        )
+        # a worker claims the CRES and dies before storing a result
+        state, _ = await utility._claim_cres("ORDER0043", "trans-1", "dead")
+        assert state == "cres"
+        await asyncio.sleep(0.25)
+        result = await utility.authenticate_challenge_once(
+            "ORDER0043", "trans-1", authenticate
+        )
+    finally:
+        utility.challenge_claim_ttl = ttl
+    assert calls == ["CRES-2"]
+    assert result["Ds_Response"] == "0000"
+
+
+async def test_challenge_completed_on_the_server(guillotina_redsys, redis_container):
+    utility = get_utility(IRedsysUtility)
+    url = "/db/guillotina/@getResultRedsysChallenge/ORDER0044/trans-1"
+
+    async def authenticate_cres_session(*args, **kwargs):
+        raise ConnectionError()
+
+    utility.authenticate_cres_session = authenticate_cres_session
+    try:
+        await utility._store_challenge_context(
+            "ORDER0044", "trans-1", {"session_token": "x", "protocol_version": "2.1.0"}
+        )
+        await guillotina_redsys(
+            "POST",
+            "/db/guillotina/@notificationRedsysChallenge/ORDER0044/trans-1",
+            data=json.dumps({"CRES": "CRES-3"}),
+            authenticated=False,
+        )
+        await utility.complete_challenge("ORDER0044", "trans-1")
+    finally:
+        del utility.authenticate_cres_session
+    # the poller gets an error instead of null forever
+    resp, status = await guillotina_redsys("GET", url, authenticated=False)
+    assert (status, resp["errorCode"]) == (200, "ERROR")
+
+    # the card on file token is not public
+    await utility.store_challenge_result(
+        "ORDER0044",
+        "trans-2",
+        RedsysAuthResult(
+            Ds_Amount="1249",
+            Ds_Currency="978",
+            Ds_Order="ORDER0044",
+            Ds_MerchantCode="999008881",
+            Ds_Terminal="1",
+            Ds_Response="0000",
+            Ds_TransactionType="0",
+            Ds_Merchant_Identifier="a1b2c3",
+        ),
+    )
+    resp, status = await guillotina_redsys(
+        "GET", url.replace("trans-1", "trans-2"), authenticated=False
+    )
+    assert resp["Ds_Response"] == "0000"
+    assert "Ds_Merchant_Identifier" not in resp
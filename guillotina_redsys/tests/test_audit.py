@@ -0,0 +1,82 @@
+from decimal import Decimal
+from guillotina_redsys.audit import AuditRecorder
+from guillotina_redsys.models import RedsysForm
+from guillotina_redsys.models import RedsysMerchantParams
+from guillotina_redsys.utils import mask_card_data
+
+import asyncio
+import json
+import pytest
+
+
+pytestmark = pytest.mark.asyncio
+
+SECRET_KEY = "sq7HjrUOBfKmC576ILgskD5srU870gJ7"
+
+
+def _signed_form():
+    merchant = RedsysMerchantParams.from_euros(
+        amount_eur=Decimal("12.49"),
+        order="ABCD1234",
+        merchant_code="999008881",
+        pan="4548810000000003",
+        expiry_date="4912",
+        cvv2="123",
+        identifier="a1b2c3d4e5f6g7h8",
+    )
+    return RedsysForm.from_merchant(merchant, SECRET_KEY).dict()
+
+
+def test_mask_card_data():
+    masked = mask_card_data(_signed_form())
+    serialized = json.dumps(masked)
+    assert "4548810000000003" not in serialized
+    assert "4912" not in serialized
+    params = masked["Ds_MerchantParameters"]
+    assert params["Ds_Merchant_Pan"] == "454881******0003"
+    assert params["Ds_Merchant_CVV2"] == "***"
+    assert params["Ds_Merchant_ExpiryDate"] == "****"
+    assert params["Ds_Merchant_Identifier"] == "************g7h8"
+    assert params["Ds_Merchant_Order"] == "ABCD1234"
+    assert mask_card_data({"Ds_Merchant_Identifier": "REQUIRED"}) == {
+        "Ds_Merchant_Identifier": "REQUIRED"
+    }
+
+
+async def test_audit_ring_buffer(guillotina_redsys, redis_container):
+    recorder = AuditRecorder(enabled=True, maxlen=100, stream="test_redsys_audit")
+    form = _signed_form()
+    recorder.record("/trataPeticionREST", "ABCD1234", form, {"errorCode": "X"}, 0.1)
+    recorder.record(
+        "/trataPeticionREST", "ABCD1234", form, None, 0.2, error="Timeout()"
+    )
+    for _ in range(50):
+        if await recorder.query("ABCD1234"):
+            break
+        await asyncio.sleep(0.05)
+    records = await recorder.query("ABCD1234")
+    await recorder.close()
+
+    assert [r["duration"] for r in records] == [0.1, 0.2]
+    assert records[1]["error"] == "Timeout()"
+    assert "4548810000000003" not in json.dumps(records)
+    assert await recorder.query("OTHER") == []
+
+
+async def test_audit_close_writes_queued_records(guillotina_redsys, redis_container):
+    recorder = AuditRecorder(enabled=True, maxlen=100, stream="test_redsys_audit")
+    for idx in range(20):
+        recorder.record("/trataPeticionREST", "CLOSE001", {}, None, idx)
+    await recorder.close()
+    assert len(await recorder.query("CLOSE001")) == 20
+    assert recorder.dropped == 0
+
+    # a writer that can not keep up does not block the close
+    async def write(records):
+        await asyncio.sleep(10)
+
+    recorder = AuditRecorder(enabled=True, close_timeout=0.1)
+    recorder._write = write
+    for idx in range(3):
+        recorder.record("/trataPeticionREST", "CLOSE002", {}, None, idx)
+    await asyncio.wait_for(recorder.close(), 1)
@@ -0,0 +1,48 @@
+from guillotina.contrib.redis import get_driver
+from guillotina_redsys import metrics
+from guillotina_redsys.batching import RedisReadBatcher
+
+import asyncio
+import pytest
+
+
+pytestmark = pytest.mark.asyncio
+
+
+def test_histogram_status():
+    histogram = metrics.Histogram(
+        "redsys_test_histogram", "Test", buckets=(1, 10), labels=("kind",)
+    )
+    for value in (1, 5, 50):
+        histogram.observe(value, kind="a")
+    [values] = histogram.status()["values"]
+    assert values["labels"] == {"kind": "a"}
+    assert values["buckets"] == {"1": 1, "10": 1, "+Inf": 1}
+    assert values["count"] == 3
+    assert values["sum"] == 56
+    assert "redsys_test_histogram" in metrics.status()
+
+
+async def test_read_batcher(guillotina_redsys, redis_container):
+    redis_driver = await get_driver()
+    for idx in range(3):
+        await redis_driver.set(key=f"batch-test-{idx}", data=str(idx).encode())
+    batcher = RedisReadBatcher(enabled=True, window=0.01, max_batch=100)
+    before = metrics.REDIS_READ_BATCH_SIZE.status()["values"]
+    calls = before[0]["count"] if before else 0
+
+    keys = [f"batch-test-{idx % 4}" for idx in range(10)]
+    values = await asyncio.gather(*[batcher.get(key) for key in keys])
+    assert values == [b"0", b"1", b"2", None] * 2 + [b"0", b"1"]
+    [after] = metrics.REDIS_READ_BATCH_SIZE.status()["values"]
+    # one pipeline with the 4 distinct keys
+    assert after["count"] == calls + 1
+    assert after["buckets"]["5"] >= 1
+
+    # a full batch does not wait for the window
+    batcher = RedisReadBatcher(enabled=True, window=10, max_batch=2)
+    values = await asyncio.wait_for(
+        asyncio.gather(batcher.get("batch-test-0"), batcher.get("batch-test-1")), 1
+    )
+    assert values == [b"0", b"1"]
+    await batcher.close()
@@ -0,0 +1,222 @@
+from guillotina.contrib.redis import get_driver
+from guillotina_redsys import keys
+from guillotina_redsys.admission import AdmissionRejected
+from guillotina_redsys.billing import BillingRuns
+from guillotina_redsys.billing import ShardLost
+from guillotina_redsys.models import RedsysAuthResult
+from guillotina_redsys.models import RedsysErrorResponse
+
+import asyncio
+import json
+import pytest
+import time
+
+
+pytestmark = pytest.mark.asyncio
+
+
+class FakeUtility:
+    def __init__(self):
+        self.calls = []
+        self.rejected = False
+
+    async def token_payment(
+        self, amount, identifier, order, cof_txnid=None, currency=978
+    ):
+        await asyncio.sleep(0)
+        if not self.rejected:
+            self.rejected = True
+            raise AdmissionRejected("token", 0)
+        self.calls.append(order)
+        if order.endswith("E"):
+            return RedsysErrorResponse(errorCode="SIS0063")
+        return RedsysAuthResult(
+            Ds_Amount=str(int(amount * 100)),
+            Ds_Currency=str(currency),
+            Ds_Order=order,
+            Ds_MerchantCode="999008881",
+            Ds_Terminal="1",
+            Ds_Response="0190" if order.endswith("D") else "0000",
+            Ds_TransactionType="0",
+        )
+
+
+def _charges(count):
+    for idx in range(count):
+        yield {
+            "order": f"{idx:04d}BILL" + "ADE"[idx % 3],
+            "identifier": "token",
+            "amount": "10.50",
+        }
+
+
+async def test_billing_run_is_shared_by_workers(guillotina_redsys, redis_container):
+    utility = FakeUtility()
+    nodes = [
+        BillingRuns(utility, shard_size=10, concurrency=3, checkpoint_every=4)
+        for _ in range(2)
+    ]
+    run_id = await nodes[0].create(_charges(25))
+    assert (await nodes[0].get_run(run_id))["shards"] == 3
+
+    async def drain(node):
+        while await node.run_once():
+            pass
+
+    await asyncio.gather(*[drain(node) for node in nodes])
+    # every charge once, the rejected one repeated
+    assert sorted(utility.calls) == sorted(charge["order"] for charge in _charges(25))
+    run = await nodes[1].get_run(run_id)
+    assert run["status"] == "finished"
+    assert run["processed"] == 25
+    assert run["authorized"] == 9
+    assert run["authorized_cents"] == 9 * 1050
+    assert run["denied"] == 8
+    assert run["errors"] == {"SIS0063": 8}
+
+
+async def test_billing_shards_wait_for_the_run_header(
+    guillotina_redsys, redis_container
+):
+    utility = FakeUtility()
+    utility.rejected = True
+    worker = BillingRuns(utility, shard_size=10)
+
+    class EagerWorkers(BillingRuns):
+        async def _store_shard(self, pool, run_id, shard, charges):
+            await super()._store_shard(pool, run_id, shard, charges)
+            # another node charges whatever is queued while create runs
+            claimed = await worker._claim_shard(run_id)
+            while claimed is not None:
+                await worker.process_shard(run_id, *claimed)
+                claimed = await worker._claim_shard(run_id)
+
+    node = EagerWorkers(utility, shard_size=10)
+    run_id = await node.create(_charges(25))
+    assert utility.calls == []
+    while await worker.run_once():
+        pass
+    run = await node.get_run(run_id)
+    assert (run["status"], run["shards_done"], run["processed"]) == ("finished", 3, 25)
+
+
+async def test_billing_shard_resumes_from_checkpoint(
+    guillotina_redsys, redis_container
+):
+    utility = FakeUtility()
+    utility.rejected = True
+    dead = BillingRuns(utility, shard_size=10, lease_ttl=0)
+    alive = BillingRuns(utility, shard_size=10)
+    run_id = await dead.create(_charges(10))
+    run_id_, shard, checkpoint = await dead._claim()
+    assert (run_id_, shard, checkpoint) == (run_id, 0, "")
+    orders = [charge["order"] for charge in _charges(10)]
+    # before the worker died: the first four charges and the sixth
+    # checkpointed, the eighth done after the checkpoint, the seventh in flight
+    for idx in (0, 1, 2, 3, 5, 7):
+        assert await dead._reserve(run_id, 0, orders[idx]) == 1
+        await dead._record(run_id, orders[idx], "authorized", 1050)
+    await dead._checkpoint(run_id, 0, '{"position": 4, "done": [5]}')
+    assert await dead._reserve(run_id, 0, orders[6]) == 1
+
+    assert await alive.run_once()
+    assert sorted(utility.calls) == sorted(orders[idx] for idx in (4, 8, 9))
+    run = await alive.get_run(run_id)
+    assert (run["status"], run["processed"]) == ("finished", 9)
+    # the dead worker can not write over it
+    with pytest.raises(ShardLost):
+        await dead._checkpoint(run_id, 0, "")
+    assert await dead._reserve(run_id, 0, orders[4]) == -1
+
+
+async def test_billing_worker_stops_when_the_lease_is_lost(
+    guillotina_redsys, redis_container
+):
+    utility = FakeUtility()
+    utility.rejected = True
+    node = BillingRuns(utility, shard_size=10, concurrency=2, checkpoint_every=100)
+    thief = BillingRuns(utility, shard_size=10)
+    run_id = await node.create(_charges(10))
+    _, shard, checkpoint = await node._claim()
+    token_payment = utility.token_payment
+
+    async def steal_lease(*args, **kwargs):
+        if len(utility.calls) == 2:
+            # the lease expired and another worker took the shard
+            pool = (await get_driver()).pool
+            await pool.hset(
+                keys.billing_shards(run_id), f"{shard}:owner", thief.worker_id
+            )
+        return await token_payment(*args, **kwargs)
+
+    utility.token_payment = steal_lease
+    with pytest.raises(ShardLost):
+        await node.process_shard(run_id, shard, checkpoint)
+    charged = len(utility.calls)
+    assert charged < 10
+    # the charges sent before the loss are counted
+    assert (await node.get_run(run_id))["processed"] == charged
+
+    await thief.process_shard(run_id, shard, "")
+    assert sorted(utility.calls) == sorted(charge["order"] for charge in _charges(10))
+    run = await thief.get_run(run_id)
+    assert (run["status"], run["processed"]) == ("finished", 10)
+
+
+async def test_billing_lease_is_renewed_while_charging(
+    guillotina_redsys, redis_container
+):
+    utility = FakeUtility()
+    utility.rejected = True
+    node = BillingRuns(utility, shard_size=10, concurrency=1, lease_ttl=0.3)
+    run_id = await node.create(_charges(2))
+    _, shard, checkpoint = await node._claim()
+    token_payment = utility.token_payment
+
+    async def slow_payment(*args, **kwargs):
+        await asyncio.sleep(0.25)
+        return await token_payment(*args, **kwargs)
+
+    utility.token_payment = slow_payment
+    task = asyncio.create_task(node.process_shard(run_id, shard, checkpoint))
+    await asyncio.sleep(0.4)
+    pool = (await get_driver()).pool
+    # no checkpoint was due yet, the lease is still held
+    assert await pool.zscore(keys.billing_queue(run_id), str(shard)) > time.time()
+    await task
+    assert (await node.get_run(run_id))["status"] == "finished"
+
+
+async def test_billing_run_services(guillotina_redsys, redis_container):
+    resp, status = await guillotina_redsys(
+        "POST",
+        "/db/guillotina/@redsysBillingRuns",
+        data=json.dumps({"run_id": "run-api", "charges": list(_charges(3))}),
+    )
+    assert status == 200
+    assert resp["run_id"] == "run-api"
+    assert resp["charges"] == 3
+    assert resp["status"] == "running"
+
+    resp, status = await guillotina_redsys(
+        "GET", "/db/guillotina/@redsysBillingRuns/run-api"
+    )
+    assert status == 200
+    assert resp["shards"] == 1
+
+    # the same run again would charge every order twice
+    resp, status = await guillotina_redsys(
+        "POST",
+        "/db/guillotina/@redsysBillingRuns",
+        data=json.dumps({"run_id": "run-api", "charges": list(_charges(3))}),
+    )
+    assert status == 409
+    resp, status = await guillotina_redsys(
+        "GET", "/db/guillotina/@redsysBillingRuns/run-api"
+    )
+    assert resp["charges"] == 3
+
+    resp, status = await guillotina_redsys(
+        "GET", "/db/guillotina/@redsysBillingRuns/missing"
+    )
+    assert status == 404
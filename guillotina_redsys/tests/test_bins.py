@@ -0,0 +1,86 @@
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from decimal import Decimal
+from guillotina_redsys.acs import ACS_PRECONNECTS
+from guillotina_redsys.bins import BinCache
+from guillotina_redsys.simulator import RedsysSimulator
+from guillotina_redsys.utility import RedsysUtility
+
+import asyncio
+import pytest
+
+
+pytestmark = pytest.mark.asyncio
+
+SECRET_KEY = "sq7HjrUOBfKmC576ILgskD5srU870gJ7"
+CARD = "4548810000000003"
+
+
+async def test_bin_cache():
+    cache = BinCache(enabled=True, bin_length=8, max_size=2)
+    cache.put(CARD, "2.2.0", "https://acs.example.com/3dsmethod")
+    info = cache.get("45488100")
+    assert info.hints() == {
+        "protocolVersion": "2.2.0",
+        "threeDSMethodURL": "https://acs.example.com/3dsmethod",
+        "preconnect": "https://acs.example.com",
+    }
+    assert cache.get("454881") is None
+
+    # the least recently used range makes room
+    cache.put("4000000000000002", "2.1.0", None)
+    cache.put("5000000000000009", "2.1.0", None)
+    assert cache.get(CARD) is None
+    assert cache.get("4000000000000002").acs_origin is None
+
+    cache.ttl = -1
+    cache.put(CARD, "2.2.0", None)
+    assert cache.get(CARD) is None
+
+
+async def test_cached_bin_preconnects_to_acs():
+    acs_app = web.Application()
+    acs = TestServer(acs_app)
+    await acs.start_server()
+    simulator = RedsysSimulator(SECRET_KEY, acs_url=str(acs.make_url("")).rstrip("/"))
+    server = TestServer(simulator.app)
+    await server.start_server()
+    utility = RedsysUtility(
+        {
+            "terminal": "001",
+            "secret_key": SECRET_KEY,
+            "merchant_code": "999008881",
+            "url_redsys": str(server.make_url("")).rstrip("/"),
+            "container_url": "http://localhost:8080/db/guillotina",
+            "bin_cache": {"enabled": True},
+        }
+    )
+    try:
+        simulator._scenarios["0001ORDER"].append({"outcome": "method"})
+        res = await utility.init_transaction(
+            Decimal("10"), CARD, "123", "4912", "0001ORDER"
+        )
+        assert not utility._preconnects
+        assert utility.bin_hints(CARD[:8]).method_url == res.Ds_EMV3DS.threeDSMethodURL
+        # hints never reach the ACS from the server
+        assert not utility._preconnects
+
+        origin = utility.bins.get(CARD).acs_origin
+        simulator._scenarios["0002ORDER"].append({"outcome": "method"})
+        await utility.init_transaction(Decimal("10"), CARD, "123", "4912", "0002ORDER")
+        await asyncio.gather(*utility._preconnects)
+        assert [host["host"] for host in utility.acs.status()["hosts"]] == [origin]
+
+        # the host is warm already
+        await utility.init_transaction(Decimal("10"), CARD, "123", "4912", "0003ORDER")
+        await asyncio.gather(*utility._preconnects)
+        results = {
+            v["labels"]["result"]: v["value"]
+            for v in ACS_PRECONNECTS.status()["values"]
+        }
+        assert results["connected"] >= 1
+        assert results["warm"] >= 1
+    finally:
+        await utility.finalize()
+        await server.close()
+        await acs.close()
@@ -0,0 +1,115 @@
+from decimal import Decimal
+from guillotina.component import get_utility
+from guillotina.contrib.redis import get_driver
+from guillotina_redsys.checkout import CheckoutSessionNotFound
+from guillotina_redsys.checkout import CheckoutSessions
+from guillotina_redsys.interfaces import IRedsysUtility
+from guillotina_redsys.models import RedsysEMV3DS
+from guillotina_redsys.models import RedsysMerchantParams
+
+import json
+import pytest
+
+
+pytestmark = pytest.mark.asyncio
+
+SECRET_KEY = "sq7HjrUOBfKmC576ILgskD5srU870gJ7"
+
+
+def _merchant(**kwargs):
+    return RedsysMerchantParams.from_euros(
+        amount_eur=Decimal("12.49"),
+        order="ABCD1234",
+        merchant_code="999008881",
+        pan="4548810000000003",
+        expiry_date="4912",
+        cvv2="123",
+        **kwargs,
+    )
+
+
+async def test_checkout_sessions(guillotina_redsys, redis_container):
+    sessions = CheckoutSessions(SECRET_KEY, enabled=True, ttl=60)
+    token = await sessions.create(
+        _merchant(emv3ds=RedsysEMV3DS(threeDSInfo="CardData"), excep_sca="Y")
+    )
+
+    # only a hash of the token and encrypted data reach Redis
+    stored = await (await get_driver()).get(sessions._key(token))
+    assert stored is not None
+    assert b"4548810000000003" not in stored
+    assert token.encode("utf-8") not in sessions._key(token).encode("utf-8")
+
+    session = await sessions.get(token, "ABCD1234")
+    emv3ds = RedsysEMV3DS(threeDSInfo="ChallengeResponse", cres="CRES")
+    assert (
+        session.merchant_params(Ds_Merchant_EMV3DS=emv3ds).to_redsys_dict()
+        == _merchant(emv3ds=emv3ds).to_redsys_dict()
+    )
+
+    with pytest.raises(CheckoutSessionNotFound):
+        await sessions.get(token, "OTHER123")
+    await sessions.delete(token)
+    with pytest.raises(CheckoutSessionNotFound):
+        await sessions.get(token)
+
+
+async def test_trata_peticion_with_session_token(guillotina_redsys, redis_container):
+    utility = get_utility(IRedsysUtility)
+    token = await utility.checkout.create(_merchant())
+    sent = []
+
+    async def post_redsys(path, merchant):
+        sent.append(merchant.to_redsys_dict())
+        return {"Ds_EMV3DS": {"threeDSInfo": "ChallengeRequest", "acsURL": "x"}}
+
+    utility._post_redsys = post_redsys
+    try:
+        resp, status = await guillotina_redsys(
+            "POST",
+            "/db/guillotina/@initTrataPeticion",
+            data=json.dumps(
+                {
+                    "session_token": token,
+                    "transaction_id": "trans-1",
+                    "protocol_version": "2.1.0",
+                    "three_ds_comp_ind": "Y",
+                }
+            ),
+        )
+        assert status == 200
+        assert resp["threeDSInfo"] == "ChallengeRequest"
+        assert sent[0]["Ds_Merchant_Pan"] == "4548810000000003"
+        assert sent[0]["Ds_Merchant_Amount"] == "1249"
+        assert sent[0]["Ds_Merchant_EMV3DS"]["threeDSInfo"] == "AuthenticationData"
+
+        # the session belongs to another order
+        await guillotina_redsys(
+            "POST",
+            "/db/guillotina/@notificationRedsysChallenge/OTHER123/trans-1",
+            data=json.dumps({"CRES": "CRES"}),
+            authenticated=False,
+        )
+        resp, status = await guillotina_redsys(
+            "POST",
+            "/db/guillotina/@performNotificationRedsysChallenge/OTHER123/trans-1",
+            data=json.dumps({"session_token": token, "protocol_version": "2.1.0"}),
+        )
+        assert status == 404
+
+        resp, status = await guillotina_redsys(
+            "POST",
+            "/db/guillotina/@initTrataPeticion",
+            data=json.dumps(
+                {
+                    "session_token": "x" * 43,
+                    "transaction_id": "trans-1",
+                    "protocol_version": "2.1.0",
+                    "three_ds_comp_ind": "Y",
+                }
+            ),
+        )
+        assert status == 404
+        assert len(sent) == 1
+    finally:
+        del utility._post_redsys
@@ -0,0 +1,63 @@
+from aiohttp.test_utils import TestServer
+from decimal import Decimal
+from guillotina_redsys.simulator import RedsysSimulator
+from guillotina_redsys.utility import RedsysUtility
+
+import pytest
+
+
+pytestmark = pytest.mark.asyncio
+
+SECRET_KEY = "sq7HjrUOBfKmC576ILgskD5srU870gJ7"
+
+
+async def test_endpoints_failover_between_simulators():
+    primary, secondary = RedsysSimulator(SECRET_KEY), RedsysSimulator(SECRET_KEY)
+    servers = [TestServer(primary.app), TestServer(secondary.app)]
+    for server in servers:
+        await server.start_server()
+    urls = [str(server.make_url("")).rstrip("/") for server in servers]
+    utility = RedsysUtility(
+        {
+            "terminal": "001",
+            "secret_key": SECRET_KEY,
+            "merchant_code": "999008881",
+            "url_redsys": urls,
+            "container_url": "http://localhost:8080/db/guillotina",
+            "endpoints": {
+                "probe_path": "/_health",
+                "failure_threshold": 2,
+                "recovery_threshold": 2,
+                "switch_ratio": 100,
+            },
+        }
+    )
+    pool = utility.endpoints
+    try:
+        await pool.probe_once()
+        assert pool.active == urls[0]
+        await utility.token_payment(Decimal("10"), "token", "0001ORDER")
+        assert (primary.requests, secondary.requests) == (1, 0)
+
+        # one failed probe is not enough to move traffic
+        primary.healthy = False
+        await pool.probe_once()
+        assert pool.active == urls[0]
+        await pool.probe_once()
+        assert pool.active == urls[1]
+        assert pool.status()["endpoints"][0]["healthy"] is False
+        res = await utility.token_payment(Decimal("10"), "token", "0002ORDER")
+        assert res.is_authorized
+        assert (primary.requests, secondary.requests) == (1, 1)
+
+        # the primary recovers but traffic stays until the secondary fails
+        primary.healthy = True
+        await pool.probe_once()
+        await pool.probe_once()
+        assert pool.status()["endpoints"][0]["healthy"] is True
+        assert pool.active == urls[1]
+        assert pool.switches == 1
+    finally:
+        await utility.finalize()
+        for server in servers:
+            await server.close()
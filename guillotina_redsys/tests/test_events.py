@@ -0,0 +1,162 @@
+from guillotina.component import get_utility
+from guillotina.contrib.redis import get_driver
+from guillotina_redsys import keys
+from guillotina_redsys.events import EventEmitter
+from guillotina_redsys.events import RedsysEvent
+from guillotina_redsys.events import RedsysEventConsumer
+from guillotina_redsys.interfaces import IRedsysUtility
+from guillotina_redsys.push import OrderUpdatesHub
+
+import asyncio
+import pytest
+
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_events_consumer_group(guillotina_redsys, redis_container):
+    emitter = EventEmitter(enabled=True, stream="test_redsys_events", maxlen=100)
+    for order in ("ORDER0001", "ORDER0002", "ORDER0003"):
+        await emitter.emit(
+            RedsysEvent(type="authorized", order=order, data={"Ds_Response": "0000"})
+        )
+
+    received = []
+
+    async def handler(events):
+        received.extend(events)
+        if len(received) <= 3:
+            raise Exception("not acknowledged")
+
+    consumer = RedsysEventConsumer(
+        "fulfillment",
+        "worker-1",
+        handler,
+        stream="test_redsys_events",
+        block=10,
+        claim_idle=0,
+    )
+    await consumer.ensure_group()
+    with pytest.raises(Exception):
+        await consumer.process_batch()
+
+    # failed batch is still pending and gets redelivered
+    assert await consumer.reclaim() == 3
+    assert [e.order for e in received[3:]] == ["ORDER0001", "ORDER0002", "ORDER0003"]
+    assert await consumer.process_batch() == 0
+
+
+async def test_order_updates_hub(guillotina_redsys, redis_container):
+    hub = OrderUpdatesHub(enabled=True, channel="test_redsys_order_updates")
+    async with hub.subscribe("ORDER0001") as queue, hub.subscribe("ORDER0002") as other:
+        # subscribed once the context is entered, nothing is lost
+        await hub.publish(RedsysEvent(type="challenge_required", order="ORDER0001"))
+        await hub.publish(RedsysEvent(type="authorized", order="ORDER0001"))
+        first = await asyncio.wait_for(queue.get(), timeout=5)
+        second = await asyncio.wait_for(queue.get(), timeout=5)
+        assert [first.type, second.type] == ["challenge_required", "authorized"]
+        assert other.empty()
+        assert hub.subscriber_count() == 2
+
+    assert hub.subscriber_count() == 0
+    assert (await hub.last_event("ORDER0001")).type == "authorized"
+    await hub.close()
+
+
+async def _start(order, transaction_id="trans-1"):
+    redis_driver = await get_driver()
+    await redis_driver.set(
+        keys.order_state(order),
+        RedsysEvent(
+            type="transaction_started", order=order, transaction_id=transaction_id
+        ).to_json(),
+    )
+
+
+async def test_order_stream_ends(guillotina_redsys, redis_container):
+    utility = get_utility(IRedsysUtility)
+    push = utility.push
+    utility.push = OrderUpdatesHub(
+        enabled=True,
+        channel="test_redsys_order_updates",
+        keepalive=0.1,
+        max_stream_time=0.5,
+    )
+    url = "/db/guillotina/@streamRedsysOrder/{}?transaction_id=trans-1"
+    try:
+        # flow still running: closed after max_stream_time
+        await _start("ORDER0003")
+        resp, status = await guillotina_redsys(
+            "GET", url.format("ORDER0003"), authenticated=False
+        )
+        assert status == 200
+        assert b"event: transaction_started" in resp
+        assert b"event: authorized" not in resp
+
+        # final event stored but never received by the subscription
+        await _start("ORDER0004")
+
+        async def authorize():
+            await asyncio.sleep(0.2)
+            redis_driver = await get_driver()
+            await redis_driver.set(
+                keys.order_state("ORDER0004"),
+                RedsysEvent(
+                    type="authorized", order="ORDER0004", transaction_id="trans-1"
+                ).to_json(),
+            )
+
+        task = asyncio.create_task(authorize())
+        resp, status = await guillotina_redsys(
+            "GET", url.format("ORDER0004"), authenticated=False
+        )
+        await task
+        assert b"event: authorized" in resp
+    finally:
+        await utility.push.close()
+        utility.push = push
+
+
+async def test_order_stream_requires_the_flow(guillotina_redsys, redis_container):
+    utility = get_utility(IRedsysUtility)
+    push = utility.push
+    utility.push = OrderUpdatesHub(
+        enabled=True, channel="test_redsys_order_updates", max_stream_time=0.5
+    )
+    url = "/db/guillotina/@streamRedsysOrder/ORDER0005"
+    try:
+        await utility.push.publish(
+            RedsysEvent(
+                type="authorized",
+                order="ORDER0005",
+                transaction_id="trans-5",
+                data={"Ds_Response": "0000", "Ds_AuthorisationCode": "123456"},
+            )
+        )
+        resp, status = await guillotina_redsys("GET", url, authenticated=False)
+        assert status == 400
+        for query in (
+            "?transaction_id=trans-6",
+            "?session_token=" + "a" * 32,
+        ):
+            resp, status = await guillotina_redsys(
+                "GET", url + query, authenticated=False
+            )
+            assert status == 404
+        resp, status = await guillotina_redsys(
+            "GET",
+            url.replace("0005", "0006") + "?transaction_id=trans-5",
+            authenticated=False,
+        )
+        assert status == 404
+
+        resp, status = await guillotina_redsys(
+            "GET", url + "?transaction_id=trans-5", authenticated=False
+        )
+        assert status == 200
+        assert b"event: authorized" in resp
+        assert b"Ds_AuthorisationCode" not in resp
+        assert b"123456" not in resp
+    finally:
+        await utility.push.close()
+        utility.push = push
@@ -0,0 +1,52 @@
+from guillotina_redsys.endpoints import EndpointPool
+from guillotina_redsys.faults import FaultInjector
+from guillotina_redsys.retries import RetryPolicy
+from guillotina_redsys.transports import TransportConnectionError
+from guillotina_redsys.utils import HTTPServerError
+from guillotina_redsys.utils import RestAPI
+
+import json
+import pytest
+
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_fault_injection_rest_api():
+    faults = FaultInjector(
+        enabled=True,
+        rules=[
+            {"endpoint": "*/iniciaPeticionREST", "reset_rate": 1},
+            {"endpoint": "*/trataPeticionREST", "redsys_error_rate": 1},
+            {"endpoint": "*", "error_rate": 1, "error_burst": 3},
+        ],
+        seed=1,
+    )
+    endpoints = EndpointPool(["https://redsys.invalid/sis/rest"], failure_threshold=6)
+    api = RestAPI(
+        faults=faults,
+        endpoints=endpoints,
+        retry_policy=RetryPolicy(
+            classes={"connection": {"min_wait": 0, "max_wait": 0}}
+        ),
+    )
+    try:
+        # injected resets are retried like real ones
+        with pytest.raises(TransportConnectionError):
+            await api.post("/iniciaPeticionREST", json={})
+
+        response = await api.post("/trataPeticionREST", json={})
+        assert json.loads(response) == {"errorCode": "SIS0042"}
+
+        # the burst outlasts the retry policy
+        with pytest.raises(HTTPServerError):
+            await api.post("/other", json={})
+        assert faults.injected == {"reset": 3, "redsys_error": 1, "server_error": 3}
+        # and every injected reset and 5xx is an endpoint failure
+        health = endpoints.status()["endpoints"][0]
+        assert health["consecutive_failures"] == 6
+
+        faults.enabled = False
+        assert faults.after_response("x", "body") == "body"
+    finally:
+        await api.close()
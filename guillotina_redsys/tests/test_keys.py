@@ -0,0 +1,67 @@
+from guillotina.component import get_utility
+from guillotina.contrib.redis import get_driver
+from guillotina_redsys import keys
+from guillotina_redsys.interfaces import IRedsysUtility
+from redis.crc import key_slot
+
+import pytest
+
+
+def test_order_keys_share_slot():
+    order_keys = [
+        keys.notification_3ds("ABCD1234", "trans-1"),
+        keys.notification_cres("ABCD1234", "trans-1"),
+        keys.challenge_context("ABCD1234", "trans-1"),
+        keys.challenge_result("ABCD1234", "trans-1"),
+        keys.challenge_claim("ABCD1234", "trans-1"),
+        keys.order_state("ABCD1234"),
+        keys.preauth("ABCD1234"),
+        keys.audit_index("ABCD1234"),
+        keys.flow("ABCD1234"),
+    ]
+    assert keys.notification_3ds("ABCD1234", "trans-1") == (
+        "redsys:v1:{ABCD1234}:3ds:trans-1"
+    )
+    assert len(set(order_keys)) == len(order_keys)
+    assert {key_slot(key.encode("utf-8")) for key in order_keys} == {
+        key_slot(b"ABCD1234")
+    }
+
+
+def test_billing_run_keys_share_slot():
+    run_keys = [
+        keys.billing_run("run-1"),
+        keys.billing_queue("run-1"),
+        keys.billing_shards("run-1"),
+        keys.billing_shard("run-1", 0),
+        keys.billing_shard("run-1", 1),
+        keys.billing_results("run-1"),
+    ]
+    assert len(set(run_keys)) == len(run_keys)
+    assert {key_slot(key.encode("utf-8")) for key in run_keys} == {key_slot(b"run-1")}
+
+
+@pytest.mark.asyncio
+async def test_legacy_notification_keys_are_read(guillotina_redsys, redis_container):
+    # notifications stored by 1.0.0 right before an upgrade
+    pool = (await get_driver()).pool
+    await pool.set(keys.legacy_notification_3ds("LEGACY01", "trans-1"), b"Y", ex=60)
+    await pool.set(keys.legacy_notification_cres("LEGACY01", "trans-1"), b"CRES", ex=60)
+
+    resp, status = await guillotina_redsys(
+        "GET",
+        "/db/guillotina/@getnotificationRedsys3DS/LEGACY01/trans-1",
+        authenticated=False,
+    )
+    assert (status, resp) == (200, {"threeDSCompInd": "Y"})
+
+    utility = get_utility(IRedsysUtility)
+    assert await utility._claim_cres("LEGACY01", "trans-1", "token") == (
+        "cres",
+        b"CRES",
+    )
+    assert await pool.get(keys.legacy_notification_cres("LEGACY01", "trans-1")) is None
+    assert await utility._claim_cres("LEGACY01", "trans-1", "other") == (
+        "pending",
+        None,
+    )
@@ -5,14 +5,20 @@ from guillotina.interfaces import IDefaultLayer
 from guillotina.interfaces import IRequest
 from guillotina.tests.utils import make_mocked_request
 from guillotina_redsys.interfaces import IRedsysUtility
+from guillotina_redsys.models import parse_redsys_response
 from guillotina_redsys.models import RedsysAuthResult
 from guillotina_redsys.models import RedsysEMV3DSResponse
+from guillotina_redsys.models import RedsysErrorResponse
 from guillotina_redsys.models import RedsysForm
 from guillotina_redsys.models import RedsysMerchantParams
 from guillotina_redsys.tests.utils import generate_redsys_order_id
 from guillotina_redsys.utils import compute_redsys_signature
+from guillotina_redsys.utils import decode_redsys_merchant_parameters
+from guillotina_redsys.utils import decrypt_context
+from guillotina_redsys.utils import encrypt_context
 from zope.interface import alsoProvides
 
+import base64
 import json
 import pytest
 
@@ -103,6 +109,45 @@ async def test_models_responses():
     }
 
 
+def test_models_card_on_file():
+    params = RedsysMerchantParams.from_euros(
+        amount_eur=Decimal("9.99"),
+        merchant_code="123456789",
+        order="ABCD1235",
+        identifier="a3f1e2d4c5b6a7f8e9d0c1b2a3f4e5d6c7b8a9f0",
+        cof_ini="N",
+        cof_type="R",
+        cof_txnid="2203191234567",
+        excep_sca="MIT",
+        direct_payment="true",
+    )
+    payload = params.to_redsys_dict()
+    assert payload["Ds_Merchant_Identifier"] == (
+        "a3f1e2d4c5b6a7f8e9d0c1b2a3f4e5d6c7b8a9f0"
+    )
+    assert payload["Ds_Merchant_Cof_Ini"] == "N"
+    assert payload["Ds_Merchant_Cof_Type"] == "R"
+    assert payload["Ds_Merchant_Cof_Txnid"] == "2203191234567"
+    assert payload["Ds_Merchant_Excep_SCA"] == "MIT"
+    assert payload["Ds_Merchant_DirectPayment"] == "true"
+    assert "Ds_Merchant_Pan" not in payload
+
+    result = RedsysAuthResult(
+        Ds_Amount="999",
+        Ds_Currency="978",
+        Ds_Order="ABCD1235",
+        Ds_MerchantCode="123456789",
+        Ds_Terminal="1",
+        Ds_Response="0000",
+        Ds_TransactionType="0",
+        Ds_Merchant_Identifier="a3f1e2d4c5b6a7f8e9d0c1b2a3f4e5d6c7b8a9f0",
+        Ds_ExpiryDate="4912",
+        Ds_Merchant_Cof_Txnid="2203191234567",
+    )
+    assert result.is_authorized
+    assert result.has_card_token
+
+
 # Using sandbox from fixtures
 # https://pagosonline.redsys.es/desarrolladores-inicio/integrate-con-nosotros/tarjetas-y-entornos-de-prueba/
 
@@ -322,3 +367,27 @@ def test_compute_signature():
         result
         == "Vjo02eSWq249IeZZp3R-ArFnGLhKY0OuzDDlx1BuVtZDC2yhczA7_11uZhsYzLZBCMFAz8u8uzGDX3AErHKmmw"
     )
+
+
+def test_encrypted_context():
+    context = {"amount": "12.49", "card": "4548810000000003", "cvv": "123"}
+    token = encrypt_context("sq7HjrUOBfKmC576ILgskD5srU870gJ7", context)
+    assert "4548810000000003" not in token
+    assert decrypt_context("sq7HjrUOBfKmC576ILgskD5srU870gJ7", token) == context
+    with pytest.raises(ValueError):
+        decrypt_context("another key", token)
+
+
+def test_parse_redsys_response():
+    params = {"Ds_Order": "ABCD1234", "Ds_Response": "0000", "Ds_Card_Brand": "1>?"}
+    encoded = base64.urlsafe_b64encode(json.dumps(params).encode("utf-8"))
+    encoded = encoded.decode("ascii").rstrip("=")
+    body = json.dumps(
+        {"Ds_SignatureVersion": "HMAC_SHA512_V2", "Ds_MerchantParameters": encoded}
+    ).encode("utf-8")
+    assert parse_redsys_response(body) == params
+    assert decode_redsys_merchant_parameters(encoded.encode("ascii")) == params
+
+    error = parse_redsys_response(b'{"errorCode":"SIS0051"}')
+    assert isinstance(error, RedsysErrorResponse)
+    assert error.errorCode == "SIS0051"
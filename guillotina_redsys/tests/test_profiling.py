@@ -0,0 +1,31 @@
+from guillotina_redsys.profiling import SamplingProfiler
+
+import asyncio
+import marshal
+import pytest
+
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_sampling_profiler():
+    profiler = SamplingProfiler()
+
+    @profiler("work")
+    async def work():
+        await asyncio.sleep(0)
+        return sum(range(1000))
+
+    # disabled: nothing is recorded
+    assert await work() == 499500
+    assert profiler.names() == {}
+
+    profiler.configure(enabled=True, sample_rate=1)
+    for _ in range(3):
+        await work()
+    assert profiler.names() == {"work": 3}
+    assert "work" in profiler.report("work")
+    assert isinstance(marshal.loads(profiler.dump()), dict)
+
+    profiler.reset()
+    assert profiler.report() == ""
@@ -0,0 +1,137 @@
+from aiohttp.test_utils import TestServer
+from decimal import Decimal
+from guillotina.contrib.redis import get_driver
+from guillotina_redsys.ratelimit import Lease
+from guillotina_redsys.ratelimit import RATE_LIMIT_LEASES
+from guillotina_redsys.ratelimit import RateLimited
+from guillotina_redsys.ratelimit import TokenBucketLimiter
+from guillotina_redsys.simulator import RedsysSimulator
+from guillotina_redsys.utility import RedsysUtility
+
+import asyncio
+import pytest
+
+
+pytestmark = pytest.mark.asyncio
+
+SECRET_KEY = "sq7HjrUOBfKmC576ILgskD5srU870gJ7"
+
+
+def _leases(operation):
+    return {
+        v["labels"]["result"]: v["value"]
+        for v in RATE_LIMIT_LEASES.status()["values"]
+        if v["labels"]["operation"] == operation
+    }
+
+
+async def test_token_bucket_is_shared_and_leased(guillotina_redsys, redis_container):
+    # connected beforehand, max_wait only covers the wait for tokens
+    await get_driver()
+    # two workers of the same cluster
+    workers = [
+        TokenBucketLimiter(
+            enabled=True,
+            rate=10,
+            burst=10,
+            lease_size=5,
+            max_wait=0.05,
+            merchant_rate=100,
+            merchant_burst=100,
+        )
+        for _ in range(2)
+    ]
+    await asyncio.gather(
+        *[workers[idx % 2].acquire("999008881", "001", "rl-test") for idx in range(10)]
+    )
+    # 10 tokens in leases of 5: one Redis call per lease
+    assert _leases("rl-test") == {"granted": 2}
+
+    # the burst is spent, by either worker
+    with pytest.raises(RateLimited) as exc:
+        await workers[1].acquire("999008881", "001", "rl-test")
+    assert exc.value.retry_after == 1
+
+    # other terminals and operations have their own buckets
+    await workers[0].acquire("999008881", "002", "rl-test")
+    await workers[0].acquire("999008881", "001", "rl-other")
+
+    # refilled at ``rate`` tokens per second
+    worker = TokenBucketLimiter(
+        enabled=True,
+        rate=10,
+        burst=10,
+        lease_size=1,
+        max_wait=1,
+        merchant_rate=100,
+        merchant_burst=100,
+    )
+    await asyncio.wait_for(worker.acquire("999008881", "001", "rl-test"), 0.5)
+
+
+async def test_merchant_bucket_caps_every_operation(guillotina_redsys, redis_container):
+    limiter = TokenBucketLimiter(
+        enabled=True,
+        rate=10,
+        burst=10,
+        lease_size=1,
+        max_wait=0.05,
+        merchant_rate=1,
+        merchant_burst=3,
+    )
+    for operation in ("rl-m1", "rl-m2", "rl-m3"):
+        await limiter.acquire("999008882", "001", operation)
+    with pytest.raises(RateLimited):
+        await limiter.acquire("999008882", "002", "rl-m4")
+
+
+async def test_lock_wait_is_bounded_apart(guillotina_redsys, redis_container):
+    limiter = TokenBucketLimiter(enabled=True, max_wait=0.05, lock_timeout=0.05)
+    lease = limiter._leases.setdefault(("999008881", "001", "rl-lock"), Lease())
+    await lease.lock.acquire()
+    try:
+        with pytest.raises(RateLimited):
+            await asyncio.wait_for(limiter.acquire("999008881", "001", "rl-lock"), 1)
+    finally:
+        lease.lock.release()
+
+    # a slow refill of another call does not use up max_wait
+    limiter.lock_timeout = 1
+    await lease.lock.acquire()
+    asyncio.get_running_loop().call_later(0.1, lease.lock.release)
+    await asyncio.wait_for(limiter.acquire("999008881", "001", "rl-lock"), 1)
+
+
+async def test_rate_limited_calls_do_not_shrink_admission(
+    guillotina_redsys, redis_container
+):
+    simulator = RedsysSimulator(SECRET_KEY)
+    server = TestServer(simulator.app)
+    await server.start_server()
+    utility = RedsysUtility(
+        {
+            "terminal": "001",
+            "secret_key": SECRET_KEY,
+            "merchant_code": "999008881",
+            "url_redsys": str(server.make_url("")).rstrip("/"),
+            "container_url": "http://localhost:8080/db/guillotina",
+            "rate_limit": {
+                "enabled": True,
+                "rate": 1,
+                "burst": 1,
+                "lease_size": 1,
+                "max_wait": 0.05,
+                "operations": {"token": {"rate": 0.1, "burst": 1}},
+            },
+            "admission": {"enabled": True, "initial_limit": 10},
+        }
+    )
+    try:
+        await utility.token_payment(Decimal("10"), "token", "0001RATE")
+        with pytest.raises(RateLimited):
+            await utility.token_payment(Decimal("10"), "token", "0002RATE")
+        status = utility.admission.status()["operations"]["token"]
+        assert (status["admitted"], status["limit"]) == (1, 10)
+    finally:
+        await utility.finalize()
+        await server.close()
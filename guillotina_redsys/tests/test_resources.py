@@ -0,0 +1,83 @@
+from aiohttp.test_utils import TestServer
+from decimal import Decimal
+from guillotina_redsys.resources import no_leaks
+from guillotina_redsys.resources import resources
+from guillotina_redsys.simulator import RedsysSimulator
+from guillotina_redsys.utility import RedsysUtility
+
+import asyncio
+import pytest
+
+
+pytestmark = pytest.mark.asyncio
+
+SECRET_KEY = "sq7HjrUOBfKmC576ILgskD5srU870gJ7"
+
+
+async def test_finalize_releases_sessions_and_sockets():
+    simulator = RedsysSimulator(SECRET_KEY)
+    server = TestServer(simulator.app)
+    await server.start_server()
+    try:
+        async with no_leaks():
+            utility = RedsysUtility(
+                {
+                    "terminal": "001",
+                    "secret_key": SECRET_KEY,
+                    "merchant_code": "999008881",
+                    "url_redsys": str(server.make_url("")).rstrip("/"),
+                    "container_url": "http://localhost:8080/db/guillotina",
+                }
+            )
+            res = await utility.token_payment(Decimal("10"), "token", "0001ORDER")
+            assert res.is_authorized
+            assert resources.status()["sessions"] >= 1
+            await utility.finalize()
+    finally:
+        await server.close()
+
+
+async def test_no_leaks_fails_on_leaked_tasks_and_sessions():
+    with pytest.raises(AssertionError, match="1 tasks"):
+        async with no_leaks(grace=0.05):
+            task = asyncio.create_task(asyncio.sleep(10))
+    task.cancel()
+
+    with pytest.raises(AssertionError, match="1 sessions"):
+        async with no_leaks(grace=0.05):
+            utility = RedsysUtility(
+                {
+                    "terminal": "001",
+                    "secret_key": SECRET_KEY,
+                    "merchant_code": "999008881",
+                    "url_redsys": "http://localhost:1",
+                    "container_url": "http://localhost:8080/db/guillotina",
+                }
+            )
+    await utility.finalize()
+
+
+async def test_resources_services(guillotina_redsys):
+    resp, status = await guillotina_redsys("GET", "/db/guillotina/@redsysResources")
+    assert status == 200
+    assert resp["tasks"]["total"] >= 1
+    assert resp["tracemalloc"]["tracing"] is False
+
+    resp, status = await guillotina_redsys(
+        "POST", "/db/guillotina/@redsysResources?limit=5"
+    )
+    assert status == 200
+    assert resp["compared_to"] is None
+    assert len(resp["top"]) <= 5
+    resp, status = await guillotina_redsys("POST", "/db/guillotina/@redsysResources")
+    assert resp["snapshot"] == 2
+    # what the request allocated since tracing started
+    assert resp["top"] and all("size_diff" in stat for stat in resp["top"])
+
+    resp, status = await guillotina_redsys("DELETE", "/db/guillotina/@redsysResources")
+    assert resp["tracemalloc"] == {
+        "tracing": False,
+        "snapshots": 0,
+        "traced": None,
+        "peak": None,
+    }
@@ -0,0 +1,116 @@
+from aiohttp.test_utils import TestServer
+from decimal import Decimal
+from guillotina_redsys.models import RedsysErrorResponse
+from guillotina_redsys.retries import HTTPServerError
+from guillotina_redsys.retries import RETRY_DECISIONS
+from guillotina_redsys.retries import RetryPolicy
+from guillotina_redsys.simulator import RedsysSimulator
+from guillotina_redsys.utility import RedsysUtility
+
+import pytest
+
+
+pytestmark = pytest.mark.asyncio
+
+SECRET_KEY = "sq7HjrUOBfKmC576ILgskD5srU870gJ7"
+NO_WAIT = {
+    "connection": {"min_wait": 0, "max_wait": 0},
+    "transient": {"min_wait": 0, "max_wait": 0},
+}
+
+
+def _calls(outcomes):
+    calls = []
+
+    async def call():
+        outcome = outcomes[min(len(calls), len(outcomes) - 1)]
+        calls.append(outcome)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    return call, calls
+
+
+async def test_retry_policy_classes():
+    policy = RetryPolicy(classes=NO_WAIT)
+    transient = RedsysErrorResponse(errorCode="SIS0081")
+    duplicate = RedsysErrorResponse(errorCode="SIS0051")
+
+    call, calls = _calls([transient, transient, {"Ds_Response": "0000"}])
+    assert await policy.call(call, operation="test") == {"Ds_Response": "0000"}
+    assert len(calls) == 3
+
+    # attempts run out: the last error response is returned
+    call, calls = _calls([transient])
+    assert await policy.call(call, operation="test") == transient
+    assert len(calls) == 3
+
+    call, calls = _calls([duplicate])
+    assert await policy.call(call, operation="test") == duplicate
+    assert len(calls) == 1
+
+    # repeatOrderStatus wins over the table
+    call, calls = _calls(
+        [duplicate.copy(update={"repeatOrderStatus": "Y"}), {"Ds_Response": "0000"}]
+    )
+    assert await policy.call(call, operation="test") == {"Ds_Response": "0000"}
+    call, calls = _calls([transient.copy(update={"repeatOrderStatus": "N"})])
+    await policy.call(call, operation="test")
+    assert len(calls) == 1
+
+    call, calls = _calls([HTTPServerError("503")])
+    with pytest.raises(HTTPServerError):
+        await policy.call(call, operation="test")
+    assert len(calls) == 3
+
+    call, calls = _calls([ValueError("bad body")])
+    with pytest.raises(ValueError):
+        await policy.call(call, operation="test")
+    assert len(calls) == 1
+
+    decisions = {
+        (v["labels"]["error_class"], v["labels"]["decision"]): v["value"]
+        for v in RETRY_DECISIONS.status()["values"]
+        if v["labels"]["operation"] == "test"
+    }
+    assert decisions[("permanent", "give_up")] == 2
+    assert decisions[("connection", "retry")] == 2
+
+
+async def test_transient_redsys_errors_are_retried():
+    simulator = RedsysSimulator(SECRET_KEY, error_code="SIS0081")
+    server = TestServer(simulator.app)
+    await server.start_server()
+    utility = RedsysUtility(
+        {
+            "terminal": "001",
+            "secret_key": SECRET_KEY,
+            "merchant_code": "999008881",
+            "url_redsys": str(server.make_url("")).rstrip("/"),
+            "container_url": "http://localhost:8080/db/guillotina",
+            "retry_policy": {
+                "classes": dict(NO_WAIT, transient={"min_wait": 0.2, "max_wait": 0.2})
+            },
+            "admission": {"enabled": True, "initial_limit": 10, "target_latency": 0.1},
+        }
+    )
+    try:
+        simulator._scenarios["0001ORDER"].extend(
+            [{"outcome": "error"}, {"outcome": "authorized"}]
+        )
+        res = await utility.token_payment(Decimal("10"), "token", "0001ORDER")
+        assert res.is_authorized
+        assert simulator.requests == 2
+        # the backoff between attempts is not Redsys latency
+        limit = utility.admission.status()["operations"]["token"]["limit"]
+        assert limit == 10
+
+        simulator.error_code = "SIS0051"
+        simulator._scenarios["0002ORDER"].extend([{"outcome": "error"}])
+        res = await utility.token_payment(Decimal("10"), "token", "0002ORDER")
+        assert res.errorCode == "SIS0051"
+        assert simulator.requests == 3
+    finally:
+        await utility.finalize()
+        await server.close()
@@ -0,0 +1,102 @@
+from decimal import Decimal
+from guillotina_redsys.models import RedsysAuthResult
+from guillotina_redsys.scheduler import PreauthScheduler
+from guillotina_redsys.tests.utils import generate_redsys_order_id
+
+import pytest
+import time
+
+
+pytestmark = pytest.mark.asyncio
+
+
+def _auth_result(order, transaction_type, ds_response):
+    return RedsysAuthResult(
+        Ds_Amount="1249",
+        Ds_Currency="978",
+        Ds_Order=order,
+        Ds_MerchantCode="999008881",
+        Ds_Terminal="1",
+        Ds_Response=ds_response,
+        Ds_TransactionType=transaction_type,
+    )
+
+
+class FakeUtility:
+    def __init__(self):
+        self.calls = []
+
+    async def confirm_preauthorization(self, amount, order, currency=978):
+        self.calls.append(("confirm", order))
+        return _auth_result(order, "2", "0900")
+
+    async def cancel_preauthorization(self, amount, order, currency=978):
+        self.calls.append(("cancel", order))
+        return _auth_result(order, "9", "0400")
+
+
+async def test_preauth_scheduler(guillotina_redsys, redis_container):
+    utility = FakeUtility()
+    scheduler = PreauthScheduler(utility, rate=2, expiry_margin=60)
+    now = time.time()
+    due = generate_redsys_order_id(8)
+    expiring = generate_redsys_order_id(8)
+    later = generate_redsys_order_id(8)
+    await scheduler.schedule(due, Decimal("12.49"), now - 1, now + 3600)
+    await scheduler.schedule(expiring, Decimal("12.49"), now - 1, now + 30)
+    await scheduler.schedule(later, Decimal("12.49"), now + 3600, now + 7200)
+
+    assert await scheduler.run_once() == 2
+    assert sorted(utility.calls) == [("cancel", expiring), ("confirm", due)]
+    assert (await scheduler.get_state(due))["status"] == "confirmed"
+    assert (await scheduler.get_state(expiring))["status"] == "cancelled"
+    assert (await scheduler.get_state(later))["status"] == "scheduled"
+
+    # already claimed, nothing left to send
+    assert await scheduler.run_once() == 0
+
+
+async def test_preauth_claimed_by_dead_worker_is_queued_again(
+    guillotina_redsys, redis_container
+):
+    utility = FakeUtility()
+    dead = PreauthScheduler(utility, visibility_timeout=0)
+    alive = PreauthScheduler(utility)
+    now = time.time()
+    order = generate_redsys_order_id(8)
+    await alive.schedule(order, Decimal("12.49"), now - 1, now + 7 * 24 * 3600)
+    # claimed, then the worker died before sending it
+    assert order in await dead._claim_due(time.time())
+    assert await alive.run_once() == 1
+    assert utility.calls == [("confirm", order)]
+    assert (await alive.get_state(order))["status"] == "confirmed"
+    assert await alive.run_once() == 0
+
+
+class FailingUtility:
+    def __init__(self):
+        self.calls = 0
+
+    async def cancel_preauthorization(self, amount, order, currency=978):
+        self.calls += 1
+        raise ConnectionError()
+
+
+async def test_preauth_retries_stop_at_expiry(guillotina_redsys, redis_container):
+    utility = FailingUtility()
+    scheduler = PreauthScheduler(utility, expiry_margin=60, retry_delay=0)
+    now = time.time()
+    order = generate_redsys_order_id(8)
+    await scheduler.schedule(order, Decimal("12.49"), now - 1, now + 0.2)
+    while await scheduler.run_once():
+        pass
+    state = await scheduler.get_state(order)
+    assert (state["status"], state["error_code"]) == ("failed", "expired")
+    assert utility.calls >= 1
+
+
+async def test_unschedule_unknown_order(guillotina_redsys, redis_container):
+    scheduler = PreauthScheduler(FakeUtility())
+    order = generate_redsys_order_id(8)
+    assert not await scheduler.unschedule(order)
+    assert await scheduler.get_state(order) is None
@@ -0,0 +1,67 @@
+from guillotina_redsys.events import RedsysEvent
+from guillotina_redsys.sweeper import FlowSweeper
+from guillotina_redsys.tests.utils import generate_redsys_order_id
+
+import pytest
+
+
+pytestmark = pytest.mark.asyncio
+
+
+class FakeUtility:
+    def __init__(self):
+        self.events = []
+
+    async def emit_event(self, type_, order, transaction_id=None, **data):
+        self.events.append((type_, order, transaction_id, data["step"]))
+
+
+async def test_flow_sweeper(guillotina_redsys, redis_container):
+    utility = FakeUtility()
+    sweeper = FlowSweeper(utility, enabled=True, flow_ttl=0, batch_size=10)
+    other = FlowSweeper(utility, enabled=True)
+    abandoned = generate_redsys_order_id(8)
+    finished = generate_redsys_order_id(8)
+    for order in (abandoned, finished):
+        await sweeper.on_event(
+            RedsysEvent(type="transaction_started", order=order, transaction_id="t")
+        )
+    await sweeper.on_event(
+        RedsysEvent(type="challenge_required", order=abandoned, transaction_id="t")
+    )
+    await sweeper.on_event(RedsysEvent(type="authorized", order=finished))
+
+    inflight = await sweeper.list_inflight()
+    assert [item["order"] for item in inflight["items"]] == [abandoned]
+    assert (await sweeper.get_flow(abandoned))["step"] == "challenge_required"
+
+    # a single leader at a time
+    assert await sweeper.acquire_leadership()
+    assert not await other.acquire_leadership()
+    assert await sweeper.acquire_leadership()
+
+    assert await sweeper.sweep_once() == 1
+    assert utility.events == [("abandoned", abandoned, "t", "challenge_required")]
+    assert await sweeper.get_flow(abandoned) is None
+    assert (await sweeper.list_inflight())["total"] == 0
+    assert await sweeper.sweep_once() == 0
+
+
+async def test_public_events_do_not_start_flows(guillotina_redsys, redis_container):
+    sweeper = FlowSweeper(FakeUtility(), enabled=True)
+    tracked = generate_redsys_order_id(8)
+    unknown = generate_redsys_order_id(8)
+    await sweeper.on_event(
+        RedsysEvent(type="transaction_started", order=tracked, transaction_id="t")
+    )
+    # the 3DS method notification is public, anyone can send it
+    for order in (tracked, unknown):
+        await sweeper.on_event(
+            RedsysEvent(type="threeds_completed", order=order, transaction_id="t")
+        )
+
+    inflight = await sweeper.list_inflight()
+    assert [item["order"] for item in inflight["items"]] == [tracked]
+    assert (await sweeper.get_flow(tracked))["step"] == "threeds_completed"
+    assert await sweeper.get_flow(unknown) is None
+    await sweeper.untrack(tracked)
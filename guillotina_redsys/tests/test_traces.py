@@ -0,0 +1,55 @@
+from aiohttp.test_utils import TestServer
+from decimal import Decimal
+from guillotina_redsys.models import RedsysAuthResult
+from guillotina_redsys.models import RedsysErrorResponse
+from guillotina_redsys.simulator import RedsysSimulator
+from guillotina_redsys.traces import load_traces
+from guillotina_redsys.utility import RedsysUtility
+
+import aiohttp
+import pytest
+
+
+pytestmark = pytest.mark.asyncio
+
+SECRET_KEY = "sq7HjrUOBfKmC576ILgskD5srU870gJ7"
+
+
+async def test_traces_recorded_against_simulator(tmp_path):
+    simulator = RedsysSimulator(SECRET_KEY)
+    server = TestServer(simulator.app)
+    await server.start_server()
+    path = str(tmp_path / "traces.jsonl")
+    utility = RedsysUtility(
+        {
+            "terminal": "001",
+            "secret_key": SECRET_KEY,
+            "merchant_code": "999008881",
+            "url_redsys": str(server.make_url("")),
+            "container_url": "http://localhost:8080/db/guillotina",
+            "traces": {"enabled": True, "path": path},
+        }
+    )
+    try:
+        async with aiohttp.ClientSession() as session:
+            await session.post(
+                server.make_url("/_scenario"),
+                json={"order": "0001TOKEN", "steps": [{"outcome": "error"}]},
+            )
+        card = dict(card="4548810000000003", cvv="123", expiry_date="4912")
+        res = await utility.init_transaction(Decimal("10"), order="0001CARD", **card)
+        assert res.Ds_EMV3DS.threeDSInfo == "CardConfiguration"
+        res = await utility.token_payment(Decimal("10"), "token", "0001TOKEN")
+        assert isinstance(res, RedsysErrorResponse)
+        res = await utility.token_payment(Decimal("10"), "token", "0001TOKEN")
+        assert isinstance(res, RedsysAuthResult) and res.is_authorized
+    finally:
+        await utility.finalize()
+        await server.close()
+
+    flows = load_traces(path)
+    assert [[(s["step"], s["outcome"]) for s in steps] for steps in flows] == [
+        [("CardData", "card_data")],
+        [("token", "error"), ("token", "authorized")],
+    ]
+    assert "0001" not in open(path).read()
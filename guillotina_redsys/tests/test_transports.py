@@ -0,0 +1,123 @@
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from guillotina_redsys.endpoints import EndpointPool
+from guillotina_redsys.transports import AiohttpTransport
+from guillotina_redsys.transports import HTTP2Transport
+from guillotina_redsys.transports import Transport
+from guillotina_redsys.transports import TransportConnectionError
+from guillotina_redsys.transports import TransportResponse
+from guillotina_redsys.utils import HTTPServerError
+from guillotina_redsys.utils import RestAPI
+
+import asyncio
+import json
+import pytest
+
+
+pytestmark = pytest.mark.asyncio
+
+
+class ScriptedTransport(Transport):
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.urls = []
+
+    async def request(self, method, url, **kwargs):
+        self.urls.append(url)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+async def test_transport_requires_request():
+    class Incomplete(Transport):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+async def test_rest_api_transport_semantics():
+    body = json.dumps({"errorCode": "SIS0051"}).encode("utf-8")
+    transport = ScriptedTransport(
+        TransportConnectionError("refused"),
+        TransportResponse(502, b"bad gateway"),
+        TransportResponse(200, body, "text/html", "utf-8"),
+        TransportResponse(200, body, "application/json"),
+    )
+    api = RestAPI("https://redsys.invalid/sis/rest/", transport=transport)
+
+    # connection errors and 5xx are retried, non JSON bodies come as text
+    assert await api.post("/trataPeticionREST", json={}) == body.decode("utf-8")
+    assert transport.urls == ["https://redsys.invalid/sis/rest/trataPeticionREST"] * 3
+    assert await api.post("/trataPeticionREST", json={}) == {"errorCode": "SIS0051"}
+
+    transport.responses = [TransportResponse(503, b"down")] * 3
+    with pytest.raises(HTTPServerError):
+        await api.get("/status")
+
+
+async def test_rest_api_timeouts_fail_over():
+    transport = ScriptedTransport(
+        asyncio.TimeoutError(), TransportResponse(200, b"{}", "application/json")
+    )
+    endpoints = EndpointPool(
+        ["https://redsys.invalid/sis/rest", "https://backup.invalid/sis/rest"],
+        failure_threshold=1,
+    )
+    api = RestAPI(transport=transport, endpoints=endpoints)
+    with pytest.raises(asyncio.TimeoutError):
+        await api.get("/status")
+    assert endpoints.active == "https://backup.invalid/sis/rest"
+    assert await api.get("/status") == {}
+    assert transport.urls[-1] == "https://backup.invalid/sis/rest/status"
+
+
+async def test_transports_share_timeout_semantics():
+    pytest.importorskip("httpx")
+    calls = []
+
+    async def slow(request):
+        calls.append(request.path)
+        await asyncio.sleep(1)
+        return web.json_response({})
+
+    app = web.Application()
+    app.router.add_get("/slow", slow)
+    server = TestServer(app)
+    await server.start_server()
+    try:
+        for transport in (
+            AiohttpTransport(timeout=0.2),
+            HTTP2Transport(timeout=0.2),
+        ):
+            endpoints = EndpointPool([str(server.make_url("")).rstrip("/")])
+            api = RestAPI(transport=transport, endpoints=endpoints)
+            calls.clear()
+            try:
+                # a read timeout may have been processed: failed, not retried
+                with pytest.raises(asyncio.TimeoutError):
+                    await api.get("/slow")
+            finally:
+                await api.close()
+            assert calls == ["/slow"]
+            assert endpoints.status()["endpoints"][0]["consecutive_failures"] == 1
+    finally:
+        await server.close()
+
+
+async def test_http2_transport_maps_connect_timeouts():
+    httpx = pytest.importorskip("httpx")
+    transport = HTTP2Transport()
+
+    def timeout(request):
+        raise httpx.ConnectTimeout("connect timeout", request=request)
+
+    await transport.client.aclose()
+    transport.client = httpx.AsyncClient(transport=httpx.MockTransport(timeout))
+    try:
+        with pytest.raises(TransportConnectionError):
+            await transport.request("GET", "https://redsys.invalid/status")
+    finally:
+        await transport.close()
@@ -0,0 +1,156 @@
+from guillotina_redsys.models import RedsysErrorResponse
+from guillotina_redsys.models import RedsysMerchantParams
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Union
+
+import asyncio
+import hashlib
+import json
+import logging
+
+
+logger = logging.getLogger("guillotina_redsys")
+
+
+def trace_step(merchant: RedsysMerchantParams) -> str:
+    """
+    Name of the flow step a Redsys call belongs to: the 3DS phase
+    (``CardData``, ``AuthenticationData``, ``ChallengeResponse``), ``token``
+    for merchant initiated payments or ``type<N>`` for other operations.
+    """
+    if merchant.Ds_Merchant_EMV3DS is not None:
+        return merchant.Ds_Merchant_EMV3DS.threeDSInfo
+    if merchant.Ds_Merchant_Excep_SCA == "MIT":
+        return "token"
+    return f"type{merchant.Ds_Merchant_TransactionType}"
+
+
+def trace_outcome(
+    response: Union[RedsysErrorResponse, Dict[str, Any], None], error: Optional[str]
+) -> str:
+    """
+    Outcome of a Redsys call, from its parsed response, with the names
+    understood by the simulator.
+    """
+    if error is not None or response is None:
+        return "failed"
+    if isinstance(response, RedsysErrorResponse):
+        return "error"
+    emv3ds = response.get("Ds_EMV3DS") or {}
+    if emv3ds.get("threeDSInfo") == "ChallengeRequest":
+        return "challenge"
+    if "Ds_Response" in response:
+        code = int(response["Ds_Response"])
+        # 0000-0099 authorized, 0400 cancelled and 0900 confirmed
+        return "authorized" if code < 100 or code in (400, 900) else "denied"
+    return "method" if emv3ds.get("threeDSMethodURL") else "card_data"
+
+
+class TraceRecorder:
+    """
+    Records timing and outcome of the Redsys calls of real flows into a JSON
+    lines file that ``benchmarks/replay.py`` drives against the simulator.
+
+    Traces hold no card data: the order id is replaced by a hash and only the
+    step, outcome, start time and duration are kept. Whole flows are sampled
+    (``sample_rate``) and written by a background task.
+    """
+
+    def __init__(
+        self,
+        *,
+        enabled: bool = False,
+        path: str = "redsys-traces.jsonl",
+        sample_rate: float = 1.0,
+        queue_size: int = 10_000,
+    ) -> None:
+        self.enabled = enabled
+        self.path = path
+        self.sample_rate = sample_rate
+        self.queue_size = queue_size
+        self.dropped = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _flow(self, order: str) -> Optional[str]:
+        digest = hashlib.sha256(order.encode("utf-8")).hexdigest()
+        # same decision for every call of an order
+        if int(digest[:8], 16) / 0xFFFFFFFF >= self.sample_rate:
+            return None
+        return digest[:16]
+
+    def record(
+        self,
+        merchant: RedsysMerchantParams,
+        response: Union[RedsysErrorResponse, Dict[str, Any], None],
+        started: float,
+        duration: float,
+        error: Optional[str] = None,
+    ) -> None:
+        if not self.enabled:
+            return
+        flow = self._flow(merchant.Ds_Merchant_Order)
+        if flow is None:
+            return
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue(maxsize=self.queue_size)
+            self._task = asyncio.create_task(self._writer())
+        trace = {
+            "flow": flow,
+            "at": started,
+            "step": trace_step(merchant),
+            "outcome": trace_outcome(response, error),
+            "duration": round(duration, 6),
+        }
+        try:
+            self._queue.put_nowait(trace)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def _append(self, traces: List[Dict[str, Any]]) -> None:
+        with open(self.path, "a") as fi:
+            fi.writelines(json.dumps(trace) + "\n" for trace in traces)
+
+    async def _writer(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            traces = [await self._queue.get()]
+            while not self._queue.empty():
+                traces.append(self._queue.get_nowait())
+            try:
+                await loop.run_in_executor(None, self._append, traces)
+            except Exception:
+                logger.warning("Could not write redsys traces", exc_info=True)
+                self.dropped += len(traces)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            # flush what the writer did not get to
+            traces = []
+            while not self._queue.empty():
+                traces.append(self._queue.get_nowait())
+            if traces:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, self._append, traces)
+
+
+def load_traces(path: str) -> List[List[Dict[str, Any]]]:
+    """
+    Flows of a trace file, each one a list of steps in call order, sorted
+    by the start of the flow.
+    """
+    flows: Dict[str, List[Dict[str, Any]]] = {}
+    with open(path) as fi:
+        for line in fi:
+            if line.strip():
+                trace = json.loads(line)
+                flows.setdefault(trace["flow"], []).append(trace)
+    for steps in flows.values():
+        steps.sort(key=lambda trace: trace["at"])
+    return sorted(flows.values(), key=lambda steps: steps[0]["at"])
@@ -0,0 +1,185 @@
+from abc import ABC
+from abc import abstractmethod
+from guillotina_redsys.resources import resources
+from typing import Any
+from typing import Dict
+from typing import Optional
+
+import aiohttp
+import asyncio
+import json as jsonlib
+
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover
+    httpx = None
+
+
+class TransportConnectionError(Exception):
+    """Connection could not be established; retried like ClientConnectorError."""
+
+
+class TransportResponse:
+    """
+    Fully read response, independent of the HTTP client that produced it.
+    """
+
+    __slots__ = ("status", "body", "content_type", "charset")
+
+    def __init__(
+        self,
+        status: int,
+        body: bytes,
+        content_type: str = "",
+        charset: Optional[str] = None,
+    ) -> None:
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+        self.charset = charset
+
+    def text(self) -> str:
+        return self.body.decode(self.charset or "utf-8", errors="replace")
+
+    def json(self) -> Any:
+        # same contract as aiohttp: only JSON content types are decoded
+        if "json" not in self.content_type:
+            raise ValueError(f"Unexpected content type {self.content_type}")
+        return jsonlib.loads(self.body)
+
+
+class Transport(ABC):
+    @abstractmethod
+    async def request(
+        self,
+        method: str,
+        url: str,
+        *,
+        json: Optional[Dict[str, Any]] = None,
+        data: Optional[Any] = None,
+        params: Optional[Dict[str, Any]] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> TransportResponse:
+        """Send a request and return the fully read response."""
+
+    async def close(self) -> None:
+        pass
+
+
+class AiohttpTransport(Transport):
+    """
+    HTTP/1.1 over an ``aiohttp.ClientSession`` (one request per connection).
+    """
+
+    def __init__(
+        self,
+        *,
+        session: Optional[aiohttp.ClientSession] = None,
+        timeout: int = 10,
+    ) -> None:
+        self._external_session = session is not None
+        self.session = session or resources.track_session(
+            aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout))
+        )
+
+    async def request(
+        self,
+        method: str,
+        url: str,
+        *,
+        json: Optional[Dict[str, Any]] = None,
+        data: Optional[Any] = None,
+        params: Optional[Dict[str, Any]] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> TransportResponse:
+        async with self.session.request(
+            method,
+            url,
+            json=json,
+            data=data,
+            params=params,
+            headers=headers,
+        ) as resp:
+            return TransportResponse(
+                resp.status, await resp.read(), resp.content_type, resp.charset
+            )
+
+    async def close(self) -> None:
+        if not self._external_session:
+            await self.session.close()
+
+
+class HTTP2Transport(Transport):
+    """
+    HTTP/2 over ``httpx``: concurrent requests are multiplexed as streams on
+    a few connections. Needs ``pip install guillotina_redsys[http2]``.
+
+    ``prior_knowledge`` speaks h2c to plain ``http://`` servers (local stubs);
+    over TLS the protocol is negotiated with ALPN.
+    """
+
+    def __init__(
+        self,
+        *,
+        timeout: int = 10,
+        max_connections: int = 10,
+        prior_knowledge: bool = False,
+    ) -> None:
+        if httpx is None:
+            raise ImportError(
+                "HTTP2Transport needs httpx[http2]: pip install guillotina_redsys[http2]"
+            )
+        self.client = resources.track_session(
+            httpx.AsyncClient(
+                http1=not prior_knowledge,
+                http2=True,
+                timeout=timeout,
+                limits=httpx.Limits(max_connections=max_connections),
+            )
+        )
+
+    async def request(
+        self,
+        method: str,
+        url: str,
+        *,
+        json: Optional[Dict[str, Any]] = None,
+        data: Optional[Any] = None,
+        params: Optional[Dict[str, Any]] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> TransportResponse:
+        kwargs = {}
+        if isinstance(data, (str, bytes)):
+            kwargs["content"] = data
+        elif data is not None:
+            kwargs["data"] = data
+        try:
+            resp = await self.client.request(
+                method,
+                url,
+                json=json,
+                params=params,
+                headers=headers,
+                **kwargs,
+            )
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+            raise TransportConnectionError(str(e)) from e
+        except httpx.TimeoutException as e:
+            # like aiohttp: Redsys may have processed it, never retried
+            raise asyncio.TimeoutError(repr(e)) from e
+        content_type = resp.headers.get("content-type", "").split(";")[0].strip()
+        return TransportResponse(
+            resp.status_code, resp.content, content_type, resp.charset_encoding
+        )
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+
+def make_transport(name: str = "aiohttp", **options) -> Transport:
+    if name == "aiohttp":
+        return AiohttpTransport(**options)
+    if name == "http2":
+        return HTTP2Transport(**options)
+    raise ValueError(f"Unknown transport {name}")
@@ -1,9 +1,26 @@
 from decimal import Decimal
+from guillotina.contrib.redis import get_driver
 from guillotina.utils import get_current_request
+from guillotina_redsys import keys
+from guillotina_redsys.acs import AcsClient
+from guillotina_redsys.admission import AdmissionController
+from guillotina_redsys.admission import AdmissionRejected
+from guillotina_redsys.audit import AuditRecorder
+from guillotina_redsys.batching import RedisReadBatcher
+from guillotina_redsys.billing import BillingRuns
+from guillotina_redsys.bins import BinCache
+from guillotina_redsys.bins import BinInfo
+from guillotina_redsys.checkout import CheckoutSessions
+from guillotina_redsys.endpoints import EndpointPool
+from guillotina_redsys.events import EventEmitter
+from guillotina_redsys.events import RedsysEvent
+from guillotina_redsys.faults import FaultInjector
 from guillotina_redsys.models import CVV2
 from guillotina_redsys.models import ExpiryDate
+from guillotina_redsys.models import IDENTIFIER_REQUIRED
 from guillotina_redsys.models import OrderId
 from guillotina_redsys.models import Pan
+from guillotina_redsys.models import parse_redsys_response
 from guillotina_redsys.models import Redsys3DSMethodResponse
 from guillotina_redsys.models import RedsysAuthResult
 from guillotina_redsys.models import RedsysEMV3DS
@@ -12,12 +29,74 @@ from guillotina_redsys.models import RedsysErrorResponse
 from guillotina_redsys.models import RedsysForm
 from guillotina_redsys.models import RedsysIniciaPeticionResponse
 from guillotina_redsys.models import RedsysMerchantParams
-from guillotina_redsys.utils import decode_redsys_merchant_parameters
+from guillotina_redsys.profiling import profiler
+from guillotina_redsys.push import OrderUpdatesHub
+from guillotina_redsys.ratelimit import TokenBucketLimiter
+from guillotina_redsys.resources import resources
+from guillotina_redsys.retries import CONNECTION
+from guillotina_redsys.retries import RetryPolicy
+from guillotina_redsys.scheduler import PreauthScheduler
+from guillotina_redsys.sweeper import FlowSweeper
+from guillotina_redsys.traces import trace_step
+from guillotina_redsys.traces import TraceRecorder
+from guillotina_redsys.transports import make_transport
+from guillotina_redsys.utils import decrypt_context
+from guillotina_redsys.utils import encrypt_context
 from guillotina_redsys.utils import RestAPI
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import Optional
+from typing import Union
 
 import asyncio
 import base64
 import json
+import logging
+import time
+import uuid
+
+
+logger = logging.getLogger("guillotina_redsys")
+
+EXPIRATION_30_MIN = 60 * 30
+
+# stored as the challenge result when completing it on the server failed
+CHALLENGE_ERROR = RedsysErrorResponse(
+    errorCode="ERROR", errorCodeDescription="The challenge could not be completed"
+)
+
+# Returns the stored result, or the CRES when the claim lock ARGV[2] is
+# taken, or tells that another caller holds the lock. The CRES stays under
+# its own key until a result is stored, so a claimer that dies only leaves a
+# lock that expires.
+_CLAIM_CRES_SCRIPT = """
+local result = redis.call('GET', KEYS[1])
+if result then
+    return {'result', result}
+end
+local cres = redis.call('GET', KEYS[2])
+if not cres then
+    return {'none'}
+end
+if redis.call('SET', KEYS[3], ARGV[2], 'NX', 'PX', ARGV[1]) then
+    return {'cres', cres}
+end
+return {'pending'}
+"""
+
+# Releases the claim lock if ARGV[1] still holds it, and deletes the CRES
+# once its result is stored (ARGV[2]).
+_RELEASE_CRES_SCRIPT = """
+if redis.call('GET', KEYS[2]) == ARGV[1] then
+    redis.call('DEL', KEYS[2])
+end
+if ARGV[2] == '1' then
+    redis.call('DEL', KEYS[1])
+end
+return 1
+"""
 
 
 class RedsysUtility:
@@ -26,10 +105,58 @@ class RedsysUtility:
         self.terminal = self._settings["terminal"]
         self.secret_key = self._settings["secret_key"]
         self.merchant_code = self._settings["merchant_code"]
-        self.url_redsys = self._settings["url_redsys"]
+        urls = self._settings["url_redsys"]
+        if isinstance(urls, str):
+            urls = [urls]
+        # first endpoint of the list, kept for compatibility
+        self.url_redsys = urls[0]
         self.container_url = self._settings["container_url"]
-        self.redsys_api = RestAPI(self.url_redsys)
-        self.api = RestAPI()
+        self.faults = FaultInjector(**self._settings.get("fault_injection", {}))
+        self.endpoints = EndpointPool(urls, **self._settings.get("endpoints", {}))
+        # whole Redsys calls are retried by error class, see _post_redsys
+        self.retries = RetryPolicy(**self._settings.get("retry_policy", {}))
+        self.redsys_api = RestAPI(
+            self.url_redsys,
+            faults=self.faults,
+            endpoints=self.endpoints,
+            retry_policy=RetryPolicy(classes={CONNECTION: {"attempts": 1}}),
+            transport=make_transport(
+                self._settings.get("transport", "aiohttp"),
+                **self._settings.get("transport_options", {}),
+            ),
+        )
+        # 3DS method posts to the issuers' ACS hosts
+        self.acs = AcsClient(**self._settings.get("acs", {}))
+        self.bins = BinCache(**self._settings.get("bin_cache", {}))
+        self.api = RestAPI(faults=self.faults, transport=self.acs)
+        self.preauth_scheduler = PreauthScheduler(
+            self, **self._settings.get("preauth_scheduler", {})
+        )
+        self.auto_complete_challenge = self._settings.get(
+            "auto_complete_challenge", False
+        )
+        self.challenge_context_ttl = self._settings.get("challenge_context_ttl", 600)
+        self.challenge_claim_ttl = self._settings.get("challenge_claim_ttl", 60)
+        self.challenge_poll_interval = self._settings.get(
+            "challenge_poll_interval", 0.2
+        )
+        # claims held by this worker, awaited by its other callers
+        self._challenge_claims: Dict[str, asyncio.Future] = {}
+        self.events = EventEmitter(**self._settings.get("events", {}))
+        self.audit = AuditRecorder(**self._settings.get("audit", {}))
+        self.traces = TraceRecorder(**self._settings.get("traces", {}))
+        self.admission = AdmissionController(**self._settings.get("admission", {}))
+        self.rate_limiter = TokenBucketLimiter(**self._settings.get("rate_limit", {}))
+        self.push = OrderUpdatesHub(**self._settings.get("push", {}))
+        self.sweeper = FlowSweeper(self, **self._settings.get("sweeper", {}))
+        self.billing = BillingRuns(self, **self._settings.get("billing", {}))
+        self.reads = RedisReadBatcher(**self._settings.get("read_batching", {}))
+        self.checkout = CheckoutSessions(
+            self.secret_key, **self._settings.get("checkout_sessions", {})
+        )
+        profiler.configure(**self._settings.get("profiling", {}))
+        self._tasks = []
+        self._preconnects = set()
 
     def _build_form(self, merchant: RedsysMerchantParams) -> dict:
         form = RedsysForm.from_merchant(
@@ -38,6 +165,102 @@ class RedsysUtility:
         )
         return form.dict()
 
+    async def _post_redsys(
+        self, path: str, merchant: RedsysMerchantParams
+    ) -> Union[RedsysErrorResponse, Dict[str, Any]]:
+        """
+        Send a signed request, repeated as ``self.retries`` classifies its
+        failures. Returns the error response or the decoded
+        Ds_MerchantParameters, parsed once from the raw body.
+        """
+        form = self._build_form(merchant)
+        order = merchant.Ds_Merchant_Order
+        started_at = time.time()
+        started = time.monotonic()
+        operation = trace_step(merchant)
+        try:
+            with resources.in_flight(operation):
+                response = await self.retries.call(
+                    self._send_form, path, form, merchant, operation=operation
+                )
+        except AdmissionRejected:
+            raise
+        except Exception as e:
+            duration = time.monotonic() - started
+            self.audit.record(path, order, form, None, duration, error=repr(e))
+            self.traces.record(merchant, None, started_at, duration, error=repr(e))
+            raise
+        duration = time.monotonic() - started
+        self.audit.record(path, order, form, response, duration)
+        self.traces.record(merchant, response, started_at, duration)
+        return response
+
+    async def _send_form(
+        self, path: str, form: dict, merchant: RedsysMerchantParams
+    ) -> Union[RedsysErrorResponse, Dict[str, Any]]:
+        # every attempt spends a token of the shared per terminal budget
+        await self.rate_limiter.acquire(
+            merchant.Ds_Merchant_MerchantCode,
+            merchant.Ds_Merchant_Terminal,
+            trace_step(merchant),
+        )
+        # admitted and measured per attempt, without the retry backoff
+        async with self.admission.admit(trace_step(merchant)):
+            body = await self.redsys_api.post_raw(path, json=form)
+        return parse_redsys_response(body)
+
+    def _cof_params(self, store_card: bool, cof_type: str = "C") -> dict:
+        # Ask Redsys to tokenize the card so later charges can reuse it
+        if not store_card:
+            return {}
+        return {
+            "identifier": IDENTIFIER_REQUIRED,
+            "cof_ini": "S",
+            "cof_type": cof_type,
+        }
+
+    async def emit_event(self, type_, order, transaction_id=None, **data):
+        event = RedsysEvent(
+            type=type_, order=order, transaction_id=transaction_id, data=data
+        )
+        await self.events.emit(event)
+        if self.push.enabled:
+            await self.push.publish(event)
+        if self.sweeper.enabled:
+            await self.sweeper.on_event(event)
+
+    async def _emit_outcome(self, order, result, transaction_id=None):
+        if isinstance(result, RedsysErrorResponse):
+            await self.emit_event(
+                "error",
+                order,
+                transaction_id,
+                errorCode=result.errorCode,
+                errorCodeDescription=result.errorCodeDescription,
+            )
+        elif isinstance(result, RedsysEMV3DSResponse):
+            await self.emit_event(
+                "challenge_required",
+                order,
+                transaction_id,
+                protocolVersion=result.protocolVersion,
+                acsURL=result.acsURL,
+                creq=result.creq,
+            )
+        elif isinstance(result, RedsysAuthResult):
+            await self.emit_event(
+                "authorized" if result.is_authorized else "denied",
+                order,
+                transaction_id,
+                Ds_Response=result.Ds_Response,
+                Ds_AuthorisationCode=result.Ds_AuthorisationCode,
+                Ds_Amount=result.Ds_Amount,
+                Ds_Currency=result.Ds_Currency,
+                Ds_TransactionType=result.Ds_TransactionType,
+                Ds_Card_Brand=result.Ds_Card_Brand,
+                Ds_Card_Country=result.Ds_Card_Country,
+            )
+
     async def init_transaction(
         self,
         amount: Decimal,
@@ -47,6 +270,8 @@ class RedsysUtility:
         order: OrderId,
         currency=978,
         transaction_type="0",
+        store_card=False,
+        cof_type="C",
     ):
         merchant = RedsysMerchantParams.from_euros(
             amount_eur=amount,
@@ -60,17 +285,20 @@ class RedsysUtility:
             excep_sca="Y",
             expiry_date=expiry_date,
             pan=card,
+            **self._cof_params(store_card, cof_type),
         )
-        form = RedsysForm.from_merchant(
-            merchant=merchant,
-            terminal_key=self.secret_key,
+        cached = self.bins.get(card)
+        if cached is not None:
+            # warm the ACS connection while iniciaPeticion is in flight
+            self._preconnect(cached)
+        response = await self._post_redsys("/iniciaPeticionREST", merchant)
+        if isinstance(response, RedsysErrorResponse):
+            await self._emit_outcome(order, response)
+            return response
+        result = RedsysIniciaPeticionResponse(**response)
+        self.bins.put(
+            card, result.Ds_EMV3DS.protocolVersion, result.Ds_EMV3DS.threeDSMethodURL
         )
-        response = await self.redsys_api.post("/iniciaPeticionREST", json=form.dict())
-        response = json.loads(response)
-        if "errorCode" in response:
-            return RedsysErrorResponse(**response)
-        decoded = decode_redsys_merchant_parameters(response["Ds_MerchantParameters"])
-        result = RedsysIniciaPeticionResponse(**decoded)
         notification_url = f"{self.container_url}/@notificationRedsys3DS/{result.Ds_Order}/{result.Ds_EMV3DS.threeDSServerTransID}"
         payload = {
             "threeDSServerTransID": result.Ds_EMV3DS.threeDSServerTransID,
@@ -83,8 +311,32 @@ class RedsysUtility:
         )
 
         result.payload_3DS = payload
+        if self.checkout.enabled:
+            result.session_token = await self.checkout.create(merchant)
+        await self.emit_event(
+            "transaction_started",
+            result.Ds_Order,
+            result.Ds_EMV3DS.threeDSServerTransID,
+            protocolVersion=result.Ds_EMV3DS.protocolVersion,
+            threeDSMethodURL=result.Ds_EMV3DS.threeDSMethodURL,
+        )
         return result
 
+    def _preconnect(self, info: BinInfo) -> None:
+        if not self.bins.preconnect or not info.method_url:
+            return
+        task = asyncio.create_task(self.acs.preconnect(info.method_url))
+        self._preconnects.add(task)
+        task.add_done_callback(self._preconnects.discard)
+
+    def bin_hints(self, card_prefix: str) -> Optional[BinInfo]:
+        """
+        Cached 3DS metadata for the BIN range of ``card_prefix``, so the
+        frontend can prefetch before the card is submitted. The worker does
+        not pre-connect here, the card may never be submitted.
+        """
+        return self.bins.get(card_prefix)
+
     # TODO the frontend needs to do the wait for. The backend needs to
     # log/persist the callback response. Use redis maybe?
     async def init_threeds_method(self, transaction_id, three_method_url):
@@ -100,7 +352,7 @@ class RedsysUtility:
             )
             try:
                 result = await asyncio.wait_for(
-                    self.api.post(
+                    self.api.post_raw(
                         three_method_url, json={"threeDSMethodData": payload}
                     ),
                     timeout=10,
@@ -125,10 +377,70 @@ class RedsysUtility:
         three_ds_comp_ind: str,
         currency=978,
         transaction_type="0",
+        store_card=False,
+        cof_type="C",
     ):
+        merchant = RedsysMerchantParams.from_euros(
+            amount_eur=amount,
+            currency_numeric=currency,
+            merchant_code=self.merchant_code,
+            order=order,
+            terminal=self.terminal,
+            transaction_type="0",
+            pan=card,
+            cvv2=cvv,
+            expiry_date=expiry_date,
+            emv3ds=self._authentication_data(
+                order, protocol_version, transaction_id, three_ds_comp_ind
+            ),
+            **self._cof_params(store_card, cof_type),
+        )
+        return await self._send_authentication(
+            merchant,
+            transaction_id,
+            {
+                "amount": str(amount),
+                "card": card,
+                "cvv": cvv,
+                "expiry_date": expiry_date,
+                "protocol_version": protocol_version,
+                "currency": currency,
+                "store_card": store_card,
+                "cof_type": cof_type,
+            },
+        )
+
+    async def init_trata_peticion_session(
+        self,
+        session_token: str,
+        protocol_version: str,
+        transaction_id: str,
+        three_ds_comp_ind: str,
+        order: Optional[OrderId] = None,
+    ):
+        """
+        ``init_trata_peticion`` for a checkout session: the card data and
+        amount come from the session created by ``init_transaction``.
+        """
+        session = await self.checkout.get(session_token, order)
+        merchant = session.merchant_params(
+            Ds_Merchant_EMV3DS=self._authentication_data(
+                session.order, protocol_version, transaction_id, three_ds_comp_ind
+            )
+        )
+        return await self._send_authentication(
+            merchant,
+            transaction_id,
+            {"session_token": session_token, "protocol_version": protocol_version},
+            session_token=session_token,
+        )
+
+    def _authentication_data(
+        self, order, protocol_version, transaction_id, three_ds_comp_ind
+    ) -> RedsysEMV3DS:
         request = get_current_request()
         notification_url = f"{self.container_url}/@notificationRedsysChallenge/{order}/{transaction_id}"
-        emv3ds_auth = RedsysEMV3DS(
+        return RedsysEMV3DS(
             threeDSInfo="AuthenticationData",
             protocolVersion=protocol_version,
             browserJavascriptEnabled="true",
@@ -144,6 +456,224 @@ class RedsysUtility:
             threeDSCompInd=three_ds_comp_ind,
             notificationURL=notification_url,
         )
+
+    async def _send_authentication(
+        self, merchant, transaction_id, context, session_token=None
+    ):
+        order = merchant.Ds_Merchant_Order
+        response = await self._post_redsys("/trataPeticionREST", merchant)
+        result = None
+        if isinstance(response, RedsysErrorResponse):
+            result = response
+        elif "Ds_EMV3DS" in response:
+            result = RedsysEMV3DSResponse(**response["Ds_EMV3DS"])
+        elif "Ds_Response" in response:
+            result = RedsysAuthResult(**response)
+        if self.auto_complete_challenge and isinstance(result, RedsysEMV3DSResponse):
+            await self._store_challenge_context(order, transaction_id, context)
+        if session_token and result is not None:
+            await self._end_session(session_token, result)
+        await self._emit_outcome(order, result, transaction_id)
+        return result
+
+    async def _end_session(self, session_token, result):
+        # the card data is no longer needed once the flow has an outcome
+        if not isinstance(result, RedsysEMV3DSResponse):
+            await self.checkout.delete(session_token)
+
+    async def _store_challenge_context(self, order, transaction_id, context):
+        # Encrypted and short lived: only until the ACS posts the CRES
+        redis_driver = await get_driver()
+        await redis_driver.set(
+            key=keys.challenge_context(order, transaction_id),
+            data=encrypt_context(self.secret_key, context).encode("utf-8"),
+            expire=self.challenge_context_ttl,
+        )
+
+    async def store_challenge_result(self, order, transaction_id, result):
+        redis_driver = await get_driver()
+        await redis_driver.set(
+            key=keys.challenge_result(order, transaction_id),
+            data=json.dumps(result.dict()).encode("utf-8"),
+            expire=EXPIRATION_30_MIN,
+        )
+
+    async def get_challenge_result(self, order, transaction_id):
+        # polled by the browsers
+        result = await self.reads.get(keys.challenge_result(order, transaction_id))
+        if result is None:
+            return None
+        return json.loads(result)
+
+    async def _claim_cres(self, order, transaction_id, token):
+        redis_driver = await get_driver()
+        for _ in range(2):
+            state, *value = await redis_driver.pool.eval(
+                _CLAIM_CRES_SCRIPT,
+                3,
+                keys.challenge_result(order, transaction_id),
+                keys.notification_cres(order, transaction_id),
+                keys.challenge_claim(order, transaction_id),
+                int(self.challenge_claim_ttl * 1000),
+                token,
+            )
+            if state != b"none" or not await self._adopt_legacy_cres(
+                order, transaction_id
+            ):
+                break
+        return state.decode("utf-8"), value[0] if value else None
+
+    async def _adopt_legacy_cres(self, order, transaction_id):
+        # a CRES received before the upgrade, under the 1.0.0 key name; it
+        # lives in another slot, so it is moved before claiming
+        pool = (await get_driver()).pool
+        legacy = keys.legacy_notification_cres(order, transaction_id)
+        cres = await pool.get(legacy)
+        if cres is None:
+            return False
+        ttl = await pool.pttl(legacy)
+        await pool.set(
+            keys.notification_cres(order, transaction_id),
+            cres,
+            px=ttl if ttl > 0 else EXPIRATION_30_MIN * 1000,
+            nx=True,
+        )
+        await pool.delete(legacy)
+        return True
+
+    async def _release_cres(self, order, transaction_id, token, done):
+        redis_driver = await get_driver()
+        await redis_driver.pool.eval(
+            _RELEASE_CRES_SCRIPT,
+            2,
+            keys.notification_cres(order, transaction_id),
+            keys.challenge_claim(order, transaction_id),
+            token,
+            "1" if done else "0",
+        )
+
+    async def authenticate_challenge_once(
+        self,
+        order,
+        transaction_id,
+        authenticate: Callable[[str], Awaitable[Any]],
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Authenticate the CRES of a challenge at most once.
+
+        The first caller takes the claim lock atomically and runs
+        ``authenticate(cres)``; the result is stored for the order and only
+        then the CRES is deleted. Callers arriving meanwhile, in this worker
+        or any other, wait for that result instead of sending the CRES to
+        Redsys again. If authentication fails, or the claimer dies and its
+        lock expires, a later call can retry. Returns the result as a dict,
+        or None when there is no CRES (yet) or the wait timed out.
+        """
+        claim_key = keys.challenge_claim(order, transaction_id)
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.challenge_claim_ttl
+        while True:
+            state, value = await self._claim_cres(order, transaction_id, token)
+            if state == "result":
+                return json.loads(value)
+            if state == "none":
+                return None
+            if state == "cres":
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            claim = self._challenge_claims.get(claim_key)
+            if claim is not None:
+                try:
+                    await asyncio.wait_for(asyncio.shield(claim), remaining)
+                except asyncio.TimeoutError:
+                    return None
+            else:
+                await asyncio.sleep(min(self.challenge_poll_interval, remaining))
+
+        claim = asyncio.get_event_loop().create_future()
+        self._challenge_claims[claim_key] = claim
+        done = False
+        try:
+            result = await authenticate(value.decode("utf-8"))
+            if result is None:
+                raise ValueError(f"No result authenticating challenge {order}")
+            await self.store_challenge_result(order, transaction_id, result)
+            done = True
+        finally:
+            try:
+                await asyncio.shield(
+                    self._release_cres(order, transaction_id, token, done)
+                )
+            finally:
+                # waiters look again: stored result, or a CRES to claim
+                del self._challenge_claims[claim_key]
+                claim.set_result(None)
+        return result.dict()
+
+    async def complete_challenge(self, order, transaction_id):
+        """
+        Finish a challenge on the server as soon as the CRES arrives, with
+        the context saved by ``init_trata_peticion``. The result is stored
+        for the browser to pick up, ``CHALLENGE_ERROR`` if it failed, since
+        the context is gone. The CRES stored by the notification is claimed,
+        so it is not authenticated twice with
+        ``@performNotificationRedsysChallenge``.
+        """
+        redis_driver = await get_driver()
+        stored = await redis_driver.pool.getdel(
+            keys.challenge_context(order, transaction_id)
+        )
+        if stored is None:
+            return None
+        context = decrypt_context(self.secret_key, stored.decode("utf-8"))
+
+        async def authenticate(claimed_cres):
+            if "session_token" in context:
+                return await self.authenticate_cres_session(
+                    context["session_token"],
+                    context["protocol_version"],
+                    claimed_cres,
+                    order=order,
+                )
+            return await self.authenticate_cres(
+                amount=Decimal(context["amount"]),
+                card=context["card"],
+                cvv=context["cvv"],
+                expiry_date=context["expiry_date"],
+                order=order,
+                protocol_version=context["protocol_version"],
+                cres=claimed_cres,
+                currency=context["currency"],
+                store_card=context["store_card"],
+                cof_type=context["cof_type"],
+            )
+
+        try:
+            return await self.authenticate_challenge_once(
+                order, transaction_id, authenticate
+            )
+        except Exception:
+            logger.error(f"Error completing challenge {order}", exc_info=True)
+            # the poller of @getResultRedsysChallenge must not wait forever
+            await self.store_challenge_result(order, transaction_id, CHALLENGE_ERROR)
+            return CHALLENGE_ERROR.dict()
+
+    async def authenticate_cres(
+        self,
+        amount: Decimal,
+        card: Pan,
+        cvv: CVV2,
+        expiry_date: ExpiryDate,
+        order: OrderId,
+        protocol_version: str,
+        cres: str,
+        currency=978,
+        transaction_type="0",
+        store_card=False,
+        cof_type="C",
+    ):
         merchant = RedsysMerchantParams.from_euros(
             amount_eur=amount,
             currency_numeric=currency,
@@ -154,65 +684,135 @@ class RedsysUtility:
             pan=card,
             cvv2=cvv,
             expiry_date=expiry_date,
-            emv3ds=emv3ds_auth,
+            emv3ds=self._challenge_response(protocol_version, cres),
+            **self._cof_params(store_card, cof_type),
         )
-        form = RedsysForm.from_merchant(
-            merchant=merchant,
-            terminal_key=self.secret_key,
-        )
-        response = await self.redsys_api.post("/trataPeticionREST", json=form.dict())
-        response = json.loads(response)
-        if "errorCode" in response:
-            return RedsysErrorResponse(**response)
-        decoded = decode_redsys_merchant_parameters(response["Ds_MerchantParameters"])
-        if "Ds_EMV3DS" in decoded:
-            return RedsysEMV3DSResponse(**decoded["Ds_EMV3DS"])
-        if "Ds_Response" in decoded:
-            return RedsysAuthResult(**decoded)
+        return await self._send_challenge_response(merchant)
 
-    async def authenticate_cres(
+    async def authenticate_cres_session(
         self,
-        amount: Decimal,
-        card: Pan,
-        cvv: CVV2,
-        expiry_date: ExpiryDate,
-        order: OrderId,
+        session_token: str,
         protocol_version: str,
         cres: str,
-        currency=978,
-        transaction_type="0",
+        order: Optional[OrderId] = None,
     ):
-        emv3ds_auth = RedsysEMV3DS(
+        """
+        ``authenticate_cres`` for a checkout session.
+        """
+        session = await self.checkout.get(session_token, order)
+        merchant = session.merchant_params(
+            Ds_Merchant_EMV3DS=self._challenge_response(protocol_version, cres)
+        )
+        return await self._send_challenge_response(merchant, session_token)
+
+    def _challenge_response(self, protocol_version, cres) -> RedsysEMV3DS:
+        return RedsysEMV3DS(
             threeDSInfo="ChallengeResponse",
             protocolVersion=protocol_version,
             cres=cres,
         )
+
+    async def _send_challenge_response(self, merchant, session_token=None):
+        response = await self._post_redsys("/trataPeticionREST", merchant)
+        result = None
+        if isinstance(response, RedsysErrorResponse):
+            result = response
+        elif "Ds_Response" in response:
+            result = RedsysAuthResult(**response)
+        if session_token and result is not None:
+            await self._end_session(session_token, result)
+        await self._emit_outcome(merchant.Ds_Merchant_Order, result)
+        return result
+
+    async def token_payment(
+        self,
+        amount: Decimal,
+        identifier: str,
+        order: OrderId,
+        cof_type="R",
+        cof_txnid=None,
+        currency=978,
+        transaction_type="0",
+    ):
+        """
+        Charge a card previously tokenized by Redsys (Ds_Merchant_Identifier).
+        Merchant initiated, so it is exempt from 3DS and finishes with a
+        single trataPeticionREST call.
+        """
         merchant = RedsysMerchantParams.from_euros(
             amount_eur=amount,
             currency_numeric=currency,
             merchant_code=self.merchant_code,
             order=order,
             terminal=self.terminal,
-            transaction_type="0",
-            pan=card,
-            cvv2=cvv,
-            expiry_date=expiry_date,
-            emv3ds=emv3ds_auth,
+            transaction_type=transaction_type,
+            identifier=identifier,
+            cof_ini="N",
+            cof_type=cof_type,
+            cof_txnid=cof_txnid,
+            excep_sca="MIT",
+            direct_payment="true",
         )
-        form = RedsysForm.from_merchant(
-            merchant=merchant,
-            terminal_key=self.secret_key,
+        response = await self._post_redsys("/trataPeticionREST", merchant)
+        if isinstance(response, RedsysErrorResponse):
+            result = response
+        else:
+            result = RedsysAuthResult(**response)
+        await self._emit_outcome(order, result)
+        return result
+
+    async def _preauth_operation(
+        self,
+        amount: Decimal,
+        order: OrderId,
+        transaction_type: str,
+        currency=978,
+    ):
+        # Confirmation and cancellation only reference the original order
+        merchant = RedsysMerchantParams.from_euros(
+            amount_eur=amount,
+            currency_numeric=currency,
+            merchant_code=self.merchant_code,
+            order=order,
+            terminal=self.terminal,
+            transaction_type=transaction_type,
         )
-        response = await self.redsys_api.post("/trataPeticionREST", json=form.dict())
-        response = json.loads(response)
-        if "errorCode" in response:
-            return RedsysErrorResponse(**response)
-        decoded = decode_redsys_merchant_parameters(response["Ds_MerchantParameters"])
-        if "Ds_Response" in decoded:
-            return RedsysAuthResult(**decoded)
+        response = await self._post_redsys("/trataPeticionREST", merchant)
+        if isinstance(response, RedsysErrorResponse):
+            return response
+        return RedsysAuthResult(**response)
+
+    async def confirm_preauthorization(
+        self, amount: Decimal, order: OrderId, currency=978
+    ):
+        return await self._preauth_operation(amount, order, "2", currency=currency)
+
+    async def cancel_preauthorization(
+        self, amount: Decimal, order: OrderId, currency=978
+    ):
+        return await self._preauth_operation(amount, order, "9", currency=currency)
 
     async def initialize(self):
-        pass
+        if len(self.endpoints.endpoints) > 1:
+            self._tasks.append(asyncio.create_task(self.endpoints.run()))
+        if self.preauth_scheduler.enabled:
+            self._tasks.append(asyncio.create_task(self.preauth_scheduler.run()))
+        if self.sweeper.enabled:
+            self._tasks.append(asyncio.create_task(self.sweeper.run()))
+        if self.billing.enabled:
+            self._tasks.append(asyncio.create_task(self.billing.run()))
 
     async def finalize(self):
-        pass
+        await self.push.close()
+        await self.audit.close()
+        await self.traces.close()
+        await self.reads.close()
+        tasks = self._tasks + list(self._preconnects)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+        await self.endpoints.close()
+        await self.redsys_api.close()
+        # the ACS transport
+        await self.api.close()
@@ -1,16 +1,21 @@
-from aiohttp import ClientConnectorError
 from Crypto.Cipher import AES  # pip install pycryptodome
-from tenacity import retry
-from tenacity import retry_if_exception_type
-from tenacity import stop_after_attempt
-from tenacity import wait_exponential
+from guillotina_redsys.endpoints import EndpointPool
+from guillotina_redsys.faults import FaultInjector
+from guillotina_redsys.retries import HTTPServerError
+from guillotina_redsys.retries import RetryPolicy
+from guillotina_redsys.transports import AiohttpTransport
+from guillotina_redsys.transports import Transport
+from guillotina_redsys.transports import TransportConnectionError
+from guillotina_redsys.transports import TransportResponse
 from typing import Any
 from typing import Dict
 from typing import Optional
 from typing import Union
 
 import aiohttp
+import asyncio
 import base64
+import binascii
 import hashlib
 import hmac
 import json
@@ -26,14 +31,79 @@ def _base64url_encode(raw: bytes) -> str:
     return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
 
 
-def decode_redsys_merchant_parameters(encoded: str) -> Dict[str, Any]:
+_json_decoder = json.JSONDecoder()
+
+
+def load_json(data: bytes) -> Any:
+    """
+    Parse UTF-8 JSON bytes. A single C level decode; ``json.loads(bytes)``
+    sniffs the encoding in Python first.
+    """
+    return _json_decoder.decode(data.decode("utf-8"))
+
+
+def decode_redsys_merchant_parameters(encoded: Union[str, bytes]) -> Dict[str, Any]:
     """
     Decode Redsys Ds_MerchantParameters (Base64URL without padding) into a dict.
     """
-    # restore padding for base64
-    padding = "=" * (-len(encoded) % 4)
-    raw = base64.urlsafe_b64decode(encoded + padding)
-    return json.loads(raw.decode("utf-8"))
+    # to the standard alphabet and restore padding for base64
+    if isinstance(encoded, bytes):
+        encoded = encoded.replace(b"-", b"+").replace(b"_", b"/") + b"=" * (
+            -len(encoded) % 4
+        )
+    else:
+        encoded = encoded.replace("-", "+").replace("_", "/") + "=" * (
+            -len(encoded) % 4
+        )
+    return load_json(binascii.a2b_base64(encoded))
+
+
+_PAN_FIELDS = {"ds_merchant_pan", "pan", "card", "ds_card_number", "ds_cardnumber"}
+_SECRET_FIELDS = {
+    "ds_merchant_cvv2",
+    "cvv",
+    "cvv2",
+    "ds_merchant_expirydate",
+    "ds_expirydate",
+    "expiry_date",
+}
+_TOKEN_FIELDS = {"ds_merchant_identifier", "identifier"}
+
+
+def _mask_pan(pan: str) -> str:
+    if len(pan) <= 10:
+        return "*" * len(pan)
+    return pan[:6] + "*" * (len(pan) - 10) + pan[-4:]
+
+
+def mask_card_data(data: Any) -> Any:
+    """
+    Copy of ``data`` safe to log: PANs keep only BIN and last 4 digits,
+    CVV and expiry date are blanked, card tokens keep the last 4 chars.
+    ``Ds_MerchantParameters`` is decoded so the masked content stays readable.
+    """
+    if isinstance(data, list):
+        return [mask_card_data(value) for value in data]
+    if not isinstance(data, dict):
+        return data
+    masked = {}
+    for key, value in data.items():
+        lowered = key.lower()
+        if not isinstance(value, str) or not value:
+            value = mask_card_data(value)
+        elif lowered in _PAN_FIELDS:
+            value = _mask_pan(value)
+        elif lowered in _SECRET_FIELDS:
+            value = "*" * len(value)
+        elif lowered in _TOKEN_FIELDS and value != "REQUIRED":
+            value = "*" * max(len(value) - 4, 0) + value[-4:]
+        elif key == "Ds_MerchantParameters":
+            try:
+                value = mask_card_data(decode_redsys_merchant_parameters(value))
+            except Exception:
+                value = "<undecodable>"
+        masked[key] = value
+    return masked
 
 
 def _aes_cbc_encrypt(key16: bytes, plaintext: bytes) -> bytes:
@@ -83,14 +153,42 @@ def compute_redsys_signature(
     return _base64url_encode(mac)
 
 
-class HTTPServerError(Exception):
-    """Raised for 5xx responses so tenacity can retry."""
+def _context_key(secret_key: str) -> bytes:
+    return hashlib.sha256(f"redsys-context:{secret_key}".encode("utf-8")).digest()
+
+
+def encrypt_context(secret_key: str, data: Dict[str, Any]) -> str:
+    """
+    AES-256-GCM encrypt a JSON serializable dict for short lived server side
+    storage (e.g. card data while a 3DS challenge is running).
+    """
+    cipher = AES.new(_context_key(secret_key), AES.MODE_GCM)
+    ciphertext, tag = cipher.encrypt_and_digest(json.dumps(data).encode("utf-8"))
+    return base64.b64encode(cipher.nonce + tag + ciphertext).decode("ascii")
+
+
+def decrypt_context(secret_key: str, token: str) -> Dict[str, Any]:
+    """
+    Reverse of ``encrypt_context``. Raises ValueError if it was tampered with.
+    """
+    raw = base64.b64decode(token)
+    nonce, tag, ciphertext = raw[:16], raw[16:32], raw[32:]
+    cipher = AES.new(_context_key(secret_key), AES.MODE_GCM, nonce=nonce)
+    return json.loads(cipher.decrypt_and_verify(ciphertext, tag))
 
 
 class RestAPI:
     """
     Minimal async REST client with retry logic.
     Good fit for Redsys REST calls.
+
+    The HTTP client is a pluggable ``Transport`` (aiohttp by default, see
+    ``guillotina_redsys.transports``); retries and error mapping are the same
+    for every transport.
+
+    With an ``EndpointPool`` every attempt goes to its active endpoint and
+    reports the outcome, so a retry after a failover lands on the new one.
+    Attempts are repeated as the ``RetryPolicy`` classifies their errors.
     """
 
     def __init__(
@@ -99,27 +197,31 @@ class RestAPI:
         *,
         session: Optional[aiohttp.ClientSession] = None,
         timeout: int = 10,
+        faults: Optional[FaultInjector] = None,
+        transport: Optional[Transport] = None,
+        endpoints: Optional[EndpointPool] = None,
+        retry_policy: Optional[RetryPolicy] = None,
     ) -> None:
         if base_url:
             self.base_url = base_url.rstrip("/")
         else:
             self.base_url = None
-        self._external_session = session is not None
-        self.session = session or aiohttp.ClientSession(
-            timeout=aiohttp.ClientTimeout(total=timeout)
-        )
+        self.faults = faults
+        self.endpoints = endpoints
+        self.transport = transport or AiohttpTransport(session=session, timeout=timeout)
+        self.retry_policy = retry_policy or RetryPolicy()
+
+    @property
+    def session(self) -> Optional[aiohttp.ClientSession]:
+        return getattr(self.transport, "session", None)
 
     async def close(self) -> None:
-        if not self._external_session:
-            await self.session.close()
-
-    @retry(
-        retry=retry_if_exception_type((ClientConnectorError, HTTPServerError)),
-        stop=stop_after_attempt(3),
-        wait=wait_exponential(min=0.5, max=5),
-        reraise=True,
-    )
-    async def _request(
+        await self.transport.close()
+
+    async def _request(self, method: str, path: str, **kwargs):
+        return await self.retry_policy.call(self._send, method, path, **kwargs)
+
+    async def _send(
         self,
         method: str,
         path: str,
@@ -128,29 +230,68 @@ class RestAPI:
         data: Optional[Dict[str, Any]] = None,
         params: Optional[Dict[str, Any]] = None,
         headers: Optional[Dict[str, str]] = None,
-    ) -> Union[Dict[str, Any], str]:
-        if self.base_url:
-            url = f"{self.base_url}/{path.lstrip('/')}"
+        raw: bool = False,
+    ) -> Union[Dict[str, Any], str, bytes]:
+        base_url = self.endpoints.active if self.endpoints else self.base_url
+        if base_url:
+            url = f"{base_url}/{path.lstrip('/')}"
         else:
             url = path
-        async with self.session.request(
-            method.upper(),
-            url,
-            json=json,
-            data=data,
-            params=params,
-            headers=headers,
-        ) as resp:
-            # Retry only on 5xx
-            if 500 <= resp.status < 600:
-                text = await resp.text()
-                raise HTTPServerError(f"{resp.status} Server Error: {text}")
+        faults = (
+            self.faults if self.faults is not None and self.faults.enabled else None
+        )
+        injected = None
+        try:
+            if faults is not None:
+                # injected resets and 5xx count against the endpoint too
+                injected = await faults.before_request(method, url)
+            if injected is None:
+                resp = await self.transport.request(
+                    method.upper(),
+                    url,
+                    json=json,
+                    data=data,
+                    params=params,
+                    headers=headers,
+                )
+            else:
+                resp = TransportResponse(injected[0], injected[1].encode("utf-8"))
+        except (
+            aiohttp.ClientConnectorError,
+            TransportConnectionError,
+            # aiohttp.ServerTimeoutError included
+            asyncio.TimeoutError,
+        ) as e:
+            if self.endpoints:
+                self.endpoints.record(base_url, False, error=repr(e))
+            raise
+        # Retry only on 5xx
+        if 500 <= resp.status < 600:
+            if self.endpoints:
+                self.endpoints.record(base_url, False, error=f"HTTP {resp.status}")
+            raise HTTPServerError(f"{resp.status} Server Error: {resp.text()}")
+        if injected is not None:
+            # a synthetic Redsys error, the endpoint was never called
+            return resp.body if raw else resp.text()
+        if self.endpoints:
+            # latency comes from the probes only, Redsys processing time
+            # varies too much per operation to compare endpoints
+            self.endpoints.record(base_url, True)
 
-            # For Redsys you usually get JSON
-            try:
-                return await resp.json()
-            except Exception:
-                return await resp.text()
+        if raw:
+            # the body as read, parsing is left to the caller
+            if faults is not None:
+                return faults.after_response(url, resp.body)
+            return resp.body
+
+        if faults is not None:
+            return faults.after_response(url, resp.text())
+
+        # For Redsys you usually get JSON
+        try:
+            return resp.json()
+        except Exception:
+            return resp.text()
 
     # ---- public coroutines ----
 
@@ -176,6 +317,25 @@ class RestAPI:
             "POST", path, json=json, params=params, data=data, headers=headers
         )
 
+    async def post_raw(
+        self,
+        path: str,
+        *,
+        data: Optional[str] = None,
+        json: Optional[Dict[str, Any]] = None,
+        params: Optional[Dict[str, Any]] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> bytes:
+        return await self._request(
+            "POST",
+            path,
+            json=json,
+            params=params,
+            data=data,
+            headers=headers,
+            raw=True,
+        )
+
     async def patch(
         self,
         path: str,
@@ -45,5 +45,9 @@ setup(
         "redis>4.2.0rc1",
     ],
     tests_require=test_requires,
-    extras_require={"test": test_requires},
+    extras_require={
+        "test": test_requires,
+        "http2": ["httpx[http2]"],
+        "metrics": ["prometheus_client"],
+    },
 )